@@ -0,0 +1,29 @@
+"""Add partial index on free credentials
+
+Revision ID: 3c9a1f5d7b2e
+Revises: ed4a93f9b7a3
+Create Date: 2026-10-16 23:40:12.318204
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3c9a1f5d7b2e'
+down_revision = 'ed4a93f9b7a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_credentials_free_date_last_usage',
+        'credentials',
+        [sa.text('date_last_usage ASC NULLS FIRST')],
+        unique=False,
+        postgresql_where=sa.text('NOT in_use'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_credentials_free_date_last_usage', table_name='credentials')
@@ -0,0 +1,31 @@
+"""Add available_at field
+
+Revision ID: 5f0e2a7c9d14
+Revises: b81d4e0c6a95
+Create Date: 2026-10-17 01:02:33.571840
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5f0e2a7c9d14'
+down_revision = 'b81d4e0c6a95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('credentials', sa.Column('available_at', sa.DateTime(), nullable=True))
+    op.create_index(
+        'ix_credentials_free_available_at',
+        'credentials',
+        ['available_at'],
+        unique=False,
+        postgresql_where=sa.text('NOT in_use'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_credentials_free_available_at', table_name='credentials')
+    op.drop_column('credentials', 'available_at')
@@ -0,0 +1,53 @@
+"""Add credential_leases table
+
+Revision ID: 8e5a2c7f1b39
+Revises: d6c1f8a3e947
+Create Date: 2026-10-17 22:04:19.337051
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8e5a2c7f1b39'
+down_revision = 'd6c1f8a3e947'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'credential_leases',
+        sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+        sa.Column('credential_id', sa.Integer(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['credential_id'], ['credentials.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_credential_leases_expires_at', 'credential_leases', ['expires_at'], unique=False)
+    # Every leased slot keeps the expiry its credential had.
+    op.execute(
+        'INSERT INTO credential_leases (credential_id, expires_at) '
+        'SELECT id, lease_expires_at FROM credentials, generate_series(1, active_leases) '
+        'WHERE lease_expires_at IS NOT NULL',
+    )
+    op.drop_index('ix_credentials_leased_lease_expires_at', table_name='credentials')
+    op.drop_column('credentials', 'lease_expires_at')
+
+
+def downgrade() -> None:
+    op.add_column('credentials', sa.Column('lease_expires_at', sa.DateTime(), nullable=True))
+    op.create_index(
+        'ix_credentials_leased_lease_expires_at',
+        'credentials',
+        ['lease_expires_at'],
+        unique=False,
+        postgresql_where=sa.text('active_leases > 0'),
+    )
+    op.execute(
+        'UPDATE credentials SET lease_expires_at = leases.expires_at '
+        'FROM (SELECT credential_id, max(expires_at) AS expires_at FROM credential_leases GROUP BY credential_id) '
+        'AS leases WHERE credentials.id = leases.credential_id',
+    )
+    op.drop_index('ix_credential_leases_expires_at', table_name='credential_leases')
+    op.drop_table('credential_leases')
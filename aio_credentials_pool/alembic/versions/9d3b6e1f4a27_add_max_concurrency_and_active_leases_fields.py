@@ -0,0 +1,64 @@
+"""Add max_concurrency and active_leases fields
+
+Revision ID: 9d3b6e1f4a27
+Revises: 5f0e2a7c9d14
+Create Date: 2026-10-17 10:41:08.214675
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9d3b6e1f4a27'
+down_revision = '5f0e2a7c9d14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('credentials', sa.Column('max_concurrency', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('credentials', sa.Column('active_leases', sa.Integer(), server_default='0', nullable=False))
+    op.execute('UPDATE credentials SET active_leases = 1 WHERE in_use')
+
+    op.drop_index('ix_credentials_free_date_last_usage', table_name='credentials')
+    op.create_index(
+        'ix_credentials_free_active_leases_date_last_usage',
+        'credentials',
+        ['active_leases', sa.text('date_last_usage ASC NULLS FIRST')],
+        unique=False,
+        postgresql_where=sa.text('NOT in_use'),
+    )
+
+    # A credential holds a lease as long as any of its slots is taken, not only while it is saturated.
+    op.drop_index('ix_credentials_in_use_lease_expires_at', table_name='credentials')
+    op.create_index(
+        'ix_credentials_leased_lease_expires_at',
+        'credentials',
+        ['lease_expires_at'],
+        unique=False,
+        postgresql_where=sa.text('active_leases > 0'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_credentials_leased_lease_expires_at', table_name='credentials')
+    op.create_index(
+        'ix_credentials_in_use_lease_expires_at',
+        'credentials',
+        ['lease_expires_at'],
+        unique=False,
+        postgresql_where=sa.text('in_use'),
+    )
+
+    op.drop_index('ix_credentials_free_active_leases_date_last_usage', table_name='credentials')
+    op.create_index(
+        'ix_credentials_free_date_last_usage',
+        'credentials',
+        [sa.text('date_last_usage ASC NULLS FIRST')],
+        unique=False,
+        postgresql_where=sa.text('NOT in_use'),
+    )
+
+    op.execute('UPDATE credentials SET in_use = active_leases > 0')
+    op.drop_column('credentials', 'active_leases')
+    op.drop_column('credentials', 'max_concurrency')
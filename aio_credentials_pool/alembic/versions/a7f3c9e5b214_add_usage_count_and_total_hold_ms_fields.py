@@ -0,0 +1,36 @@
+"""Add usage_count and total_hold_ms fields
+
+Revision ID: a7f3c9e5b214
+Revises: e2b7d5a3c816
+Create Date: 2026-10-17 18:03:27.514862
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a7f3c9e5b214'
+down_revision = 'e2b7d5a3c816'
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    'ix_credentials_free_active_leases_usage_count': ['active_leases', 'usage_count'],
+    'ix_credentials_free_tag_active_leases_usage_count': ['tag', 'active_leases', 'usage_count'],
+    'ix_credentials_free_active_leases_total_hold_ms': ['active_leases', 'total_hold_ms'],
+    'ix_credentials_free_tag_active_leases_total_hold_ms': ['tag', 'active_leases', 'total_hold_ms'],
+}
+
+
+def upgrade() -> None:
+    op.add_column('credentials', sa.Column('usage_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('credentials', sa.Column('total_hold_ms', sa.BigInteger(), server_default='0', nullable=False))
+    for name, columns in INDEXES.items():
+        op.create_index(name, 'credentials', columns, unique=False, postgresql_where=sa.text('NOT in_use'))
+
+
+def downgrade() -> None:
+    for name in INDEXES:
+        op.drop_index(name, table_name='credentials')
+    op.drop_column('credentials', 'total_hold_ms')
+    op.drop_column('credentials', 'usage_count')
@@ -0,0 +1,31 @@
+"""Add lease_expires_at field
+
+Revision ID: b81d4e0c6a95
+Revises: 3c9a1f5d7b2e
+Create Date: 2026-10-17 00:21:47.905113
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b81d4e0c6a95'
+down_revision = '3c9a1f5d7b2e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('credentials', sa.Column('lease_expires_at', sa.DateTime(), nullable=True))
+    op.create_index(
+        'ix_credentials_in_use_lease_expires_at',
+        'credentials',
+        ['lease_expires_at'],
+        unique=False,
+        postgresql_where=sa.text('in_use'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_credentials_in_use_lease_expires_at', table_name='credentials')
+    op.drop_column('credentials', 'lease_expires_at')
@@ -0,0 +1,31 @@
+"""Add tag field
+
+Revision ID: c4e8a2d61f93
+Revises: 9d3b6e1f4a27
+Create Date: 2026-10-17 14:12:51.903318
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2d61f93'
+down_revision = '9d3b6e1f4a27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('credentials', sa.Column('tag', sa.Text(), nullable=True))
+    op.create_index(
+        'ix_credentials_free_tag_active_leases_date_last_usage',
+        'credentials',
+        ['tag', 'active_leases', sa.text('date_last_usage ASC NULLS FIRST')],
+        unique=False,
+        postgresql_where=sa.text('NOT in_use'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_credentials_free_tag_active_leases_date_last_usage', table_name='credentials')
+    op.drop_column('credentials', 'tag')
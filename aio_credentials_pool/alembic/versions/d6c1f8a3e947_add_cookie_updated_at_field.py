@@ -0,0 +1,23 @@
+"""Add cookie_updated_at field
+
+Revision ID: d6c1f8a3e947
+Revises: a7f3c9e5b214
+Create Date: 2026-10-17 21:12:44.608317
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'd6c1f8a3e947'
+down_revision = 'a7f3c9e5b214'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('credentials', sa.Column('cookie_updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('credentials', 'cookie_updated_at')
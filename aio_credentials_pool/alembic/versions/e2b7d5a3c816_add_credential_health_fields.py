@@ -0,0 +1,27 @@
+"""Add credential health fields
+
+Revision ID: e2b7d5a3c816
+Revises: c4e8a2d61f93
+Create Date: 2026-10-17 16:41:08.271934
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e2b7d5a3c816'
+down_revision = 'c4e8a2d61f93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('credentials', sa.Column('failure_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('credentials', sa.Column('last_failure_kind', sa.Text(), nullable=True))
+    op.add_column('credentials', sa.Column('quarantined_until', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('credentials', 'quarantined_until')
+    op.drop_column('credentials', 'last_failure_kind')
+    op.drop_column('credentials', 'failure_count')
@@ -5,12 +5,14 @@ Revises: 890872dbc09f
 Create Date: 2023-12-16 18:00:00.644327
 
 """
-import json
+from datetime import datetime
+from itertools import islice
 from pathlib import Path
 
+import sqlalchemy as sa
 from alembic import op
 
-from models import Credential
+from credentials_files import iter_credentials
 
 # revision identifiers, used by Alembic.
 revision = 'f67bda6eade3'
@@ -20,12 +22,28 @@ depends_on = None
 
 
 CREDENTIALS_JSON_PATH = Path(__file__).parent.parent.parent / 'fixtures' / 'credentials.json'
+BATCH_SIZE = 1000
+
+# The table as of this revision, later columns of ``models.Credential`` don't exist yet.
+credentials_table = sa.table(
+    'credentials',
+    sa.column('username', sa.Text),
+    sa.column('password', sa.Text),
+    sa.column('cookie', sa.Text),
+    sa.column('in_use', sa.Boolean),
+    sa.column('created_at', sa.DateTime),
+)
 
 
 def load_credentials_data():
-    with Path(CREDENTIALS_JSON_PATH).open() as file:
-        data = json.load(file)
-        op.bulk_insert(Credential.__table__, data)
+    defaults = {'in_use': False, 'created_at': datetime.utcnow()}
+    rows = (
+        {'username': credential['username'], 'password': credential['password'], 'cookie': credential['cookie']}
+        | defaults
+        for credential in iter_credentials(CREDENTIALS_JSON_PATH)
+    )
+    while batch := list(islice(rows, BATCH_SIZE)):
+        op.bulk_insert(credentials_table, batch)
 
 
 def upgrade() -> None:
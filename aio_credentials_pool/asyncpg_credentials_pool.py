@@ -0,0 +1,72 @@
+import asyncio
+from collections.abc import Sequence
+from dataclasses import dataclass
+
+import asyncpg
+from sqlalchemy import Executable
+from sqlalchemy.dialects.postgresql.asyncpg import dialect as asyncpg_dialect
+
+from persistent_credentials_pool import PersistentCredentialsPool, postgres_dsn
+
+DIALECT = asyncpg_dialect()
+
+
+@dataclass
+class CompiledStatement:
+    sql: str
+    parameter_names: tuple[str, ...]
+    fixed_parameters: dict[str, object]
+
+    @classmethod
+    def compile(cls, statement: Executable) -> 'CompiledStatement':
+        compiled = statement.compile(dialect=DIALECT)
+        return cls(
+            sql=compiled.string,
+            parameter_names=tuple(compiled.positiontup),
+            fixed_parameters={name: bind.effective_value for name, bind in compiled.binds.items() if not bind.required},
+        )
+
+    def arguments(self, parameters: dict) -> list:
+        values = self.fixed_parameters | parameters
+        return [values[name] for name in self.parameter_names]
+
+
+class AsyncpgCredentialsPool(PersistentCredentialsPool):
+    """``PersistentCredentialsPool`` running its statements on a plain ``asyncpg.Pool``.
+
+    Skips the session, unit of work and result processing of SQLAlchemy. Every statement is compiled to SQL once,
+    then asyncpg prepares it once per connection and keeps it in the connection's statement cache.
+    """
+
+    def __init__(self, dsn: str | None = None, min_size: int = 10, max_size: int = 10, **kwargs):
+        super().__init__(**kwargs)
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.connection_pool: asyncpg.Pool | None = None
+        self.connection_pool_lock = asyncio.Lock()
+        self.compiled_statements: dict[int, CompiledStatement] = {}
+
+    async def close(self) -> None:
+        await super().close()
+        if self.connection_pool is not None:
+            connection_pool, self.connection_pool = self.connection_pool, None
+            await connection_pool.close()
+
+    async def _run(self, statement: Executable, parameters: dict) -> Sequence[asyncpg.Record]:
+        compiled = self.compiled_statements.get(id(statement))
+        if compiled is None:
+            compiled = self.compiled_statements[id(statement)] = CompiledStatement.compile(statement)
+
+        connection_pool = self.connection_pool or await self._create_connection_pool()
+        return await connection_pool.fetch(compiled.sql, *compiled.arguments(parameters))
+
+    async def _create_connection_pool(self) -> asyncpg.Pool:
+        async with self.connection_pool_lock:
+            if self.connection_pool is None:
+                self.connection_pool = await asyncpg.create_pool(
+                    self.dsn or postgres_dsn(),
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                )
+        return self.connection_pool
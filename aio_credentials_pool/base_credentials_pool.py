@@ -1,21 +1,65 @@
 import asyncio
 import logging
+import random
+import time
+from collections.abc import Awaitable, Callable, Iterable, Sequence
 from dataclasses import dataclass
+from enum import StrEnum
+from functools import cached_property
+from typing import TypeVar
 
+from metrics import PoolMetrics
 from models import Credential
+from tracing import TRACER, TraceOp
+
+T = TypeVar('T')
 
 LOGGER = logging.getLogger(__name__)
 
+# Weight of the latest attempt in the miss rate of a pool.
+MISS_RATE_WEIGHT = 0.1
+
+
+class FailureKind(StrEnum):
+    ERROR = 'error'
+    RATE_LIMITED = 'rate_limited'
+    STALE_COOKIE = 'stale_cookie'
+    BANNED = 'banned'
+
+
+# Quarantine after the first failure of a kind, doubled with every further failure before a success.
+QUARANTINE_SECONDS = {
+    FailureKind.ERROR: 30,
+    FailureKind.RATE_LIMITED: 60,
+    FailureKind.STALE_COOKIE: 300,
+    FailureKind.BANNED: 3600,
+}
+MAX_QUARANTINE_SECONDS = 24 * 3600
+
+
+def quarantine_seconds(kind: FailureKind, failure_count: int) -> float:
+    """Quarantine after the ``failure_count``-th failure in a row, this one included."""
+    return min(MAX_QUARANTINE_SECONDS, QUARANTINE_SECONDS[kind] * 2 ** (failure_count - 1))
+
 
 class NoAvailableCredentialsError(Exception):
     pass
 
 
-@dataclass
+class CredentialNotFoundError(Exception):
+    """The credential being released or reported is not in the pool."""
+
+
+@dataclass(slots=True)
 class CredentialMetadata:
     username: str
     password: str
     cookie: str | None
+    id: int | None = None
+    max_concurrency: int = 1
+    tag: str | None = None
+    # Failures reported since the last success, as of acquiring the credential.
+    failure_count: int = 0
 
     @classmethod
     def from_orm(cls, credential: Credential) -> 'CredentialMetadata':
@@ -23,35 +67,312 @@ class CredentialMetadata:
             username=credential.username,
             password=credential.password,
             cookie=credential.cookie,
+            id=credential.id,
+            max_concurrency=credential.max_concurrency,
+            tag=credential.tag,
+            failure_count=credential.failure_count,
         )
 
 
+class CredentialLease:
+    """Acquires a credential on enter and releases it exactly once, at the latest on exit.
+
+    The release is shielded: cancelling the task while the credential is being released doesn't interrupt the release.
+    So is the acquire: a credential taken by an acquire attempt that the cancellation hit is released by the pool.
+    No database connection is held while the body runs, the pool only touches the database to acquire and release.
+    """
+
+    def __init__(self, pool: 'BaseCredentialsPool', **acquire_kwargs):
+        self.pool = pool
+        self.acquire_kwargs = acquire_kwargs
+        self.credential: CredentialMetadata | None = None
+        self.releasing: asyncio.Future[None] | None = None
+
+    async def __aenter__(self) -> CredentialMetadata:
+        self.credential = await self.pool.acquire(**self.acquire_kwargs)
+        return self.credential
+
+    async def __aexit__(self, *_exc_info) -> None:
+        await self.release()
+
+    async def release(self) -> None:
+        if self.credential is None:
+            return
+        if self.releasing is None:
+            self.releasing = asyncio.ensure_future(self.pool.release(self.credential))
+        await asyncio.shield(self.releasing)
+
+
+def normalize_tags(tags: Iterable[str] | None) -> tuple[str, ...] | None:
+    """Deduplicated tags in the order they were given, ``None`` matches credentials of any tag."""
+    if tags is None:
+        return None
+    if isinstance(tags, str):
+        tags = (tags,)
+    return tuple(dict.fromkeys(tags))
+
+
 class BaseCredentialsPool:
-    async def acquire(self, max_retries=3, min_wait=1, max_wait=32) -> CredentialMetadata:
-        current_wait = min_wait
+    # Exponentially weighted share of recent acquire attempts that found no free credential, across all callers.
+    miss_rate = 0.0
+
+    async def acquire(  # noqa: PLR0913
+        self,
+        max_retries=3,
+        min_wait=1,
+        max_wait=32,
+        tags: Iterable[str] | None = None,
+        timeout: float | None = None,
+    ) -> CredentialMetadata:
+        """Acquire a credential, with ``tags`` only one whose tag is among them, preferring earlier tags.
+
+        A miss is retried after a jittered backoff, ``max_retries`` times or, with ``timeout``, until that many
+        seconds have passed.
+        """
+        tags = normalize_tags(tags)
+        started_at = time.perf_counter()
+        credential, attempt = await self._with_retries(
+            lambda: self._acquire(tags),
+            max_retries,
+            min_wait,
+            max_wait,
+            timeout,
+            tags,
+        )
+        now = time.perf_counter()
+        self.metrics.on_acquired([credential], started_at, now)
+        if TRACER.enabled:
+            TRACER.record(TraceOp.ACQUIRE, credential.id, started_at, now, attempt)
+        return credential
+
+    async def acquire_many(  # noqa: PLR0913
+        self,
+        n: int,
+        min_n: int | None = None,
+        max_retries=3,
+        min_wait=1,
+        max_wait=32,
+        tags: Iterable[str] | None = None,
+        timeout: float | None = None,
+    ) -> list[CredentialMetadata]:
+        """Acquire up to ``n`` credentials in one operation.
+
+        Returns at least ``min_n`` (``n`` by default) and at most ``n`` credentials. A batch is taken atomically:
+        if fewer than ``min_n`` credentials are free, none of them are taken and the call waits and retries
+        like ``acquire`` does, raising ``NoAvailableCredentialsError`` once the retries are exhausted.
+        With ``tags``, the whole batch is taken from the first tag that has enough free credentials.
+        """
+        if min_n is None:
+            min_n = n
+        if not 0 < min_n <= n:
+            error_message = f'Expected 0 < min_n <= n, got min_n={min_n}, n={n}'
+            raise ValueError(error_message)
+        tags = normalize_tags(tags)
+
+        started_at = time.perf_counter()
+        credentials, attempt = await self._with_retries(
+            lambda: self._acquire_many(n, min_n, tags),
+            max_retries,
+            min_wait,
+            max_wait,
+            timeout,
+            tags,
+        )
+        now = time.perf_counter()
+        self.metrics.on_acquired(credentials, started_at, now)
+        if TRACER.enabled:
+            for credential in credentials:
+                TRACER.record(TraceOp.ACQUIRE, credential.id, started_at, now, attempt)
+        return credentials
+
+    def lease(self, **acquire_kwargs) -> CredentialLease:
+        """Use as ``async with pool.lease() as credential``, the arguments are passed to ``acquire``."""
+        return CredentialLease(self, **acquire_kwargs)
+
+    async def release(self, credential: CredentialMetadata, cookie: str | None = None) -> None:
+        """Release a credential, with ``cookie`` also saving the session state it was refreshed to."""
+        started_at = time.perf_counter()
+        try:
+            if cookie is not None:
+                credential.cookie = cookie
+                await self._save_cookies([credential])
+        finally:
+            # A failed cookie write never keeps the credential leased.
+            await self._release(credential)
+        now = time.perf_counter()
+        self.metrics.on_released([credential], now)
+        if TRACER.enabled:
+            TRACER.record(TraceOp.RELEASE, credential.id, started_at, now)
 
-        for attempt in range(max_retries + 1):
-            credential = await self._acquire()
+    async def release_many(
+        self,
+        credentials: list[CredentialMetadata],
+        cookies: Sequence[str | None] | None = None,
+    ) -> None:
+        """Release credentials at once, ``cookies`` are refreshed cookies in the same order, ``None`` for unchanged."""
+        if credentials:
+            started_at = time.perf_counter()
+            try:
+                if cookies is not None:
+                    refreshed = []
+                    for credential, cookie in zip(credentials, cookies, strict=True):
+                        if cookie is not None:
+                            credential.cookie = cookie
+                            refreshed.append(credential)
+                    if refreshed:
+                        await self._save_cookies(refreshed)
+            finally:
+                await self._release_many(credentials)
+            now = time.perf_counter()
+            self.metrics.on_released(credentials, now)
+            if TRACER.enabled:
+                for credential in credentials:
+                    TRACER.record(TraceOp.RELEASE, credential.id, started_at, now)
 
-            if credential:
-                LOGGER.info(f'Credential acquired: {credential}')
-                return credential
+    async def report_failure(self, credential: CredentialMetadata, kind: FailureKind = FailureKind.ERROR) -> None:
+        """Quarantine a credential whose use just failed, best called before releasing it.
 
-            if attempt < max_retries:
-                wait_seconds = min(current_wait, max_wait)
-                LOGGER.info(f'Failed to acquire credential. Will retry in {wait_seconds} seconds')
-                await asyncio.sleep(wait_seconds)
-                current_wait *= 2
+        The quarantine lasts ``QUARANTINE_SECONDS[kind]``, doubled for every earlier failure since the last success
+        up to ``MAX_QUARANTINE_SECONDS``. Acquire skips the credential until the quarantine is over.
+        """
+        self.metrics.reported_failures.inc()
+        await self._report_failure(credential, FailureKind(kind))
 
-        error_message = f'No available credentials after {max_retries} retries'
+    async def report_success(self, credential: CredentialMetadata) -> None:
+        """Reset the failure count of a credential once it works again, so its next quarantine is short."""
+        await self._report_success(credential)
+
+    async def close(self) -> None:
+        """Release resources held by the pool itself, such as background connections."""
+
+    @cached_property
+    def abandoned_releases(self) -> set[asyncio.Task[None]]:
+        """Releases of credentials taken by attempts whose caller was cancelled, referenced until done."""
+        return set()
+
+    @cached_property
+    def metrics(self) -> PoolMetrics:
+        return PoolMetrics(type(self).__name__, free=self._free_count)
+
+    def stats(self) -> dict:
+        """Snapshot of the pool metrics, histograms are summarized by count, sum and bucket quantiles."""
+        return self.metrics.snapshot()
+
+    async def _with_retries(  # noqa: PLR0913
+        self,
+        attempt_acquire: Callable[[], Awaitable[T | None]],
+        max_retries: int,
+        min_wait: float,
+        max_wait: float,
+        timeout: float | None = None,
+        tags: tuple[str, ...] | None = None,
+    ) -> tuple[T, int]:
+        """Returns the first truthy result of ``attempt_acquire`` and the number of the attempt that got it.
+
+        Attempts are never interrupted: when the caller is cancelled during one, the attempt still runs to its end
+        and whatever it took is released. With ``timeout``, no attempt starts and no wait lasts past the deadline,
+        whatever ``max_retries`` is.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        wait = min_wait
+        attempt = 0
+
+        while True:
+            started_at = time.perf_counter()
+            result = await self._attempt(attempt_acquire)
+            self.miss_rate += MISS_RATE_WEIGHT * ((0.0 if result else 1.0) - self.miss_rate)
+
+            if result:
+                return result, attempt
+
+            self.metrics.misses.inc()
+            if TRACER.enabled:
+                TRACER.record(TraceOp.MISS, None, started_at, time.perf_counter(), attempt)
+
+            wait = self._backoff(wait, min_wait, max_wait)
+            if deadline is None:
+                if attempt >= max_retries:
+                    break
+            else:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                wait = min(wait, remaining)
+
+            self.metrics.retries.inc()
+            await self._wait_before_retry(wait, tags)
+            attempt += 1
+
+        self.metrics.failures.inc()
+        if TRACER.enabled:
+            TRACER.record(TraceOp.FAILURE, None, started_at, time.perf_counter(), attempt)
+        if deadline is None:
+            error_message = f'No available credentials after {max_retries} retries'
+        else:
+            error_message = f'No available credentials within {timeout} seconds'
         raise NoAvailableCredentialsError(error_message)
 
-    async def release(self, credential: CredentialMetadata) -> None:
-        await self._release(credential)
-        LOGGER.info(f'Credential released: {credential}')
+    async def _attempt(self, attempt_acquire: Callable[[], Awaitable[T | None]]) -> T | None:
+        attempt = asyncio.ensure_future(attempt_acquire())
+        try:
+            return await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            attempt.add_done_callback(self._release_abandoned)
+            raise
+
+    def _release_abandoned(self, attempt: asyncio.Future) -> None:
+        """Release what an attempt took after its caller was cancelled."""
+        if attempt.cancelled() or attempt.exception() is not None or not attempt.result():
+            return
+        result = attempt.result()
+        credentials = result if isinstance(result, list) else [result]
+        task = asyncio.ensure_future(self._release_many(credentials))
+        self.abandoned_releases.add(task)
+        task.add_done_callback(self._on_abandoned_released)
+
+    def _on_abandoned_released(self, task: asyncio.Task[None]) -> None:
+        self.abandoned_releases.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            LOGGER.error('Failed to give back credentials of a cancelled acquire', exc_info=task.exception())
 
-    async def _acquire(self) -> CredentialMetadata | None:
+    def _backoff(self, previous_wait: float, min_wait: float, max_wait: float) -> float:
+        """Decorrelated jitter: a random wait between ``min_wait`` and three times the previous one.
+
+        Callers that miss together spread their retries instead of hitting the backend in lockstep. The range
+        is stretched while most recent attempts on the pool miss and shrunk while they mostly succeed.
+        """
+        upper = previous_wait * 3 * (0.5 + self.miss_rate)
+        return min(max_wait, random.uniform(min_wait, max(min_wait, upper)))
+
+    async def _acquire(self, tags: tuple[str, ...] | None) -> CredentialMetadata | None:
+        raise NotImplementedError
+
+    async def _acquire_many(self, n: int, min_n: int, tags: tuple[str, ...] | None) -> list[CredentialMetadata]:
+        """Take between ``min_n`` and ``n`` free credentials, or none at all."""
         raise NotImplementedError
 
     async def _release(self, credential: CredentialMetadata) -> None:
         raise NotImplementedError
+
+    async def _release_many(self, credentials: list[CredentialMetadata]) -> None:
+        raise NotImplementedError
+
+    async def _save_cookies(self, credentials: list[CredentialMetadata]) -> None:
+        """Keep the refreshed ``cookie`` of every credential for the next holder, called right before the release."""
+        raise NotImplementedError
+
+    async def _report_failure(self, credential: CredentialMetadata, kind: FailureKind) -> None:
+        """Count the failure, set ``credential.failure_count`` to the new count and quarantine the credential."""
+        raise NotImplementedError
+
+    async def _report_success(self, credential: CredentialMetadata) -> None:
+        raise NotImplementedError
+
+    async def _wait_before_retry(self, wait_seconds: float, tags: tuple[str, ...] | None) -> None:  # noqa: ARG002
+        """Wait before the next attempt of an acquire, ``tags`` are its tags for pools woken by matching releases."""
+        await asyncio.sleep(wait_seconds)
+
+    def _free_count(self) -> int | None:
+        """Number of credentials free in this process, ``None`` if the pool can't tell without a query."""
+        return None
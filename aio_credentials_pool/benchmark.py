@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+
+import asyncpg
+from sqlalchemy import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import persistent_credentials_pool
+from asyncpg_credentials_pool import AsyncpgCredentialsPool
+from base_credentials_pool import BaseCredentialsPool, CredentialMetadata, NoAvailableCredentialsError
+from cached_credentials_pool import CachedCredentialsPool
+from in_memory_credentials_pool import InMemoryCredentialsPool
+from models import Base
+from persistent_credentials_pool import PersistentCredentialsPool
+from settings import POSTGRES_URL
+from shared_memory_credentials_pool import SharedMemoryCredentialsPool
+from sqlite_credentials_pool import SqliteCredentialsPool
+
+logging.basicConfig(level=logging.WARNING)
+
+# `postgres` is the database service of docker-compose.yaml.
+LOCAL_HOSTS = {'localhost', '127.0.0.1', '::1', 'postgres'}
+
+HOLD_TIME_DISTRIBUTIONS: dict[str, Callable[[random.Random, float], float]] = {
+    'constant': lambda _rng, mean: mean,
+    'uniform': lambda rng, mean: rng.uniform(0, 2 * mean),
+    'exponential': lambda rng, mean: rng.expovariate(1 / mean) if mean else 0.0,
+}
+
+
+@dataclass
+class BenchmarkConfig:
+    workers: int
+    pool_size: int
+    duration: float
+    hold_time: str
+    hold_mean: float
+    seed: int
+
+
+def credentials(pool_size: int) -> list[CredentialMetadata]:
+    return [CredentialMetadata(f'user{i}', f'pass{i}', None) for i in range(pool_size)]
+
+
+async def prepare_database(size: int) -> None:
+    """Point the persistent pools at a fresh ``<database>_benchmark`` database holding ``size`` credentials."""
+    url = make_url(POSTGRES_URL)
+    if url.host not in LOCAL_HOSTS:
+        error_message = f'The benchmark only runs against a local Postgres, not {url.host}'
+        raise SystemExit(error_message)
+
+    benchmark_url = url.set(database=f'{url.database}_benchmark')
+    connection = await asyncpg.connect(user=url.username, password=url.password, host=url.host, port=url.port)
+    try:
+        if not await connection.fetchval('SELECT 1 FROM pg_database WHERE datname = $1', benchmark_url.database):
+            await connection.execute(f'CREATE DATABASE "{benchmark_url.database}"')
+    finally:
+        await connection.close()
+
+    engine = create_async_engine(benchmark_url)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+        raw_connection = (await connection.get_raw_connection()).driver_connection
+        created_at = datetime.utcnow()
+        records = [(credential.username, credential.password, False, created_at) for credential in credentials(size)]
+        await raw_connection.copy_records_to_table(
+            'credentials',
+            records=records,
+            columns=['username', 'password', 'in_use', 'created_at'],
+        )
+
+    persistent_credentials_pool.async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+
+async def in_memory_pool(pool_size: int) -> BaseCredentialsPool:
+    return InMemoryCredentialsPool(credentials(pool_size))
+
+
+async def compact_pool(pool_size: int) -> BaseCredentialsPool:
+    return InMemoryCredentialsPool(credentials(pool_size), compact=True)
+
+
+async def shared_memory_pool(pool_size: int) -> BaseCredentialsPool:
+    pool = SharedMemoryCredentialsPool(credentials(pool_size), f'benchmark_{os.getpid()}')
+    # The mapping stays valid after the segment is unlinked, and nothing is left behind after the run.
+    pool.unlink()
+    return pool
+
+
+async def sqlite_pool(pool_size: int) -> BaseCredentialsPool:
+    # Replaced on every run, the files of the last run are left in the temporary directory.
+    path = Path(tempfile.gettempdir()) / 'benchmark.sqlite3'
+    for suffix in ('', '-wal', '-shm'):
+        path.with_name(path.name + suffix).unlink(missing_ok=True)
+    return SqliteCredentialsPool(path, credentials(pool_size))
+
+
+async def persistent_pool(pool_size: int) -> BaseCredentialsPool:
+    await prepare_database(pool_size)
+    return PersistentCredentialsPool()
+
+
+async def asyncpg_pool(pool_size: int) -> BaseCredentialsPool:
+    await prepare_database(pool_size)
+    return AsyncpgCredentialsPool()
+
+
+async def cached_pool(pool_size: int) -> BaseCredentialsPool:
+    await prepare_database(pool_size)
+    return CachedCredentialsPool(AsyncpgCredentialsPool())
+
+
+BACKENDS: dict[str, Callable[[int], Awaitable[BaseCredentialsPool]]] = {
+    'in_memory': in_memory_pool,
+    'compact': compact_pool,
+    'shared_memory': shared_memory_pool,
+    'sqlite': sqlite_pool,
+    'persistent': persistent_pool,
+    'asyncpg': asyncpg_pool,
+    'cached': cached_pool,
+}
+
+# Backends keeping every credential in process memory, their memory per credential is reported.
+IN_PROCESS_BACKENDS = {'in_memory', 'compact'}
+
+
+async def create_pool(backend: str, pool_size: int) -> tuple[BaseCredentialsPool, float | None]:
+    """The pool of ``backend`` and, for in-process backends, the bytes it allocated per credential."""
+    if backend not in IN_PROCESS_BACKENDS:
+        return await BACKENDS[backend](pool_size), None
+
+    tracemalloc.start()
+    try:
+        pool = await BACKENDS[backend](pool_size)
+        allocated, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return pool, allocated / pool_size
+
+
+def percentile(sorted_values: list[float], q: float) -> float | None:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def statement_count(pool: BaseCredentialsPool) -> int:
+    count = pool.stats()['statement_seconds']['count']
+    if isinstance(pool, CachedCredentialsPool):
+        count += statement_count(pool.source)
+    return count
+
+
+async def run_benchmark(pool: BaseCredentialsPool, config: BenchmarkConfig) -> dict:
+    """Lease credentials from ``config.workers`` workers for ``config.duration`` seconds and summarize the run."""
+    rng = random.Random(config.seed)
+    hold_time = HOLD_TIME_DISTRIBUTIONS[config.hold_time]
+    latencies: list[float] = []
+    usage: Counter[str] = Counter()
+    failures = 0
+    deadline = time.monotonic() + config.duration
+
+    async def worker() -> None:
+        nonlocal failures
+        while time.monotonic() < deadline:
+            started_at = time.perf_counter()
+            try:
+                async with pool.lease(min_wait=0.01) as credential:
+                    latencies.append(time.perf_counter() - started_at)
+                    usage[credential.username] += 1
+                    # Sleep even without a hold time, an in-memory acquire alone never yields to the other workers.
+                    await asyncio.sleep(hold_time(rng, config.hold_mean))
+            except NoAvailableCredentialsError:
+                failures += 1
+
+    started_at = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(config.workers)))
+    elapsed = time.monotonic() - started_at
+
+    latencies.sort()
+    usage_counts = [usage[credential.username] for credential in credentials(config.pool_size)]
+    squares_sum = sum(count * count for count in usage_counts)
+
+    return {
+        'acquisitions': len(latencies),
+        'failures': failures,
+        'acquisitions_per_second': len(latencies) / elapsed,
+        'acquire_latency_seconds': {
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'p999': percentile(latencies, 0.999),
+            'max': latencies[-1] if latencies else None,
+        },
+        'statements_per_acquisition': statement_count(pool) / len(latencies) if latencies else None,
+        'usage': {
+            'min': min(usage_counts),
+            'max': max(usage_counts),
+            # Jain's fairness index: 1 when every credential was used equally often, 1/n when only one was.
+            'fairness': sum(usage_counts) ** 2 / (len(usage_counts) * squares_sum) if squares_sum else None,
+        },
+    }
+
+
+def current_commit() -> str | None:
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=False)  # noqa: S603, S607
+    return result.stdout.strip() or None
+
+
+def print_result(backend: str, result: dict) -> None:
+    latency = result['acquire_latency_seconds']
+    statements = result['statements_per_acquisition']
+    memory = result['memory_per_credential_bytes']
+    print(  # noqa: T201
+        f'{backend:>12}: {result["acquisitions_per_second"]:10.1f} acquisitions/sec, '
+        f'p50 {(latency["p50"] or 0) * 1000:.2f} ms, p99 {(latency["p99"] or 0) * 1000:.2f} ms, '
+        f'p999 {(latency["p999"] or 0) * 1000:.2f} ms, '
+        f'{statements or 0:.2f} statements/acquisition, fairness {result["usage"]["fairness"] or 0:.3f}'
+        + ('' if memory is None else f', {memory:.0f} bytes/credential'),
+    )
+
+
+async def main(backends: list[str], config: BenchmarkConfig, output: Path | None) -> None:
+    results = {}
+    for backend in backends:
+        pool, memory_per_credential = await create_pool(backend, config.pool_size)
+        try:
+            results[backend] = await run_benchmark(pool, config)
+        finally:
+            await pool.close()
+        results[backend]['memory_per_credential_bytes'] = memory_per_credential
+        print_result(backend, results[backend])
+
+    if output is not None:
+        report = {'commit': current_commit(), 'config': asdict(config), 'results': results}
+        output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the credentials pool backends against a local Postgres')
+    parser.add_argument('--workers', type=int, default=200, help='Number of concurrent workers')
+    parser.add_argument('--pool_size', type=int, default=None, help='Number of credentials, see --contention')
+    parser.add_argument(
+        '--contention',
+        type=float,
+        default=2,
+        help='Workers per credential, used to size the pool when --pool_size is not given',
+    )
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run each backend for')
+    parser.add_argument('--hold_time', choices=list(HOLD_TIME_DISTRIBUTIONS), default='exponential')
+    parser.add_argument('--hold_mean', type=float, default=0.01, help='Mean seconds a credential is held')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the hold time generator')
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument('--output', type=Path, default=None, help='Write the results as JSON to this file')
+
+    args = parser.parse_args()
+
+    benchmark_config = BenchmarkConfig(
+        workers=args.workers,
+        pool_size=args.pool_size or max(1, math.ceil(args.workers / args.contention)),
+        duration=args.duration,
+        hold_time=args.hold_time,
+        hold_mean=args.hold_mean,
+        seed=args.seed,
+    )
+
+    asyncio.run(main(args.backends, benchmark_config, args.output))
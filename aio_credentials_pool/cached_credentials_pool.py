@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from collections.abc import Iterable
+from contextlib import suppress
+
+from base_credentials_pool import (
+    BaseCredentialsPool,
+    CredentialMetadata,
+    FailureKind,
+    NoAvailableCredentialsError,
+    normalize_tags,
+)
+from credentials_store import SchedulingStrategy
+from in_memory_credentials_pool import InMemoryCredentialsPool
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CachedCredentialsPool(InMemoryCredentialsPool):
+    """Process-local tier in front of another pool, usually a ``PersistentCredentialsPool``.
+
+    Credentials are reserved from the source pool in batches and then acquired and released in-process.
+    When fewer than ``low_watermark`` credentials are free locally, a background task reserves another batch.
+    When more than ``high_watermark`` are free, the surplus is returned to the source in bulk.
+    The source pool stays the source of truth: reserved credentials are in use there until they are returned.
+    With ``tags``, only credentials with one of them are reserved, tagged acquires should stay within those tags.
+    Failures and successes are reported to the source too, a credential quarantined here stays reserved while it rests.
+    Refreshed cookies are kept locally and only saved to the source along with the credential when it's returned.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        source: BaseCredentialsPool,
+        batch_size: int = 100,
+        low_watermark: int | None = None,
+        high_watermark: int | None = None,
+        strategy: SchedulingStrategy = SchedulingStrategy.FIFO,
+        tags: Iterable[str] | None = None,
+    ):
+        super().__init__([], strategy)
+        self.source = source
+        self.tags = normalize_tags(tags)
+        self.batch_size = batch_size
+        self.low_watermark = batch_size // 4 if low_watermark is None else low_watermark
+        self.high_watermark = batch_size * 2 if high_watermark is None else high_watermark
+        self.reservation: asyncio.Future[bool] | None = None
+        self.refill_task: asyncio.Task[None] | None = None
+        self.closed = False
+        # Refreshed cookie by username, for credentials reserved from the source.
+        self.refreshed_cookies: dict[str, str] = {}
+
+    async def close(self) -> None:
+        self.closed = True
+
+        if self.refill_task is not None:
+            self.refill_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.refill_task
+
+        if self.cooling_timer is not None:
+            self.cooling_timer.cancel()
+        resting = [credential for _, _, credential in self.cooling]
+        self.cooling.clear()
+        await self._return_to_source(resting + self._take_free(len(self.credentials)))
+        await self.source.close()
+
+    async def _acquire(self, tags: tuple[str, ...] | None) -> CredentialMetadata | None:
+        credential = self._pop(tags)
+
+        if credential is None and not self.closed:
+            await self._reserve_now()
+            credential = self._pop(tags)
+
+        if credential is None or len(self.credentials) < self.low_watermark:
+            self._schedule_refill()
+        return credential
+
+    async def _acquire_many(self, n: int, min_n: int, tags: tuple[str, ...] | None) -> list[CredentialMetadata]:
+        if self.credentials.count(tags) < min_n and not self.closed:
+            await self._reserve_now()
+        return await super()._acquire_many(n, min_n, tags)
+
+    async def _release(self, credential: CredentialMetadata) -> None:
+        if self.closed:
+            await self._return_to_source([credential])
+            return
+
+        await super()._release(credential)
+
+        if len(self.credentials) > self.high_watermark:
+            surplus_size = len(self.credentials) - (self.low_watermark + self.high_watermark) // 2
+            await self._return_surplus(self._take_free(surplus_size))
+
+    async def _save_cookies(self, credentials: list[CredentialMetadata]) -> None:
+        await super()._save_cookies(credentials)
+        for credential in credentials:
+            self.refreshed_cookies[credential.username] = credential.cookie
+
+    async def _return_to_source(self, credentials: list[CredentialMetadata]) -> None:
+        cookies = [self.refreshed_cookies.get(credential.username) for credential in credentials]
+        await self.source.release_many(credentials, cookies)
+        for credential in credentials:
+            self.refreshed_cookies.pop(credential.username, None)
+
+    async def _return_surplus(self, credentials: list[CredentialMetadata]) -> None:
+        # The release that triggered the return is done already, a failed return mustn't undo it or lose the surplus.
+        try:
+            await self._return_to_source(credentials)
+        except Exception:
+            LOGGER.exception('Failed to return surplus credentials to the source pool')
+            for credential in credentials:
+                self.credentials.on_released(credential)
+                self._hand_over(credential)
+
+    async def _report_failure(self, credential: CredentialMetadata, kind: FailureKind) -> None:
+        await super()._report_failure(credential, kind)
+        await self.source.report_failure(credential, kind)
+
+    async def _report_success(self, credential: CredentialMetadata) -> None:
+        # The source skips the statement once the failure count is reset, so it goes first.
+        await self.source.report_success(credential)
+        await super()._report_success(credential)
+
+    def _take_free(self, count: int) -> list[CredentialMetadata]:
+        return [self.credentials.pop() for _ in range(count)]
+
+    async def _reserve(self, max_retries: int) -> bool:
+        try:
+            credentials = await self.source.acquire_many(
+                self.batch_size,
+                min_n=1,
+                max_retries=max_retries,
+                tags=self.tags,
+            )
+        except NoAvailableCredentialsError:
+            return False
+
+        if self.closed:
+            await self.source.release_many(credentials)
+            return False
+
+        for credential in credentials:
+            # Waiters get the reserved credentials first, the rest goes to the local store.
+            await super()._release(credential)
+        return True
+
+    async def _reserve_now(self) -> None:
+        # Concurrent misses share one in-flight reservation instead of each reserving a batch.
+        if self.reservation is None or self.reservation.done():
+            self.reservation = asyncio.ensure_future(self._reserve(max_retries=0))
+        await asyncio.shield(self.reservation)
+
+    def _schedule_refill(self) -> None:
+        if not self.closed and (self.refill_task is None or self.refill_task.done()):
+            self.refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self) -> None:
+        try:
+            while not self.closed and (self.waiters or len(self.credentials) < self.low_watermark):
+                if not await self._reserve(max_retries=3) and not self.waiters:
+                    return
+        except Exception:
+            LOGGER.exception('Failed to reserve credentials from the source pool')
@@ -0,0 +1,111 @@
+import csv
+import json
+import re
+from collections.abc import Iterator
+from enum import StrEnum
+from pathlib import Path
+from typing import TextIO
+
+WHITESPACE = re.compile(r'\s*')
+
+
+class CredentialsFormat(StrEnum):
+    JSON = 'json'
+    JSONL = 'jsonl'
+    CSV = 'csv'
+
+
+SUFFIX_FORMATS = {
+    '.json': CredentialsFormat.JSON,
+    '.jsonl': CredentialsFormat.JSONL,
+    '.ndjson': CredentialsFormat.JSONL,
+    '.csv': CredentialsFormat.CSV,
+}
+
+
+def credential_record(raw: dict) -> dict:
+    """The known fields of a parsed credential, with empty optional fields as ``None``."""
+    max_concurrency = raw.get('max_concurrency')
+    return {
+        'username': raw['username'],
+        'password': raw['password'],
+        'cookie': raw.get('cookie') or None,
+        'max_concurrency': int(max_concurrency) if max_concurrency not in (None, '') else None,
+        'tag': raw.get('tag') or None,
+    }
+
+
+def iter_json_array(file: TextIO, chunk_size: int = 1 << 16) -> Iterator[dict]:  # noqa: C901
+    """Yield the items of a top-level JSON array, reading ``chunk_size`` characters at a time."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+
+    def read_more() -> bool:
+        nonlocal buffer, position
+        chunk = file.read(chunk_size)
+        if chunk:
+            buffer, position = buffer[position:] + chunk, 0
+        return bool(chunk)
+
+    def next_token() -> str:
+        nonlocal position
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position < len(buffer):
+                return buffer[position]
+            if not read_more():
+                return ''
+
+    if next_token() != '[':
+        error_message = 'Expected a JSON array of credentials'
+        raise ValueError(error_message)
+    position += 1
+    if next_token() == ']':
+        return
+
+    while True:
+        next_token()
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if read_more():
+                continue
+            raise
+        # An item running up to the end of the buffer may be cut short, a number for instance.
+        if end == len(buffer) and read_more():
+            continue
+
+        yield item
+        position = end
+
+        separator = next_token()
+        if separator == ']':
+            return
+        if separator != ',':
+            error_message = f'Expected "," or "]" after an item of the JSON array, got {separator!r}'
+            raise ValueError(error_message)
+        position += 1
+
+
+def iter_json_lines(file: TextIO) -> Iterator[dict]:
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_credentials(path: Path, credentials_format: CredentialsFormat | None = None) -> Iterator[dict]:
+    """Stream the credentials of a JSON array, JSON lines or CSV file, the format defaults to the file suffix."""
+    if credentials_format is None:
+        credentials_format = SUFFIX_FORMATS[path.suffix.lower()]
+
+    with path.open(newline='') as file:
+        if credentials_format == CredentialsFormat.JSON:
+            items = iter_json_array(file)
+        elif credentials_format == CredentialsFormat.JSONL:
+            items = iter_json_lines(file)
+        else:
+            items = csv.DictReader(file)
+
+        for item in items:
+            yield credential_record(item)
@@ -0,0 +1,400 @@
+import heapq
+import itertools
+import time
+from array import array
+from collections import defaultdict, deque
+from collections.abc import Iterable
+from enum import StrEnum
+
+from base_credentials_pool import CredentialMetadata
+
+
+class SchedulingStrategy(StrEnum):
+    FIFO = 'fifo'
+    LRU = 'lru'
+    LEAST_USED = 'least_used'
+    LEAST_HELD = 'least_held'
+
+
+class BaseCredentialsStore:
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def push(self, credential: CredentialMetadata) -> None:
+        raise NotImplementedError
+
+    def pop(self) -> CredentialMetadata | None:
+        raise NotImplementedError
+
+    def head_key(self) -> float | None:
+        """Ordering key of the credential ``pop`` would hand out, ``None`` for stores without a key."""
+        return None
+
+    def on_acquired(self, credential: CredentialMetadata) -> None:
+        """Account for a use of ``credential``, ``pop`` does it itself, a slot handed straight to a waiter needs it."""
+
+    def on_released(self, credential: CredentialMetadata) -> None:
+        """Account for the end of a use of ``credential``, before it is pushed back or handed to a waiter."""
+
+
+class FifoCredentialsStore(BaseCredentialsStore):
+    """Hands credentials out in the order they were released, O(1) per operation."""
+
+    def __init__(self, credentials: Iterable[CredentialMetadata] = ()):
+        self._credentials = deque(credentials)
+
+    def __len__(self) -> int:
+        return len(self._credentials)
+
+    def push(self, credential: CredentialMetadata) -> None:
+        self._credentials.append(credential)
+
+    def pop(self) -> CredentialMetadata | None:
+        if self._credentials:
+            return self._credentials.popleft()
+        return None
+
+
+class LruCredentialsStore(BaseCredentialsStore):
+    """Hands out the credential acquired the longest time ago, never used ones first, O(log n) per operation.
+
+    Mirrors the ``date_last_usage`` ordering of ``PersistentCredentialsPool``.
+    """
+
+    def __init__(self, credentials: Iterable[CredentialMetadata] = ()):
+        self._counter = itertools.count()
+        self._last_usage: dict[str, float] = {}
+        self._heap = [(0.0, next(self._counter), credential) for credential in credentials]
+        heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, credential: CredentialMetadata) -> None:
+        last_usage = self._last_usage.get(credential.username, 0.0)
+        heapq.heappush(self._heap, (last_usage, next(self._counter), credential))
+
+    def pop(self) -> CredentialMetadata | None:
+        if not self._heap:
+            return None
+        _, _, credential = heapq.heappop(self._heap)
+        self.on_acquired(credential)
+        return credential
+
+    def on_acquired(self, credential: CredentialMetadata) -> None:
+        self._last_usage[credential.username] = time.monotonic()
+
+    def head_key(self) -> float | None:
+        return self._heap[0][0] if self._heap else None
+
+
+class LeastUsedCredentialsStore(BaseCredentialsStore):
+    """Hands out the credential acquired the fewest times so far, O(log n) per operation.
+
+    Mirrors the ``usage_count`` ordering of ``PersistentCredentialsPool``.
+    """
+
+    def __init__(self, credentials: Iterable[CredentialMetadata] = ()):
+        self._counter = itertools.count()
+        self._usage_counts: dict[str, int] = {}
+        self._heap = [(0, next(self._counter), credential) for credential in credentials]
+        heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, credential: CredentialMetadata) -> None:
+        usage_count = self._usage_counts.get(credential.username, 0)
+        heapq.heappush(self._heap, (usage_count, next(self._counter), credential))
+
+    def pop(self) -> CredentialMetadata | None:
+        if not self._heap:
+            return None
+        _, _, credential = heapq.heappop(self._heap)
+        self.on_acquired(credential)
+        return credential
+
+    def on_acquired(self, credential: CredentialMetadata) -> None:
+        self._usage_counts[credential.username] = self._usage_counts.get(credential.username, 0) + 1
+
+    def head_key(self) -> float | None:
+        return self._heap[0][0] if self._heap else None
+
+
+class LeastHeldCredentialsStore(BaseCredentialsStore):
+    """Hands out the credential held for the least time in total, O(log n) per operation.
+
+    The hold time of a slot runs from its acquisition to its release. Mirrors the ``total_hold_ms`` ordering of
+    ``PersistentCredentialsPool``.
+    """
+
+    def __init__(self, credentials: Iterable[CredentialMetadata] = ()):
+        self._counter = itertools.count()
+        self._hold_seconds: dict[str, float] = {}
+        # Pop times of the slots of every leased credential, oldest first.
+        self._popped_at: dict[str, list[float]] = {}
+        self._heap = [(0.0, next(self._counter), credential) for credential in credentials]
+        heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, credential: CredentialMetadata) -> None:
+        hold_seconds = self._hold_seconds.get(credential.username, 0.0)
+        heapq.heappush(self._heap, (hold_seconds, next(self._counter), credential))
+
+    def pop(self) -> CredentialMetadata | None:
+        if not self._heap:
+            return None
+        _, _, credential = heapq.heappop(self._heap)
+        self.on_acquired(credential)
+        return credential
+
+    def on_acquired(self, credential: CredentialMetadata) -> None:
+        self._popped_at.setdefault(credential.username, []).append(time.monotonic())
+
+    def on_released(self, credential: CredentialMetadata) -> None:
+        popped_at = self._popped_at.get(credential.username)
+        if popped_at:
+            hold_seconds = self._hold_seconds.get(credential.username, 0.0) + time.monotonic() - popped_at.pop(0)
+            self._hold_seconds[credential.username] = hold_seconds
+            if not popped_at:
+                del self._popped_at[credential.username]
+
+    def head_key(self) -> float | None:
+        return self._heap[0][0] if self._heap else None
+
+
+CREDENTIALS_STORES: dict[SchedulingStrategy, type[BaseCredentialsStore]] = {
+    SchedulingStrategy.FIFO: FifoCredentialsStore,
+    SchedulingStrategy.LRU: LruCredentialsStore,
+    SchedulingStrategy.LEAST_USED: LeastUsedCredentialsStore,
+    SchedulingStrategy.LEAST_HELD: LeastHeldCredentialsStore,
+}
+
+
+class TaggedCredentialsStore(BaseCredentialsStore):
+    """Keeps a separate store per tag, so a tagged pop never looks at credentials of other tags.
+
+    An untagged pop takes from the store whose next credential has the smallest ordering key, so ordered strategies
+    stay global across tags. Stores without a key, and ties, are taken from in turn.
+    """
+
+    def __init__(self, store_class: type[BaseCredentialsStore], credentials: Iterable[CredentialMetadata] = ()):
+        self._store_class = store_class
+        credentials_by_tag: dict[str | None, list[CredentialMetadata]] = defaultdict(list)
+        for credential in credentials:
+            credentials_by_tag[credential.tag].append(credential)
+        self._stores = {tag: store_class(tagged) for tag, tagged in credentials_by_tag.items()}
+        self._len = sum(len(store) for store in self._stores.values())
+
+    def __len__(self) -> int:
+        return self._len
+
+    def count(self, tags: tuple[str, ...] | None = None) -> int:
+        if tags is None:
+            return self._len
+        return sum(len(self._stores[tag]) for tag in tags if tag in self._stores)
+
+    def push(self, credential: CredentialMetadata) -> None:
+        self._push_to(credential.tag, credential)
+
+    def update_cookie(self, credential: CredentialMetadata) -> None:
+        """Keep the cookie a leased credential was refreshed to, stored objects already carry it."""
+
+    def on_acquired(self, credential: CredentialMetadata) -> None:
+        self._store_of(credential.tag).on_acquired(credential)
+
+    def on_released(self, credential: CredentialMetadata) -> None:
+        self._store_of(credential.tag).on_released(credential)
+
+    def pop(self, tags: tuple[str, ...] | None = None) -> CredentialMetadata | None:
+        store = self._store_to_pop(tags)
+        if store is None:
+            return None
+        self._len -= 1
+        return store.pop()
+
+    def _push_to(self, tag: str | None, item) -> None:
+        self._store_of(tag).push(item)
+        self._len += 1
+
+    def _store_of(self, tag: str | None) -> BaseCredentialsStore:
+        store = self._stores.get(tag)
+        if store is None:
+            store = self._stores[tag] = self._store_class()
+        return store
+
+    def _store_to_pop(self, tags: tuple[str, ...] | None) -> BaseCredentialsStore | None:
+        if tags is None:
+            chosen: tuple[str | None, float | None] | None = None
+            for tag, store in self._stores.items():
+                if not len(store):
+                    continue
+                key = store.head_key()
+                if key is None:
+                    chosen = (tag, key)
+                    break
+                if chosen is None or key < chosen[1]:
+                    chosen = (tag, key)
+            if chosen is None:
+                return None
+            # Move the tag to the back, so unordered stores and ties are taken from in turn.
+            store = self._stores[chosen[0]] = self._stores.pop(chosen[0])
+            return store
+
+        for tag in tags:
+            store = self._stores.get(tag)
+            if store is not None and len(store):
+                return store
+        return None
+
+
+class StringColumn:
+    """Strings packed as UTF-8 into one buffer, 8 bytes of offset per string plus its encoded length."""
+
+    def __init__(self, *, nullable: bool = False):
+        self._data = bytearray()
+        self._offsets = array('Q', [0])
+        self._nulls = bytearray() if nullable else None
+
+    def append(self, value: str | None) -> None:
+        if self._nulls is not None:
+            self._nulls.append(value is None)
+        if value:
+            self._data += value.encode()
+        self._offsets.append(len(self._data))
+
+    def __getitem__(self, row: int) -> str | None:
+        if self._nulls is not None and self._nulls[row]:
+            return None
+        return self._data[self._offsets[row] : self._offsets[row + 1]].decode()
+
+
+class RowRing:
+    """FIFO queue of row numbers in a circular ``array``, 4 bytes per entry, grown by doubling."""
+
+    def __init__(self, rows: Iterable[int] = ()):
+        self._rows = array('I', [0]) * 16
+        self._head = 0
+        self._len = 0
+        for row in rows:
+            self.push(row)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def push(self, row: int) -> None:
+        if self._len == len(self._rows):
+            self._rows = self._rows[self._head :] + self._rows[: self._head] + array('I', [0]) * len(self._rows)
+            self._head = 0
+        self._rows[(self._head + self._len) % len(self._rows)] = row
+        self._len += 1
+
+    def pop(self) -> int | None:
+        if not self._len:
+            return None
+        row = self._rows[self._head]
+        self._head = (self._head + 1) % len(self._rows)
+        self._len -= 1
+        return row
+
+    def head_key(self) -> float | None:
+        """FIFO has no ordering key, see ``BaseCredentialsStore.head_key``."""
+        return None
+
+
+class CompactCredentialsStore(TaggedCredentialsStore):
+    """``TaggedCredentialsStore`` with FIFO order for millions of credentials, kept column-wise in arrays.
+
+    Every credential is a row: its strings live in ``StringColumn`` buffers and its numbers in ``array`` columns,
+    and the free slots of every tag are row numbers in a ``RowRing``. A ``CredentialMetadata`` is only built when a
+    slot is popped, and a pushed credential is mapped back to its row by username, so usernames must be unique.
+    Only the rows of leased credentials are kept in a dict.
+    """
+
+    def __init__(self, credentials: Iterable[CredentialMetadata] = ()):
+        super().__init__(RowRing)
+        self._usernames = StringColumn()
+        self._passwords = StringColumn()
+        self._cookies = StringColumn(nullable=True)
+        self._ids = array('q')
+        self._max_concurrency = array('I')
+        self._tag_numbers = array('I')
+        self._tags: list[str | None] = []
+        self._tag_numbers_by_tag: dict[str | None, int] = {}
+        # Username of a leased credential to its row and the number of its leased slots.
+        self._leased: dict[str, list[int]] = {}
+        # Strings can't be replaced in place, refreshed cookies are kept aside by row.
+        self._refreshed_cookies: dict[int, str] = {}
+
+        extra_slots = []
+        for credential in credentials:
+            row = self._append(credential)
+            self._push_to(credential.tag, row)
+            if credential.max_concurrency > 1:
+                extra_slots.append(row)
+
+        # The first slot of every credential comes before the second slot of any.
+        for slot in range(1, max((self._max_concurrency[row] for row in extra_slots), default=1)):
+            for row in extra_slots:
+                if self._max_concurrency[row] > slot:
+                    self._push_to(self._tags[self._tag_numbers[row]], row)
+
+    def push(self, credential: CredentialMetadata) -> None:
+        leased = self._leased.get(credential.username)
+        if leased is None:
+            # Not handed out by this store, keep it like any other store would.
+            row = self._append(credential)
+        else:
+            row = leased[0]
+            leased[1] -= 1
+            if not leased[1]:
+                del self._leased[credential.username]
+        self._push_to(self._tags[self._tag_numbers[row]], row)
+
+    def update_cookie(self, credential: CredentialMetadata) -> None:
+        leased = self._leased.get(credential.username)
+        if leased is not None:
+            self._refreshed_cookies[leased[0]] = credential.cookie
+
+    def on_acquired(self, credential: CredentialMetadata) -> None:
+        """FIFO order keeps no usage state."""
+
+    def on_released(self, credential: CredentialMetadata) -> None:
+        """FIFO order keeps no usage state."""
+
+    def pop(self, tags: tuple[str, ...] | None = None) -> CredentialMetadata | None:
+        row = super().pop(tags)
+        if row is None:
+            return None
+
+        cookie = self._refreshed_cookies.get(row) if self._refreshed_cookies else None
+        credential = CredentialMetadata(
+            username=self._usernames[row],
+            password=self._passwords[row],
+            cookie=self._cookies[row] if cookie is None else cookie,
+            id=None if self._ids[row] < 0 else self._ids[row],
+            max_concurrency=self._max_concurrency[row],
+            tag=self._tags[self._tag_numbers[row]],
+        )
+        leased = self._leased.get(credential.username)
+        if leased is None:
+            self._leased[credential.username] = [row, 1]
+        else:
+            leased[1] += 1
+        return credential
+
+    def _append(self, credential: CredentialMetadata) -> int:
+        tag_number = self._tag_numbers_by_tag.get(credential.tag)
+        if tag_number is None:
+            tag_number = self._tag_numbers_by_tag[credential.tag] = len(self._tags)
+            self._tags.append(credential.tag)
+
+        self._usernames.append(credential.username)
+        self._passwords.append(credential.password)
+        self._cookies.append(credential.cookie)
+        self._ids.append(-1 if credential.id is None else credential.id)
+        self._max_concurrency.append(credential.max_concurrency)
+        self._tag_numbers.append(tag_number)
+        return len(self._ids) - 1
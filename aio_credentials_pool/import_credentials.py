@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import logging
+from collections.abc import Iterable
+from pathlib import Path
+
+import asyncpg
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Identity,
+    Integer,
+    MetaData,
+    Table,
+    Text,
+    case,
+    exists,
+    false,
+    func,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.schema import CreateTable
+
+from asyncpg_credentials_pool import DIALECT, CompiledStatement
+from credentials_files import CredentialsFormat, iter_credentials
+from persistent_credentials_pool import RELEASE_CHANNEL, credentials_table, postgres_dsn
+
+LOGGER = logging.getLogger(__name__)
+
+IMPORTED_COLUMNS = ('username', 'password', 'cookie', 'max_concurrency', 'tag')
+
+staging_table = Table(
+    'credentials_import',
+    MetaData(),
+    Column('ordinal', BigInteger, Identity()),
+    Column('username', Text),
+    Column('password', Text),
+    Column('cookie', Text),
+    Column('max_concurrency', Integer),
+    Column('tag', Text),
+    prefixes=['TEMPORARY'],
+    postgresql_on_commit='DROP',
+)
+
+CREATE_STAGING_TABLE = str(CreateTable(staging_table).compile(dialect=DIALECT))
+
+# The last occurrence of a username in the file wins.
+DEDUPLICATE_STATEMENT = (
+    'DELETE FROM credentials_import AS earlier USING credentials_import AS later '
+    'WHERE earlier.username = later.username AND earlier.ordinal < later.ordinal'
+)
+
+# Usage and health state such as in_use, active_leases, usage_count and failure_count is left alone,
+# optional fields are only overwritten when the file has a value for them.
+UPDATE_EXISTING_STATEMENT = CompiledStatement.compile(
+    update(credentials_table)
+    .where(credentials_table.c.username == staging_table.c.username)
+    .values(
+        password=staging_table.c.password,
+        cookie=func.coalesce(staging_table.c.cookie, credentials_table.c.cookie),
+        # An imported cookie is newer than any cookie still buffered by a pool.
+        cookie_updated_at=case(
+            (staging_table.c.cookie.is_not(None), func.timezone('UTC', func.now())),
+            else_=credentials_table.c.cookie_updated_at,
+        ),
+        max_concurrency=func.coalesce(staging_table.c.max_concurrency, credentials_table.c.max_concurrency),
+        tag=func.coalesce(staging_table.c.tag, credentials_table.c.tag),
+    ),
+)
+
+INSERT_NEW_STATEMENT = CompiledStatement.compile(
+    insert(credentials_table).from_select(
+        [*IMPORTED_COLUMNS, 'in_use', 'active_leases', 'failure_count', 'usage_count', 'total_hold_ms', 'created_at'],
+        select(
+            staging_table.c.username,
+            staging_table.c.password,
+            staging_table.c.cookie,
+            func.coalesce(staging_table.c.max_concurrency, 1),
+            staging_table.c.tag,
+            false(),
+            0,
+            0,
+            0,
+            0,
+            func.timezone('UTC', func.now()),
+        ).where(~exists().where(credentials_table.c.username == staging_table.c.username)),
+    ),
+)
+
+
+async def execute(connection: asyncpg.Connection, statement: CompiledStatement) -> int:
+    """Run a statement without parameters of its own, returns the number of affected rows."""
+    status = await connection.execute(statement.sql, *statement.arguments({}))
+    return int(status.rsplit(' ', 1)[-1])
+
+
+async def import_credentials(credentials: Iterable[dict], dsn: str | None = None) -> tuple[int, int]:
+    """Upsert a stream of credentials, returns the number of inserted and updated credentials.
+
+    The credentials are streamed into a temporary staging table with ``COPY``, then merged into ``credentials``
+    with one ``UPDATE`` and one ``INSERT``, all in a single transaction. Memory use doesn't depend on the input size.
+    """
+    connection = await asyncpg.connect(dsn or postgres_dsn())
+    try:
+        async with connection.transaction():
+            await connection.execute(CREATE_STAGING_TABLE)
+            await connection.copy_records_to_table(
+                'credentials_import',
+                records=(tuple(credential[column] for column in IMPORTED_COLUMNS) for credential in credentials),
+                columns=IMPORTED_COLUMNS,
+            )
+            await connection.execute('ANALYZE credentials_import')
+            await connection.execute(DEDUPLICATE_STATEMENT)
+
+            updated = await execute(connection, UPDATE_EXISTING_STATEMENT)
+            inserted = await execute(connection, INSERT_NEW_STATEMENT)
+
+            if inserted:
+                # Wake up workers waiting for a free credential.
+                await connection.execute('SELECT pg_notify($1, $2)', RELEASE_CHANNEL, str(inserted))
+    finally:
+        await connection.close()
+
+    return inserted, updated
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Import credentials into the database, updating existing ones')
+    parser.add_argument('path', type=Path, help='JSON array, JSON lines or CSV file with credentials')
+    parser.add_argument(
+        '--format',
+        choices=list(CredentialsFormat),
+        default=None,
+        help='Format of the file, guessed from its suffix by default',
+    )
+
+    args = parser.parse_args()
+
+    inserted_count, updated_count = asyncio.run(
+        import_credentials(iter_credentials(args.path, args.format and CredentialsFormat(args.format))),
+    )
+    LOGGER.info(f'Imported {inserted_count} new and updated {updated_count} existing credentials')
@@ -1,19 +1,293 @@
 import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator, Sequence
+from contextlib import suppress
+from dataclasses import replace
+from pathlib import Path
 
-from base_credentials_pool import BaseCredentialsPool, CredentialMetadata
+from base_credentials_pool import (
+    BaseCredentialsPool,
+    CredentialMetadata,
+    FailureKind,
+    NoAvailableCredentialsError,
+    normalize_tags,
+    quarantine_seconds,
+)
+from credentials_files import CredentialsFormat, iter_credentials
+from credentials_store import CREDENTIALS_STORES, CompactCredentialsStore, SchedulingStrategy, TaggedCredentialsStore
+from tracing import TRACER, TraceOp
+
+
+def slot_order(max_concurrencies: Sequence[int]) -> list[tuple[int, int]]:
+    """(index, slot) of every lease slot: the first slot of every credential comes before the second slot of any."""
+    max_concurrency = max(max_concurrencies, default=1)
+    return [
+        (index, slot)
+        for slot in range(max_concurrency)
+        for index, concurrency in enumerate(max_concurrencies)
+        if concurrency > slot
+    ]
+
+
+def lease_slots(credentials: Iterable[CredentialMetadata]) -> list[CredentialMetadata]:
+    """One entry per lease slot in ``slot_order``.
+
+    Every slot after the first is a copy, so concurrent holders of a credential don't share one mutable object.
+    """
+    credentials = list(credentials)
+    if all(credential.max_concurrency == 1 for credential in credentials):
+        return credentials
+    order = slot_order([credential.max_concurrency for credential in credentials])
+    return [credentials[index] if slot == 0 else replace(credentials[index]) for index, slot in order]
+
+
+def read_credentials(path: Path, credentials_format: CredentialsFormat | None = None) -> Iterator[CredentialMetadata]:
+    for record in iter_credentials(path, credentials_format):
+        yield CredentialMetadata(
+            username=record['username'],
+            password=record['password'],
+            cookie=record['cookie'],
+            max_concurrency=record['max_concurrency'] or 1,
+            tag=record['tag'],
+        )
 
 
 class InMemoryCredentialsPool(BaseCredentialsPool):
-    def __init__(self, credentials: list[CredentialMetadata]):
-        self.credentials = credentials
-        self.lock = asyncio.Lock()
+    """Credentials pool kept in process memory.
+
+    The store holds one entry per free lease slot, so a credential with ``max_concurrency`` slots is handed out
+    up to that many times at once. Released slots go to the back of the store, which spreads the load over all
+    credentials before any of them takes another lease. Every tag has a store of its own.
+
+    With ``cooldown`` set, a released credential rests for that many seconds before it is handed out again.
+    Resting credentials are kept in a heap ordered by the end of their cooldown, and a single timer
+    hands each of them to the oldest waiter or back to the store as soon as it is available.
+
+    Credentials quarantined by ``report_failure`` rest in the same heap until their quarantine is over. A slot
+    released while quarantined goes there directly, a free slot is moved there when acquire comes across it.
+
+    With ``compact`` set, credentials are kept column-wise in a ``CompactCredentialsStore`` instead of as objects,
+    which takes a fraction of the memory for millions of credentials and only supports the FIFO strategy.
+    """
+
+    def __init__(
+        self,
+        credentials: Iterable[CredentialMetadata],
+        strategy: SchedulingStrategy = SchedulingStrategy.FIFO,
+        cooldown: float | None = None,
+        *,
+        compact: bool = False,
+    ):
+        if not compact:
+            self.credentials = TaggedCredentialsStore(CREDENTIALS_STORES[strategy], lease_slots(credentials))
+        elif strategy == SchedulingStrategy.FIFO:
+            self.credentials = CompactCredentialsStore(credentials)
+        else:
+            error_message = f'The compact store only supports the {SchedulingStrategy.FIFO} strategy, not {strategy}'
+            raise ValueError(error_message)
+        self.waiters: deque[tuple[tuple[str, ...] | None, asyncio.Future[CredentialMetadata]]] = deque()
+        self.cooldown = cooldown
+        self.cooling: list[tuple[float, int, CredentialMetadata]] = []
+        self.cooling_counter = itertools.count()
+        self.cooling_timer: asyncio.TimerHandle | None = None
+        # Keyed by username, so every slot of a credential shares them.
+        self.failure_counts: dict[str, int] = {}
+        self.quarantined_until: dict[str, float] = {}
+        # Only for credentials with several slots, the object of a single slot carries its own cookie.
+        self.refreshed_cookies: dict[str, str] = {}
+
+    @classmethod
+    def from_file(
+        cls,
+        path: Path,
+        credentials_format: CredentialsFormat | None = None,
+        **kwargs,
+    ) -> 'InMemoryCredentialsPool':
+        """Pool of the credentials of a JSON array, JSON lines or CSV file, parsed one credential at a time."""
+        return cls(read_credentials(path, credentials_format), **kwargs)
+
+    async def acquire(  # noqa: PLR0913
+        self,
+        max_retries=3,
+        min_wait=1,
+        max_wait=32,
+        tags: Iterable[str] | None = None,
+        timeout: float | None = None,
+    ) -> CredentialMetadata:
+        """Acquire a credential, waiting in FIFO order for a release if the pool is empty.
+
+        Without an explicit ``timeout`` the caller waits as long as the retry schedule of
+        ``BaseCredentialsPool.acquire`` would, but is woken up as soon as a credential is released.
+        With ``tags``, only a credential with one of the tags is taken and only such a release wakes the caller.
+        """
+        tags = normalize_tags(tags)
+        started_at = time.perf_counter()
+        credential = await self._acquire(tags)
+
+        if credential is None:
+            self.metrics.misses.inc()
+            if TRACER.enabled:
+                TRACER.record(TraceOp.MISS, None, started_at, time.perf_counter())
+            if timeout is None:
+                timeout = sum(min(min_wait * 2**attempt, max_wait) for attempt in range(max_retries))
+            try:
+                credential = await self._wait_for_release(timeout, tags)
+            except NoAvailableCredentialsError:
+                self.metrics.failures.inc()
+                if TRACER.enabled:
+                    TRACER.record(TraceOp.FAILURE, None, started_at, time.perf_counter())
+                raise
+
+        now = time.perf_counter()
+        self.metrics.on_acquired([credential], started_at, now)
+        if TRACER.enabled:
+            TRACER.record(TraceOp.ACQUIRE, credential.id, started_at, now)
+        return credential
+
+    async def _acquire(self, tags: tuple[str, ...] | None) -> CredentialMetadata | None:
+        return self._pop(tags)
 
-    async def _acquire(self) -> CredentialMetadata | None:
-        async with self.lock:
-            if self.credentials:
-                return self.credentials.pop(0)
-        return None
+    async def _acquire_many(self, n: int, min_n: int, tags: tuple[str, ...] | None) -> list[CredentialMetadata]:
+        for batch_tags in [None] if tags is None else [(tag,) for tag in tags]:
+            free_count = self.credentials.count(batch_tags)
+            if free_count >= min_n:
+                credentials = []
+                while len(credentials) < n and (credential := self._pop(batch_tags)) is not None:
+                    credentials.append(credential)
+                if len(credentials) >= min_n:
+                    return credentials
+                # Quarantined slots were skipped, give the short batch back.
+                for credential in credentials:
+                    self.credentials.on_released(credential)
+                    self.credentials.push(credential)
+        return []
 
     async def _release(self, credential: CredentialMetadata) -> None:
-        async with self.lock:
-            self.credentials.append(credential)
+        self.credentials.on_released(credential)
+        rest_seconds = max(self.cooldown or 0, self._quarantine_left(credential.username))
+        if rest_seconds > 0:
+            self._cool_down(credential, rest_seconds)
+        else:
+            self._hand_over(credential)
+
+    async def _save_cookies(self, credentials: list[CredentialMetadata]) -> None:
+        for credential in credentials:
+            self.credentials.update_cookie(credential)
+            if credential.max_concurrency > 1:
+                self.refreshed_cookies[credential.username] = credential.cookie
+
+    async def _report_failure(self, credential: CredentialMetadata, kind: FailureKind) -> None:
+        failure_count = self.failure_counts.get(credential.username, 0) + 1
+        self.failure_counts[credential.username] = failure_count
+        quarantined_until = asyncio.get_running_loop().time() + quarantine_seconds(kind, failure_count)
+        self.quarantined_until[credential.username] = max(
+            quarantined_until,
+            self.quarantined_until.get(credential.username, 0),
+        )
+        credential.failure_count = failure_count
+
+    async def _report_success(self, credential: CredentialMetadata) -> None:
+        self.failure_counts.pop(credential.username, None)
+        self.quarantined_until.pop(credential.username, None)
+        credential.failure_count = 0
+
+    def _pop(self, tags: tuple[str, ...] | None) -> CredentialMetadata | None:
+        """Pop a free slot, moving the quarantined ones met on the way to the cooling heap."""
+        while (credential := self.credentials.pop(tags)) is not None and self.quarantined_until:
+            quarantine_left = self._quarantine_left(credential.username)
+            if quarantine_left <= 0:
+                break
+            self.credentials.on_released(credential)
+            self._cool_down(credential, quarantine_left)
+        if credential is not None:
+            self._share_state(credential)
+        return credential
+
+    def _share_state(self, credential: CredentialMetadata) -> None:
+        """Bring a slot up to date with what holders of the other slots of its credential reported."""
+        # The compact store doesn't keep the count, a credential it pops is built afresh.
+        if self.failure_counts:
+            credential.failure_count = self.failure_counts.get(credential.username, 0)
+        if self.refreshed_cookies:
+            credential.cookie = self.refreshed_cookies.get(credential.username, credential.cookie)
+
+    def _quarantine_left(self, username: str) -> float:
+        quarantined_until = self.quarantined_until.get(username)
+        if quarantined_until is None:
+            return 0
+        quarantine_left = quarantined_until - asyncio.get_running_loop().time()
+        if quarantine_left <= 0:
+            del self.quarantined_until[username]
+        return quarantine_left
+
+    def _hand_over(self, credential: CredentialMetadata) -> None:
+        while self.waiters and self.waiters[0][1].done():
+            self.waiters.popleft()
+
+        for index, (tags, waiter) in enumerate(self.waiters):
+            if not waiter.done() and (tags is None or credential.tag in tags):
+                del self.waiters[index]
+                # The slot skips the store, its use is counted all the same.
+                self.credentials.on_acquired(credential)
+                self._share_state(credential)
+                waiter.set_result(credential)
+                return
+        self.credentials.push(credential)
+
+    def _cool_down(self, credential: CredentialMetadata, seconds: float) -> None:
+        loop = asyncio.get_running_loop()
+        available_at = loop.time() + seconds
+        heapq.heappush(self.cooling, (available_at, next(self.cooling_counter), credential))
+
+        if self.cooling[0][2] is credential:
+            if self.cooling_timer is not None:
+                self.cooling_timer.cancel()
+            self.cooling_timer = loop.call_at(available_at, self._end_cooldowns)
+
+    def _end_cooldowns(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.cooling and self.cooling[0][0] <= loop.time():
+            _, _, credential = heapq.heappop(self.cooling)
+            # The quarantine may have been extended after the credential started resting.
+            if self.quarantined_until and (quarantine_left := self._quarantine_left(credential.username)) > 0:
+                heapq.heappush(self.cooling, (loop.time() + quarantine_left, next(self.cooling_counter), credential))
+            else:
+                self._hand_over(credential)
+
+        self.cooling_timer = loop.call_at(self.cooling[0][0], self._end_cooldowns) if self.cooling else None
+
+    async def _release_many(self, credentials: list[CredentialMetadata]) -> None:
+        for credential in credentials:
+            await self._release(credential)
+
+    async def _wait_for_release(self, timeout: float, tags: tuple[str, ...] | None = None) -> CredentialMetadata:
+        if timeout <= 0:
+            raise NoAvailableCredentialsError('No available credentials')
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append((tags, waiter))
+
+        try:
+            async with asyncio.timeout(timeout):
+                return await waiter
+        except (TimeoutError, asyncio.CancelledError) as error:
+            if waiter.done() and not waiter.cancelled():
+                # The credential was handed over right before the timeout or cancellation hit us,
+                # pass it on instead of leaking it.
+                self.credentials.on_released(waiter.result())
+                self._hand_over(waiter.result())
+            else:
+                waiter.cancel()
+                with suppress(ValueError):
+                    self.waiters.remove((tags, waiter))
+
+            if isinstance(error, TimeoutError):
+                error_message = f'No available credentials after waiting {timeout} seconds'
+                raise NoAvailableCredentialsError(error_message) from None
+            raise
+
+    def _free_count(self) -> int:
+        return len(self.credentials)
@@ -0,0 +1,241 @@
+import asyncio
+import bisect
+import weakref
+from collections.abc import Callable, Collection, Iterator
+
+# Upper bounds in seconds, the last bucket is +Inf.
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+HOLD_TIME_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+Sample = tuple[str, dict[str, str], float]
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def snapshot(self) -> float:
+        return self.value
+
+    def samples(self) -> Iterator[Sample]:
+        yield self.name, {}, self.value
+
+
+class Gauge:
+    """Either set explicitly or, with ``function``, read when collected."""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float] | None = None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: int = 1) -> None:
+        self.value -= amount
+
+    def snapshot(self) -> float:
+        return self.value if self.function is None else self.function()
+
+    def samples(self) -> Iterator[Sample]:
+        yield self.name, {}, self.snapshot()
+
+
+class Histogram:
+    """Counts observations into fixed buckets, one ``bisect`` per observation."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the ``q`` quantile, ``None`` without observations."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts, strict=False):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+    def samples(self) -> Iterator[Sample]:
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), self.counts, strict=True):
+            cumulative += count
+            yield f'{self.name}_bucket', {'le': format_value(bound)}, cumulative
+        yield f'{self.name}_sum', {}, self.sum
+        yield f'{self.name}_count', {}, self.count
+
+
+Metric = Counter | Gauge | Histogram
+
+
+class PoolMetrics:
+    """Metrics of a single pool, all labelled with ``pool``. Updating them is a few attribute operations."""
+
+    def __init__(self, pool: str, free: Callable[[], int | None], registry: 'MetricsRegistry | None' = None):
+        self.labels = {'pool': pool}
+        self.acquire_seconds = Histogram(
+            'credentials_pool_acquire_seconds',
+            'Time to acquire credentials, waiting included',
+        )
+        self.hold_seconds = Histogram(
+            'credentials_pool_hold_seconds',
+            'Time between acquiring and releasing a credential',
+            HOLD_TIME_BUCKETS,
+        )
+        self.statement_seconds = Histogram(
+            'credentials_pool_statement_seconds',
+            'Duration of the database statements run by the pool',
+        )
+        self.acquisitions = Counter('credentials_pool_acquisitions_total', 'Credentials acquired')
+        self.releases = Counter('credentials_pool_releases_total', 'Credentials released')
+        self.misses = Counter('credentials_pool_misses_total', 'Acquire attempts that found no free credential')
+        self.retries = Counter('credentials_pool_retries_total', 'Acquire attempts repeated after a backoff')
+        self.failures = Counter('credentials_pool_failures_total', 'Acquires that gave up without a credential')
+        self.reported_failures = Counter(
+            'credentials_pool_reported_failures_total',
+            'Failed uses of credentials reported with report_failure',
+        )
+        self.in_use = Gauge('credentials_pool_in_use', 'Credentials acquired through this pool and not released yet')
+        self.free = Gauge('credentials_pool_free', 'Credentials free in this process', free)
+        self.acquired_at: dict[tuple[int | None, str], list[float]] = {}
+
+        (registry or REGISTRY).register(self)
+
+    def metrics(self) -> Iterator[Metric]:
+        yield from (
+            self.acquire_seconds,
+            self.hold_seconds,
+            self.statement_seconds,
+            self.acquisitions,
+            self.releases,
+            self.misses,
+            self.retries,
+            self.failures,
+            self.reported_failures,
+            self.in_use,
+        )
+        if self.free.snapshot() is not None:
+            yield self.free
+
+    def on_acquired(self, credentials: Collection, started_at: float, now: float) -> None:
+        self.acquire_seconds.observe(now - started_at)
+        self.acquisitions.value += len(credentials)
+        self.in_use.value += len(credentials)
+        for credential in credentials:
+            key = (credential.id, credential.username)
+            acquired_at = self.acquired_at.get(key)
+            if acquired_at is None:
+                self.acquired_at[key] = [now]
+            else:
+                # Several slots of the same credential are held at once.
+                acquired_at.append(now)
+
+    def on_released(self, credentials: Collection, now: float) -> None:
+        self.releases.value += len(credentials)
+        self.in_use.value -= len(credentials)
+        for credential in credentials:
+            key = (credential.id, credential.username)
+            acquired_at = self.acquired_at.get(key)
+            if acquired_at is not None:
+                self.hold_seconds.observe(now - acquired_at.pop())
+                if not acquired_at:
+                    del self.acquired_at[key]
+
+    def snapshot(self) -> dict:
+        prefix = 'credentials_pool_'
+        return {metric.name.removeprefix(prefix): metric.snapshot() for metric in self.metrics()}
+
+
+class MetricsRegistry:
+    """Collects the metrics of every live pool, pools are only referenced weakly."""
+
+    def __init__(self):
+        self.collectors: weakref.WeakSet[PoolMetrics] = weakref.WeakSet()
+
+    def register(self, collector: PoolMetrics) -> None:
+        self.collectors.add(collector)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        families: dict[str, tuple[Metric, list[Sample]]] = {}
+        for collector in list(self.collectors):
+            for metric in collector.metrics():
+                _, samples = families.setdefault(metric.name, (metric, []))
+                samples.extend((name, collector.labels | labels, value) for name, labels, value in metric.samples())
+
+        lines = []
+        for metric, samples in families.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in samples:
+                rendered_labels = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f'{name}{{{rendered_labels}}} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = MetricsRegistry()
+
+
+async def start_metrics_server(
+    host: str = '127.0.0.1',
+    port: int = 9100,
+    registry: MetricsRegistry = REGISTRY,
+) -> asyncio.Server:
+    """Serve ``registry`` in the Prometheus text format over plain HTTP on every path."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while (await reader.readline()).strip():
+                pass
+            body = registry.render().encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                b'Connection: close\r\n\r\n' + body,
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, DateTime, Integer, Text
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, ForeignKey, Index, Integer, Text
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -13,7 +13,80 @@ class Credential(Base):
     username = Column(Text, unique=True, nullable=False, index=True)
     password = Column(Text, nullable=False)
     cookie = Column(Text, nullable=True)
+    # When the cookie was refreshed, only written together with it, so a late write never replaces a newer cookie.
+    cookie_updated_at = Column(DateTime, nullable=True)
+    # Set once all ``max_concurrency`` slots of the credential are taken, so the partial indexes cover free slots.
     in_use = Column(Boolean, default=False, nullable=False)
+    max_concurrency = Column(Integer, default=1, server_default='1', nullable=False)
+    active_leases = Column(Integer, default=0, server_default='0', nullable=False)
+    # Partition key, e.g. the target site or region a credential can be used for.
+    tag = Column(Text, nullable=True)
     date_last_usage = Column(DateTime, nullable=True, index=True)
+    # Acquisitions and total time held, counted by the acquire and release statements themselves.
+    usage_count = Column(Integer, default=0, server_default='0', nullable=False)
+    total_hold_ms = Column(BigInteger, default=0, server_default='0', nullable=False)
+    available_at = Column(DateTime, nullable=True)
+    # Failures reported since the last success, each one doubles the quarantine of the next.
+    failure_count = Column(Integer, default=0, server_default='0', nullable=False)
+    last_failure_kind = Column(Text, nullable=True)
+    # Also folded into ``available_at``, which is what acquire filters on.
+    quarantined_until = Column(DateTime, nullable=True)
 
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index(
+            'ix_credentials_free_active_leases_date_last_usage',
+            active_leases,
+            date_last_usage.asc().nullsfirst(),
+            postgresql_where=in_use == False,
+        ),
+        Index(
+            'ix_credentials_free_tag_active_leases_date_last_usage',
+            tag,
+            active_leases,
+            date_last_usage.asc().nullsfirst(),
+            postgresql_where=in_use == False,
+        ),
+        Index(
+            'ix_credentials_free_active_leases_usage_count',
+            active_leases,
+            usage_count,
+            postgresql_where=in_use == False,
+        ),
+        Index(
+            'ix_credentials_free_tag_active_leases_usage_count',
+            tag,
+            active_leases,
+            usage_count,
+            postgresql_where=in_use == False,
+        ),
+        Index(
+            'ix_credentials_free_active_leases_total_hold_ms',
+            active_leases,
+            total_hold_ms,
+            postgresql_where=in_use == False,
+        ),
+        Index(
+            'ix_credentials_free_tag_active_leases_total_hold_ms',
+            tag,
+            active_leases,
+            total_hold_ms,
+            postgresql_where=in_use == False,
+        ),
+        Index(
+            'ix_credentials_free_available_at',
+            available_at,
+            postgresql_where=in_use == False,
+        ),
+    )
+
+
+class Lease(Base):
+    """A slot of a credential taken by a pool with a ``lease_ttl``, it runs out on its own unless extended."""
+
+    __tablename__ = 'credential_leases'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    credential_id = Column(Integer, ForeignKey('credentials.id', ondelete='CASCADE'), nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
@@ -1,20 +1,382 @@
-from collections.abc import AsyncGenerator
-from contextlib import asynccontextmanager
-from datetime import datetime
+import asyncio
+import json
+import logging
+import time
+from collections import Counter, deque
+from collections.abc import AsyncGenerator, Awaitable, Callable, Sequence
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 
-from sqlalchemy import func, nullsfirst, select
+import asyncpg
+from sqlalchemy import (
+    ARRAY,
+    BigInteger,
+    ColumnElement,
+    DateTime,
+    Executable,
+    Integer,
+    RowMapping,
+    Select,
+    Text,
+    any_,
+    bindparam,
+    case,
+    cast,
+    column,
+    delete,
+    func,
+    insert,
+    literal,
+    literal_column,
+    or_,
+    select,
+    update,
+)
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.sql.dml import ReturningUpdate
+from sqlalchemy.sql.selectable import CTE, Subquery
 
-from base_credentials_pool import BaseCredentialsPool, CredentialMetadata
-from models import Credential
+from base_credentials_pool import (
+    MAX_QUARANTINE_SECONDS,
+    QUARANTINE_SECONDS,
+    BaseCredentialsPool,
+    CredentialMetadata,
+    CredentialNotFoundError,
+    FailureKind,
+)
+from credentials_store import SchedulingStrategy
+from models import Credential, Lease
 from settings import POSTGRES_URL
 
+LOGGER = logging.getLogger(__name__)
+
+RELEASE_CHANNEL = 'credentials_released'
+
 engine = create_async_engine(POSTGRES_URL)
 async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
 
+credentials_table = Credential.__table__
+leases_table = Lease.__table__
+
+acquired_columns = (
+    credentials_table.c.username,
+    credentials_table.c.password,
+    credentials_table.c.cookie,
+    credentials_table.c.id,
+    credentials_table.c.max_concurrency,
+    credentials_table.c.tag,
+    credentials_table.c.failure_count,
+    # Not part of ``CredentialMetadata``, tells whether a cookie buffered by this pool is still the latest one.
+    credentials_table.c.cookie_updated_at,
+)
+
+
+def take_slot(active_leases: ColumnElement[int]) -> dict:
+    """Values taking a slot of a credential that has ``active_leases`` leases once taken."""
+    return {
+        'active_leases': active_leases,
+        'in_use': active_leases >= credentials_table.c.max_concurrency,
+        'date_last_usage': bindparam('now'),
+        'usage_count': credentials_table.c.usage_count + 1,
+    }
+
+
+def leasing(taken: ReturningUpdate) -> Select:
+    """Runs ``taken`` and leases every taken slot until ``lease_expiry`` in ``credential_leases``.
+
+    Every row comes with the ``lease_id`` of its slot, ``None`` when ``lease_expiry`` is ``None`` and nothing is leased.
+    """
+    taken_rows = taken.cte('taken')
+    lease_expiry = bindparam('lease_expiry', type_=DateTime)
+    new_leases = (
+        insert(leases_table)
+        .from_select(
+            ['credential_id', 'expires_at'],
+            select(taken_rows.c.id, lease_expiry).where(lease_expiry.is_not(None)),
+        )
+        .returning(leases_table.c.id, leases_table.c.credential_id)
+        .cte('new_leases')
+    )
+    return select(*taken_rows.c, new_leases.c.id.label('lease_id')).select_from(
+        taken_rows.outerjoin(new_leases, new_leases.c.credential_id == taken_rows.c.id),
+    )
+
+
+def acquire_statement(candidates: Select, active_leases: ColumnElement[int]) -> Select:
+    return leasing(
+        update(credentials_table)
+        .where(credentials_table.c.id == candidates.limit(1).scalar_subquery())
+        .values(take_slot(active_leases))
+        .returning(*acquired_columns),
+    )
+
+
+def acquire_many_statement(candidates: Select, active_leases: ColumnElement[int]) -> Select:
+    locked = candidates.limit(bindparam('n')).cte('candidates')
+
+    # The candidates are locked either way, but rows are only taken when at least `min_n` of them could be locked.
+    return leasing(
+        update(credentials_table)
+        .where(
+            credentials_table.c.id.in_(select(locked.c.id)),
+            select(func.count()).select_from(locked).scalar_subquery() >= bindparam('min_n'),
+        )
+        .values(take_slot(active_leases))
+        .returning(*acquired_columns),
+    )
+
+
+hold_ms = func.extract('epoch', bindparam('now', type_=DateTime) - credentials_table.c.date_last_usage) * 1000
+
+
+def release_statement(where: ColumnElement[bool], slots: ColumnElement[int]) -> Select:
+    """Frees ``slots`` slots of every credential matching ``where`` and wakes as many waiters as slots are free.
+
+    A credential with fewer leases than ``slots`` is left alone, so a double release or a release after the reaper
+    took the credential back doesn't free slots held by someone else. The notification carries the freed slots per
+    tag and the cooldown they rest for, slots released into a quarantine wake nobody.
+    """
+    released = (
+        update(credentials_table)
+        .where(where, credentials_table.c.active_leases >= slots)
+        .values(
+            active_leases=credentials_table.c.active_leases - slots,
+            in_use=False,
+            # A quarantine reported while the credential was held outlasts the cooldown.
+            available_at=func.greatest(bindparam('available_from'), credentials_table.c.quarantined_until),
+            # Every released slot is counted from the latest acquisition of the credential.
+            total_hold_ms=credentials_table.c.total_hold_ms + slots * func.coalesce(cast(hold_ms, BigInteger), 0),
+        )
+        .returning(slots.label('slots'), credentials_table.c.tag, credentials_table.c.available_at)
+        .cte('released')
+    )
+    available_from = bindparam('available_from', type_=DateTime)
+    now = bindparam('now', type_=DateTime)
+    rests_for_cooldown = or_(
+        released.c.available_at.is_(None),
+        released.c.available_at <= func.greatest(available_from, now),
+    )
+    released_by_tag = (
+        select(
+            released.c.tag,
+            func.count().label('released_count'),
+            func.sum(case((rests_for_cooldown, released.c.slots), else_=0)).label('slots'),
+        )
+        .group_by(released.c.tag)
+        .subquery('released_by_tag')
+    )
+    released_count = func.sum(released_by_tag.c.released_count)
+    payload = func.json_build_object(
+        'delay',
+        func.coalesce(func.extract('epoch', available_from - now), 0),
+        'slots',
+        func.json_agg(func.json_build_array(released_by_tag.c.tag, released_by_tag.c.slots)),
+    )
+    return (
+        select(
+            cast(released_count, Integer).label('released_count'),
+            func.pg_notify(RELEASE_CHANNEL, cast(payload, Text)),
+        )
+        .select_from(released_by_tag)
+        .having(released_count > 0)
+    )
+
+
+# Least loaded credentials first, so that load spreads over all credentials before any of them takes a second lease,
+# then in the order of the scheduling strategy. Each order is served by a partial index over free credentials.
+STRATEGY_ORDERS = {
+    SchedulingStrategy.LRU: credentials_table.c.date_last_usage.asc().nullsfirst(),
+    SchedulingStrategy.LEAST_USED: credentials_table.c.usage_count,
+    SchedulingStrategy.LEAST_HELD: credentials_table.c.total_hold_ms,
+}
+
+
+def free_credentials(strategy: SchedulingStrategy) -> Select:
+    return (
+        select(credentials_table.c.id)
+        .where(
+            credentials_table.c.in_use == False,
+            or_(credentials_table.c.available_at.is_(None), credentials_table.c.available_at <= bindparam('now')),
+        )
+        .order_by(credentials_table.c.active_leases, STRATEGY_ORDERS[strategy])
+        .with_for_update(skip_locked=True)
+    )
+
+
+@dataclass(frozen=True)
+class AcquireStatements:
+    """Statements taking free credentials in the order of one scheduling strategy."""
+
+    acquire: Select
+    acquire_tagged: Select
+    acquire_many: Select
+    acquire_many_tagged: Select
+
+    @classmethod
+    def build(cls, strategy: SchedulingStrategy) -> 'AcquireStatements':
+        free = free_credentials(strategy)
+        # A single tag per statement keeps the scan an ordered probe of the (tag, active_leases, ...) index.
+        free_tagged = free.where(credentials_table.c.tag == bindparam('credential_tag'))
+        active_leases = credentials_table.c.active_leases + 1
+        return cls(
+            acquire=acquire_statement(free, active_leases),
+            acquire_tagged=acquire_statement(free_tagged, active_leases),
+            acquire_many=acquire_many_statement(free, active_leases),
+            acquire_many_tagged=acquire_many_statement(free_tagged, active_leases),
+        )
+
+
+ACQUIRE_STATEMENTS = {strategy: AcquireStatements.build(strategy) for strategy in STRATEGY_ORDERS}
 
-class CredentialNotFoundError(Exception):
-    pass
+
+def pool_state_statement(*where: ColumnElement[bool]) -> Select:
+    return select(
+        select(credentials_table.c.id).where(*where).limit(1).scalar_subquery().label('any_id'),
+        select(func.min(credentials_table.c.available_at))
+        .where(credentials_table.c.in_use == False, *where)
+        .scalar_subquery()
+        .label('next_available_at'),
+    )
+
+
+# Only run after a miss: tells an empty table apart from a busy one, and when the next cooling credential frees up.
+POOL_STATE_STATEMENT = pool_state_statement()
+POOL_STATE_TAGGED_STATEMENT = pool_state_statement(
+    credentials_table.c.tag == any_(bindparam('tags', type_=ARRAY(Text))),
+)
+
+# One row per released credential, with the number of its slots released at once.
+released_slots = (
+    func.unnest(
+        bindparam('credential_ids', type_=ARRAY(Integer)),
+        bindparam('credential_usernames', type_=ARRAY(Text)),
+        bindparam('slots', type_=ARRAY(Integer)),
+    )
+    .table_valued(column('id', Integer), column('username', Text), column('slots', Integer))
+    .render_derived('released_slots')
+)
+
+RELEASE_STATEMENT = release_statement(credentials_table.c.id == bindparam('credential_id'), literal(1))
+RELEASE_BY_USERNAME_STATEMENT = release_statement(
+    credentials_table.c.username == bindparam('credential_username'),
+    literal(1),
+)
+RELEASE_MANY_STATEMENT = release_statement(
+    or_(credentials_table.c.id == released_slots.c.id, credentials_table.c.username == released_slots.c.username),
+    released_slots.c.slots,
+)
+
+
+def slots_by_credential(leases: CTE, name: str) -> Subquery:
+    """Number of slots per credential among the deleted ``leases``."""
+    return select(leases.c.credential_id, func.count().label('slots')).group_by(leases.c.credential_id).subquery(name)
+
+
+# Leases of this pool, only their own slots are released.
+ended_leases = (
+    delete(leases_table)
+    .where(leases_table.c.id == any_(bindparam('lease_ids', type_=ARRAY(BigInteger))))
+    .returning(leases_table.c.credential_id)
+    .cte('ended_leases')
+)
+ended_slots = slots_by_credential(ended_leases, 'ended_slots')
+RELEASE_LEASES_STATEMENT = release_statement(credentials_table.c.id == ended_slots.c.credential_id, ended_slots.c.slots)
+
+# Every expired lease frees its own slot, however long the other slots of its credential stay in use.
+expired_leases = (
+    delete(leases_table)
+    .where(
+        leases_table.c.id.in_(
+            select(leases_table.c.id)
+            .where(leases_table.c.expires_at < bindparam('now'))
+            .with_for_update(skip_locked=True),
+        ),
+    )
+    .returning(leases_table.c.credential_id)
+    .cte('expired_leases')
+)
+expired_slots = slots_by_credential(expired_leases, 'expired_slots')
+REAP_EXPIRED_LEASES_STATEMENT = release_statement(
+    credentials_table.c.id == expired_slots.c.credential_id,
+    expired_slots.c.slots,
+)
+
+saved_cookies = (
+    func.unnest(
+        bindparam('credential_ids', type_=ARRAY(Integer)),
+        bindparam('credential_usernames', type_=ARRAY(Text)),
+        bindparam('cookies', type_=ARRAY(Text)),
+        bindparam('refreshed_at', type_=ARRAY(DateTime)),
+    )
+    .table_valued(
+        column('id', Integer),
+        column('username', Text),
+        column('cookie', Text),
+        column('refreshed_at', DateTime),
+    )
+    .render_derived('saved_cookies')
+)
+
+# A cookie refreshed elsewhere after this one was buffered is newer, it's left alone.
+SAVE_COOKIES_STATEMENT = (
+    update(credentials_table)
+    .where(
+        or_(credentials_table.c.id == saved_cookies.c.id, credentials_table.c.username == saved_cookies.c.username),
+        or_(
+            credentials_table.c.cookie_updated_at.is_(None),
+            credentials_table.c.cookie_updated_at <= saved_cookies.c.refreshed_at,
+        ),
+    )
+    .values(cookie=saved_cookies.c.cookie, cookie_updated_at=saved_cookies.c.refreshed_at)
+    .returning(credentials_table.c.id)
+)
+
+EXTEND_LEASES_STATEMENT = (
+    update(leases_table)
+    .where(leases_table.c.id == any_(bindparam('lease_ids', type_=ARRAY(BigInteger))))
+    .values(expires_at=bindparam('lease_expiry'))
+    .returning(leases_table.c.id)
+)
+
+
+def report_failure_statement(where: ColumnElement[bool]) -> ReturningUpdate:
+    """Counts a failure and quarantines the credential for ``quarantine_seconds`` doubled per earlier failure."""
+    quarantine = func.least(
+        bindparam('quarantine_seconds') * func.power(2, credentials_table.c.failure_count),
+        MAX_QUARANTINE_SECONDS,
+    )
+    quarantined_until = bindparam('now', type_=DateTime) + quarantine * literal_column("interval '1 second'")
+    return (
+        update(credentials_table)
+        .where(where)
+        .values(
+            failure_count=credentials_table.c.failure_count + 1,
+            last_failure_kind=bindparam('failure_kind'),
+            quarantined_until=quarantined_until,
+            available_at=func.greatest(credentials_table.c.available_at, quarantined_until),
+        )
+        .returning(credentials_table.c.failure_count)
+    )
+
+
+def report_success_statement(where: ColumnElement[bool]) -> ReturningUpdate:
+    return (
+        update(credentials_table)
+        .where(where)
+        .values(failure_count=0, quarantined_until=None)
+        .returning(credentials_table.c.failure_count)
+    )
+
+
+REPORT_FAILURE_STATEMENT = report_failure_statement(credentials_table.c.id == bindparam('credential_id'))
+REPORT_FAILURE_BY_USERNAME_STATEMENT = report_failure_statement(
+    credentials_table.c.username == bindparam('credential_username'),
+)
+REPORT_SUCCESS_STATEMENT = report_success_statement(credentials_table.c.id == bindparam('credential_id'))
+REPORT_SUCCESS_BY_USERNAME_STATEMENT = report_success_statement(
+    credentials_table.c.username == bindparam('credential_username'),
+)
 
 
 class NoCredentialsAtDatabaseError(Exception):
@@ -34,35 +396,441 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
             await session.close()
 
 
+def postgres_dsn() -> str:
+    """DSN of the database the sessions are bound to, for connections made with asyncpg directly."""
+    return async_session.kw['bind'].url.set(drivername='postgresql').render_as_string(hide_password=False)
+
+
+class ReleaseListener:
+    """Shares a single LISTEN connection between the waiters of a pool.
+
+    Every notification on ``RELEASE_CHANNEL`` wakes, for each tag, as many local waiters of that tag as slots of
+    it were released, once their cooldown is over. The rest keep sleeping until their backoff runs out.
+    """
+
+    def __init__(self):
+        self.connection: asyncpg.Connection | None = None
+        # Tags of the acquire and its waiter, resolved with the tag of the slot that woke it.
+        self.waiters: deque[tuple[tuple[str, ...] | None, asyncio.Future[str | None]]] = deque()
+        self.lock = asyncio.Lock()
+
+    async def wait(self, timeout: float, tags: tuple[str, ...] | None = None) -> None:
+        if not await self._listen():
+            await asyncio.sleep(timeout)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append((tags, waiter))
+
+        try:
+            async with asyncio.timeout(timeout):
+                await waiter
+        except TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._wake(1, waiter.result())
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                waiter.cancel()
+                with suppress(ValueError):
+                    self.waiters.remove((tags, waiter))
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await connection.close()
+
+    async def _listen(self) -> bool:
+        async with self.lock:
+            if self.connection is None:
+                try:
+                    self.connection = await asyncpg.connect(postgres_dsn())
+                    self.connection.add_termination_listener(self._on_termination)
+                    await self.connection.add_listener(RELEASE_CHANNEL, self._on_release)
+                except (OSError, asyncpg.PostgresError):
+                    LOGGER.exception('Failed to listen for released credentials, falling back to polling')
+                    await self.close()
+        return self.connection is not None
+
+    def _on_release(self, _connection: asyncpg.Connection, _pid: int, _channel: str, payload: str) -> None:
+        released = json.loads(payload)
+        loop = asyncio.get_running_loop()
+        for tag, slots in released['slots']:
+            if slots and released['delay'] > 0:
+                loop.call_later(released['delay'], self._wake, slots, tag)
+            elif slots:
+                self._wake(slots, tag)
+
+    def _on_termination(self, _connection: asyncpg.Connection) -> None:
+        self.connection = None
+        for _, waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+    def _wake(self, count: int, tag: str | None) -> None:
+        """Wake the first ``count`` waiters that can take a slot tagged ``tag``, in the order they started waiting."""
+        while self.waiters and self.waiters[0][1].done():
+            self.waiters.popleft()
+
+        index = 0
+        while count and index < len(self.waiters):
+            tags, waiter = self.waiters[index]
+            if not waiter.done() and (tags is None or tag in tags):
+                del self.waiters[index]
+                waiter.set_result(tag)
+                count -= 1
+            else:
+                index += 1
+
+
 class PersistentCredentialsPool(BaseCredentialsPool):
-    async def _acquire(self) -> CredentialMetadata | None:
-        async with get_session() as session:
-            count = (await session.execute(select(func.count(Credential.id)))).scalar()
+    """Credentials pool backed by the ``credentials`` table.
+
+    With ``lease_ttl`` set, every acquired slot is leased with a row of its own in ``credential_leases``, inserted by
+    the acquire statement. While the process lives, a heartbeat task extends the leases it holds every
+    ``heartbeat_interval`` seconds, and release deletes the lease of the released slot. Leases of crashed processes
+    run out slot by slot, and ``reap_expired_leases`` frees exactly their slots: when an acquire finds no free
+    credential, and every ``reap_interval`` seconds.
+
+    A credential can be leased ``max_concurrency`` times at once. Acquire takes a slot of the least loaded
+    credential, among those the one that comes first in the ``strategy`` order: least recently used, least used
+    (``usage_count``) or least held in total (``total_hold_ms``). Acquire counts the use and release adds the time
+    since the latest acquisition, in their own statements. ``in_use`` is only set once all its slots are taken.
+
+    With ``cooldown`` set, a released credential rests for that many seconds before it can be acquired again:
+    release sets ``available_at`` and the acquire query skips credentials that are not available yet.
+    A credential quarantined by ``report_failure`` is kept out the same way, ``available_at`` is pushed to
+    ``quarantined_until`` so acquire keeps using a single filter and its indexes.
+
+    Cookies refreshed on release are written behind: they are buffered per credential, the latest one wins,
+    and written in the background with a single ``UPDATE`` once ``cookie_flush_size`` credentials are pending or
+    ``cookie_flush_interval`` seconds after the first of them, and on ``close``. A failed write is logged and retried
+    with the next flush, it never fails a release. Until then, acquires of this
+    pool already get the buffered cookie, other processes still get the previous one. ``cookie_updated_at`` is only
+    written together with a cookie: a buffered cookie is dropped once another process wrote a cookie refreshed after
+    it, so it never overwrites a newer cookie, and acquires of this pool get the newer one then.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        lease_ttl: float | None = None,
+        heartbeat_interval: float | None = None,
+        reap_interval: float | None = None,
+        cooldown: float | None = None,
+        cookie_flush_size: int = 100,
+        cookie_flush_interval: float = 1.0,
+        strategy: SchedulingStrategy = SchedulingStrategy.LRU,
+    ):
+        if strategy not in ACQUIRE_STATEMENTS:
+            error_message = (
+                f'The persistent pool supports the {", ".join(ACQUIRE_STATEMENTS)} strategies, not {strategy}'
+            )
+            raise ValueError(error_message)
+        self.acquire_statements = ACQUIRE_STATEMENTS[strategy]
+        self.release_listener = ReleaseListener()
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval or (lease_ttl and lease_ttl / 3)
+        self.reap_interval = reap_interval
+        self.cooldown = cooldown
+        self.next_available_at: datetime | None = None
+        # Leases this pool holds by credential id, with ``lease_ttl`` set.
+        self.held_leases: dict[int, list[int]] = {}
+        self.background_tasks: list[asyncio.Task[None]] = []
+        self.cookie_flush_size = cookie_flush_size
+        self.cookie_flush_interval = cookie_flush_interval
+        # Refreshed cookie and the time it was refreshed at, by (id, None) or (None, username) for credentials
+        # without an id.
+        self.pending_cookies: dict[tuple[int | None, str | None], tuple[str, datetime]] = {}
+        self.cookie_flush_timer: asyncio.Task[None] | None = None
+        self.cookie_flush_requested = asyncio.Event()
+
+    async def close(self) -> None:
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.background_tasks.clear()
+        if self.cookie_flush_timer is not None:
+            # A flush interrupted mid-statement leaves its cookies pending, the flush below writes them.
+            self.cookie_flush_timer.cancel()
+            await asyncio.gather(self.cookie_flush_timer, return_exceptions=True)
+            self.cookie_flush_timer = None
+        await self.flush_cookies()
+        await self.release_listener.close()
+
+    async def flush_cookies(self) -> None:
+        """Write every buffered cookie with a single statement."""
+        if not self.pending_cookies:
+            return
+
+        # Cookies stay pending until they are written, so a failed or cancelled flush loses none of them.
+        pending = dict(self.pending_cookies)
+        parameters = {
+            'credential_ids': [credential_id for credential_id, _ in pending],
+            'credential_usernames': [username for _, username in pending],
+            'cookies': [cookie for cookie, _ in pending.values()],
+            'refreshed_at': [refreshed_at for _, refreshed_at in pending.values()],
+        }
+        await self._execute(SAVE_COOKIES_STATEMENT, parameters)
+        for key, buffered in pending.items():
+            # Cookies buffered in the meantime are newer, they are left for the next flush.
+            if self.pending_cookies.get(key) == buffered:
+                del self.pending_cookies[key]
+
+    async def reap_expired_leases(self) -> int:
+        """Reclaim every credential whose lease has run out, returns the number of reclaimed credentials."""
+        now = datetime.utcnow()
+        rows = await self._execute(
+            REAP_EXPIRED_LEASES_STATEMENT, {'now': now, 'available_from': self._available_from(now)}
+        )
+        return rows[0]['released_count'] if rows else 0
+
+    async def extend_leases(self) -> None:
+        if self.held_leases:
+            lease_ids = [lease_id for lease_ids in self.held_leases.values() for lease_id in lease_ids]
+            parameters = {'lease_ids': lease_ids, 'lease_expiry': self._lease_expiry(datetime.utcnow())}
+            await self._execute(EXTEND_LEASES_STATEMENT, parameters)
+
+    async def _acquire(self, tags: tuple[str, ...] | None) -> CredentialMetadata | None:
+        acquire_statements = self.acquire_statements
+        credentials = await self._take(acquire_statements.acquire, acquire_statements.acquire_tagged, {}, tags)
+        return credentials[0] if credentials else None
+
+    async def _acquire_many(self, n: int, min_n: int, tags: tuple[str, ...] | None) -> list[CredentialMetadata]:
+        return await self._take(
+            self.acquire_statements.acquire_many,
+            self.acquire_statements.acquire_many_tagged,
+            {'n': n, 'min_n': min_n},
+            tags,
+        )
+
+    async def _release(self, credential: CredentialMetadata) -> None:
+        if self.lease_ttl is not None:
+            await self._release_leases([credential])
+            return
+
+        statement, parameters = self._by_credential(credential, RELEASE_STATEMENT, RELEASE_BY_USERNAME_STATEMENT)
+        now = datetime.utcnow()
+        parameters |= {'now': now, 'available_from': self._available_from(now)}
+
+        if not await self._execute(statement, parameters):
+            raise CredentialNotFoundError('There is no such leased credential in db which you are trying to release')
+
+    async def _release_many(self, credentials: list[CredentialMetadata]) -> None:
+        if self.lease_ttl is not None:
+            await self._release_leases(credentials)
+            return
+
+        # Several slots of the same credential are released with a single row update.
+        slots = Counter(self._credential_key(credential) for credential in credentials)
+        parameters = {
+            'credential_ids': [credential_id for credential_id, _ in slots],
+            'credential_usernames': [username for _, username in slots],
+            'slots': list(slots.values()),
+        }
+        now = datetime.utcnow()
+        parameters |= {'now': now, 'available_from': self._available_from(now)}
+
+        rows = await self._execute(RELEASE_MANY_STATEMENT, parameters)
+        released_count = rows[0]['released_count'] if rows else 0
 
-            if count == 0:
+        if released_count < len(slots):
+            error_message = f'Only {released_count} of {len(slots)} credentials were found leased in db to release'
+            raise CredentialNotFoundError(error_message)
+
+    async def _release_leases(self, credentials: list[CredentialMetadata]) -> None:
+        """Release the slots by deleting leases of this pool, a lease that already ran out releases nothing."""
+        slots = Counter(credential.id for credential in credentials)
+        for credential_id, count in slots.items():
+            if len(self.held_leases.get(credential_id, ())) < count:
+                error_message = f'Credential {credential_id} is not leased by this pool'
+                raise CredentialNotFoundError(error_message)
+
+        # Taken off before the statement: two releases of slots of one credential never end the same lease,
+        # and the lease of a failed release runs out and is reaped.
+        lease_ids = []
+        for credential_id, count in slots.items():
+            held = self.held_leases[credential_id]
+            lease_ids.extend(held[-count:])
+            del held[-count:]
+            if not held:
+                del self.held_leases[credential_id]
+
+        now = datetime.utcnow()
+        parameters = {'lease_ids': lease_ids, 'now': now, 'available_from': self._available_from(now)}
+        rows = await self._execute(RELEASE_LEASES_STATEMENT, parameters)
+        released_count = rows[0]['released_count'] if rows else 0
+
+        if released_count < len(slots):
+            error_message = f'Only {released_count} of {len(slots)} credentials were found leased in db to release'
+            raise CredentialNotFoundError(error_message)
+
+    async def _save_cookies(self, credentials: list[CredentialMetadata]) -> None:
+        now = datetime.utcnow()
+        for credential in credentials:
+            self.pending_cookies[self._credential_key(credential)] = (credential.cookie, now)
+
+        if len(self.pending_cookies) >= self.cookie_flush_size:
+            # Flushed by the background task too, so a failed write never fails the release.
+            self.cookie_flush_requested.set()
+        if self.cookie_flush_timer is None or self.cookie_flush_timer.done():
+            self.cookie_flush_timer = asyncio.create_task(self._flush_cookies_later())
+
+    async def _flush_cookies_later(self) -> None:
+        """Flush every ``cookie_flush_interval`` seconds or once the flush size is reached, until nothing is pending."""
+        while self.pending_cookies:
+            with suppress(TimeoutError):
+                async with asyncio.timeout(self.cookie_flush_interval):
+                    await self.cookie_flush_requested.wait()
+            self.cookie_flush_requested.clear()
+            try:
+                await self.flush_cookies()
+            except Exception:
+                LOGGER.exception('Background flush_cookies failed')
+
+    async def _report_failure(self, credential: CredentialMetadata, kind: FailureKind) -> None:
+        statement, parameters = self._by_credential(
+            credential,
+            REPORT_FAILURE_STATEMENT,
+            REPORT_FAILURE_BY_USERNAME_STATEMENT,
+        )
+        parameters |= {
+            'now': datetime.utcnow(),
+            'quarantine_seconds': QUARANTINE_SECONDS[kind],
+            'failure_kind': str(kind),
+        }
+        rows = await self._execute(statement, parameters)
+        if not rows:
+            raise CredentialNotFoundError('There is no such credential in db which you are trying to report')
+        credential.failure_count = rows[0]['failure_count']
+
+    async def _report_success(self, credential: CredentialMetadata) -> None:
+        # Most uses succeed, only a credential that failed since it was acquired costs a statement.
+        if not credential.failure_count:
+            return
+        statement, parameters = self._by_credential(
+            credential,
+            REPORT_SUCCESS_STATEMENT,
+            REPORT_SUCCESS_BY_USERNAME_STATEMENT,
+        )
+        if not await self._execute(statement, parameters):
+            raise CredentialNotFoundError('There is no such credential in db which you are trying to report')
+        credential.failure_count = 0
+
+    async def _wait_before_retry(self, wait_seconds: float, tags: tuple[str, ...] | None) -> None:
+        now = datetime.utcnow()
+        if self.next_available_at is not None and self.next_available_at > now:
+            wait_seconds = min(wait_seconds, (self.next_available_at - now).total_seconds())
+        await self.release_listener.wait(wait_seconds, tags)
+
+    async def _take(
+        self,
+        statement: Executable,
+        tagged_statement: Executable,
+        parameters: dict,
+        tags: tuple[str, ...] | None,
+    ) -> list[CredentialMetadata]:
+        """Run ``statement``, or ``tagged_statement`` once per tag in the order of preference.
+
+        When nothing is free, expired leases are reaped and the statements run once more.
+        """
+        now = datetime.utcnow()
+        parameters |= {'now': now, 'lease_expiry': self._lease_expiry(now)}
+
+        if tags is None:
+            attempts = [(statement, parameters)]
+        else:
+            attempts = [(tagged_statement, parameters | {'credential_tag': tag}) for tag in tags]
+
+        rows = await self._first_rows(attempts)
+        if not rows and await self.reap_expired_leases():
+            rows = await self._first_rows(attempts)
+
+        if not rows:
+            if tags is None:
+                pool_state = (await self._execute(POOL_STATE_STATEMENT, {}))[0]
+            else:
+                pool_state = (await self._execute(POOL_STATE_TAGGED_STATEMENT, {'tags': list(tags)}))[0]
+            if pool_state['any_id'] is None:
                 raise NoCredentialsAtDatabaseError('Please, upload credentials to the database')
+            self.next_available_at = pool_state['next_available_at']
 
-            credential = (
-                await session.execute(
-                    select(Credential)
-                    .filter(Credential.in_use == False)
-                    .order_by(nullsfirst(Credential.date_last_usage.asc()))
-                    .limit(1)
-                    .with_for_update(skip_locked=True),
-                )
-            ).scalar()
+        self._start_background_tasks()
+        return [self._taken_credential(row) for row in rows]
 
-            if credential:
-                credential.date_last_usage = datetime.utcnow()
-                credential.in_use = True
-                return CredentialMetadata.from_orm(credential)
+    async def _first_rows(self, attempts: list[tuple[Executable, dict]]) -> Sequence[RowMapping]:
+        rows = []
+        for statement, parameters in attempts:
+            rows = await self._execute(statement, parameters)
+            if rows:
+                break
+        return rows
 
-        return None
+    def _taken_credential(self, row: RowMapping) -> CredentialMetadata:
+        values = dict(row)
+        cookie_updated_at = values.pop('cookie_updated_at')
+        lease_id = values.pop('lease_id')
+        credential = CredentialMetadata(**values)
+        if lease_id is not None:
+            self.held_leases.setdefault(credential.id, []).append(lease_id)
 
-    async def _release(self, credential: Credential) -> None:
-        async with get_session() as session:
-            db_credential = (await session.execute(select(Credential).filter_by(username=credential.username))).scalar()
-            if db_credential:
-                db_credential.in_use = False
+        key = self._credential_key(credential)
+        pending = self.pending_cookies.get(key)
+        if pending is not None:
+            cookie, refreshed_at = pending
+            if cookie_updated_at is None or cookie_updated_at <= refreshed_at:
+                credential.cookie = cookie
             else:
-                raise CredentialNotFoundError('There is no such credential in db which you are trying to release')
+                # Another process wrote a newer cookie, the buffered one would never be written.
+                del self.pending_cookies[key]
+        return credential
+
+    async def _execute(self, statement: Executable, parameters: dict) -> Sequence[RowMapping]:
+        started_at = time.perf_counter()
+        try:
+            return await self._run(statement, parameters)
+        finally:
+            self.metrics.statement_seconds.observe(time.perf_counter() - started_at)
+
+    async def _run(self, statement: Executable, parameters: dict) -> Sequence[RowMapping]:
+        async with get_session() as session:
+            return (await session.execute(statement, parameters)).mappings().all()
+
+    @staticmethod
+    def _credential_key(credential: CredentialMetadata) -> tuple[int | None, str | None]:
+        return (credential.id, None) if credential.id is not None else (None, credential.username)
+
+    @staticmethod
+    def _by_credential(
+        credential: CredentialMetadata,
+        statement: Executable,
+        by_username_statement: Executable,
+    ) -> tuple[Executable, dict]:
+        if credential.id is None:
+            return by_username_statement, {'credential_username': credential.username}
+        return statement, {'credential_id': credential.id}
+
+    def _lease_expiry(self, now: datetime) -> datetime | None:
+        return None if self.lease_ttl is None else now + timedelta(seconds=self.lease_ttl)
+
+    def _available_from(self, now: datetime) -> datetime | None:
+        return None if self.cooldown is None else now + timedelta(seconds=self.cooldown)
+
+    def _start_background_tasks(self) -> None:
+        if self.background_tasks:
+            return
+        if self.lease_ttl is not None:
+            self.background_tasks.append(asyncio.create_task(self._every(self.heartbeat_interval, self.extend_leases)))
+        if self.reap_interval is not None:
+            self.background_tasks.append(asyncio.create_task(self._every(self.reap_interval, self.reap_expired_leases)))
+
+    @staticmethod
+    async def _every(interval: float, callback: Callable[[], Awaitable[object]]) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await callback()
+            except Exception:
+                LOGGER.exception(f'Background {callback.__name__} failed')
@@ -0,0 +1,280 @@
+import asyncio
+import fcntl
+import os
+import tempfile
+import time
+import zlib
+from collections import Counter
+from collections.abc import Iterable
+from dataclasses import replace
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+from base_credentials_pool import BaseCredentialsPool, CredentialMetadata, CredentialNotFoundError
+from in_memory_credentials_pool import slot_order
+
+MAGIC = 0x43505348
+# magic, slot count, credentials checksum
+HEADER_FIELDS = 3
+# Polling interval bounds while another process holds the lock, its critical sections take microseconds.
+LOCK_MIN_WAIT = 0.0001
+LOCK_MAX_WAIT = 0.01
+
+
+class FileLock:
+    """Exclusive ``flock`` on a file, every process opening the same path takes the same lock.
+
+    ``async with`` polls the lock without blocking and yields to the event loop while another process holds it,
+    plain ``with`` blocks and is only meant for code that doesn't run on an event loop.
+    """
+
+    def __init__(self, path: Path):
+        self.file = path.open('a')
+
+    def __enter__(self) -> None:
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *_exc_info) -> None:
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    async def __aenter__(self) -> None:
+        wait = 0.0
+        while True:
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                await asyncio.sleep(wait)
+                wait = min(max(wait * 2, LOCK_MIN_WAIT), LOCK_MAX_WAIT)
+            else:
+                return
+
+    async def __aexit__(self, *_exc_info) -> None:
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class SharedMemoryCredentialsPool(BaseCredentialsPool):
+    """Credentials pool shared by the processes of one host, its state lives in ``multiprocessing.shared_memory``.
+
+    Every process passes the same credentials in the same order, only the lease state is shared: for every lease slot
+    its owner pid (0 when free) and the time it was last acquired, and for every tag a ring of free slots, handed out
+    in the order they were released. The first process to open the pool ``name`` creates and fills the segment, the
+    others attach to it. All reads and writes happen under an exclusive ``flock`` on ``<tempdir>/<name>.lock``, and
+    an acquire or release is a handful of array operations under it. While another process holds the lock, acquire
+    and release poll it and leave the event loop to the other tasks.
+
+    When no slot is free, slots whose owner process no longer exists are reclaimed, oldest acquisition first, at most
+    once every ``reclaim_interval`` seconds per process.
+    An empty pool is retried with the backoff of ``BaseCredentialsPool.acquire``, there's no cross-process wake-up.
+    The segment outlives the processes, ``unlink`` removes it.
+    """
+
+    def __init__(
+        self,
+        credentials: Iterable[CredentialMetadata],
+        name: str = 'aio_credentials_pool',
+        reclaim_interval: float = 1.0,
+    ):
+        self.name = name
+        self.reclaim_interval = reclaim_interval
+        self.reclaimed_at: float | None = None
+        self.credentials = list(credentials)
+        self.pid = os.getpid()
+
+        rows_by_tag: dict[str | None, list[int]] = {}
+        for row, credential in enumerate(self.credentials):
+            rows_by_tag.setdefault(credential.tag, []).append(row)
+
+        # Slots are numbered tag by tag, the free ring of a tag is the part of the ring array with its slot numbers.
+        self.tag_numbers = {tag: number for number, tag in enumerate(rows_by_tag)}
+        self.slot_rows = []
+        self.slot_tag_numbers = []
+        self.tag_ranges = []
+        for number, tagged_rows in enumerate(rows_by_tag.values()):
+            start = len(self.slot_rows)
+            order = slot_order([self.credentials[row].max_concurrency for row in tagged_rows])
+            self.slot_rows.extend(tagged_rows[index] for index, _ in order)
+            self.slot_tag_numbers.extend([number] * (len(self.slot_rows) - start))
+            self.tag_ranges.append((start, len(self.slot_rows)))
+        self.held: dict[str, list[int]] = {}
+        self.next_tag_number = 0
+
+        slot_count = len(self.slot_rows)
+        tag_count = len(self.tag_ranges)
+        size = 8 * slot_count + 4 * HEADER_FIELDS + 8 * tag_count + 4 * slot_count + 4 * slot_count
+        checksum = zlib.crc32('\0'.join(credential.username for credential in self.credentials).encode())
+
+        self.lock = FileLock(Path(tempfile.gettempdir()) / f'{name}.lock')
+        with self.lock:
+            try:
+                self.shared_memory = SharedMemory(name, create=True, size=size)
+                created = True
+            except FileExistsError:
+                self.shared_memory = SharedMemory(name)
+                created = False
+            # The segment is removed by ``unlink``, not when the process that happened to open it first exits.
+            resource_tracker.unregister(self.shared_memory._name, 'shared_memory')  # noqa: SLF001
+
+            buffer = self.shared_memory.buf
+            self.acquired_at = buffer[: 8 * slot_count].cast('d')
+            offset = 8 * slot_count
+            self.header = buffer[offset : offset + 4 * HEADER_FIELDS].cast('I')
+            offset += 4 * HEADER_FIELDS
+            # Head and length of the free ring of every tag.
+            self.rings = buffer[offset : offset + 8 * tag_count].cast('I')
+            offset += 8 * tag_count
+            self.owners = buffer[offset : offset + 4 * slot_count].cast('i')
+            offset += 4 * slot_count
+            self.ring = buffer[offset : offset + 4 * slot_count].cast('I')
+
+            if created:
+                self.header[0], self.header[1], self.header[2] = MAGIC, slot_count, checksum
+                for number, (start, end) in enumerate(self.tag_ranges):
+                    self.rings[2 * number + 1] = end - start
+                for slot in range(slot_count):
+                    self.ring[slot] = slot
+            compatible = tuple(self.header) == (MAGIC, slot_count, checksum)
+
+        if not compatible:
+            self._close_views()
+            error_message = f'Shared memory pool {name} was created with other credentials'
+            raise ValueError(error_message)
+
+    async def _acquire(self, tags: tuple[str, ...] | None) -> CredentialMetadata | None:
+        credentials = await self._acquire_many(1, 1, tags)
+        return credentials[0] if credentials else None
+
+    async def _acquire_many(self, n: int, min_n: int, tags: tuple[str, ...] | None) -> list[CredentialMetadata]:
+        slots = await self._take_slots(n, min_n, tags)
+        if not slots and await self._reclaim_dead_slots():
+            slots = await self._take_slots(n, min_n, tags)
+
+        credentials = []
+        for slot in slots:
+            credential = self.credentials[self.slot_rows[slot]]
+            if credential.max_concurrency > 1:
+                # Concurrent holders of a credential get objects of their own.
+                credential = replace(credential)
+            self.held.setdefault(credential.username, []).append(slot)
+            credentials.append(credential)
+        return credentials
+
+    async def _release(self, credential: CredentialMetadata) -> None:
+        await self._release_many([credential])
+
+    async def _release_many(self, credentials: list[CredentialMetadata]) -> None:
+        # ``held`` is only touched once the lock is held and without awaiting in between, so a cancelled wait for the
+        # lock or an unknown credential in the batch leaves every slot leased and releasable again.
+        async with self.lock:
+            for username, count in Counter(credential.username for credential in credentials).items():
+                if len(self.held.get(username, ())) < count:
+                    error_message = f'Credential {username} is not leased by this process'
+                    raise CredentialNotFoundError(error_message)
+
+            for credential in credentials:
+                held = self.held[credential.username]
+                self._free_slot(held.pop())
+                if not held:
+                    del self.held[credential.username]
+
+    async def close(self) -> None:
+        self._close_views()
+
+    def unlink(self) -> None:
+        """Remove the shared memory segment, processes still attached to it keep their mapping."""
+        # Registered again only for ``SharedMemory.unlink`` to unregister it.
+        resource_tracker.register(self.shared_memory._name, 'shared_memory')  # noqa: SLF001
+        self.shared_memory.unlink()
+
+    def _free_count(self) -> int | None:
+        if self.lock.closed:
+            return None
+        return sum(self.rings[1::2])
+
+    async def _take_slots(self, n: int, min_n: int, tags: tuple[str, ...] | None) -> list[int]:
+        if tags is None:
+            # Start with another tag every time, like ``TaggedCredentialsStore``.
+            tag_count = len(self.tag_ranges)
+            self.next_tag_number = (self.next_tag_number + 1) % max(tag_count, 1)
+            groups = [[(self.next_tag_number + offset) % tag_count for offset in range(tag_count)]]
+        else:
+            groups = [[self.tag_numbers[tag]] for tag in tags if tag in self.tag_numbers]
+
+        async with self.lock:
+            for numbers in groups:
+                free_count = sum(self.rings[2 * number + 1] for number in numbers)
+                if free_count >= min_n:
+                    slots = []
+                    for number in numbers:
+                        while len(slots) < n and self.rings[2 * number + 1]:
+                            slots.append(self._pop_slot(number))
+                    return slots
+        return []
+
+    def _pop_slot(self, tag_number: int) -> int:
+        start, end = self.tag_ranges[tag_number]
+        head = self.rings[2 * tag_number]
+        slot = self.ring[start + head]
+        self.rings[2 * tag_number] = (head + 1) % (end - start)
+        self.rings[2 * tag_number + 1] -= 1
+        self.owners[slot] = self.pid
+        self.acquired_at[slot] = time.time()
+        return slot
+
+    def _free_slot(self, slot: int) -> None:
+        tag_number = self.slot_tag_numbers[slot]
+        start, end = self.tag_ranges[tag_number]
+        head, length = self.rings[2 * tag_number], self.rings[2 * tag_number + 1]
+        self.ring[start + (head + length) % (end - start)] = slot
+        self.rings[2 * tag_number + 1] = length + 1
+        self.owners[slot] = 0
+
+    async def _reclaim_dead_slots(self) -> int:
+        """Free the slots of processes that exited without releasing them, returns how many were freed.
+
+        Owners are checked once per process and outside the lock, which is only taken to free the slots that still
+        belong to the dead ones.
+        """
+        now = time.monotonic()
+        if self.reclaimed_at is not None and now - self.reclaimed_at < self.reclaim_interval:
+            return 0
+        self.reclaimed_at = now
+
+        # Read without the lock, a slot changing owner meanwhile is checked again under it.
+        owners = set(self.owners) - {0, self.pid}
+        dead_owners = {owner for owner in owners if not process_exists(owner)}
+        if not dead_owners:
+            return 0
+
+        async with self.lock:
+            dead_slots = [slot for slot, owner in enumerate(self.owners) if owner in dead_owners]
+            dead_slots.sort(key=lambda slot: self.acquired_at[slot])
+            for slot in dead_slots:
+                self._free_slot(slot)
+        return len(dead_slots)
+
+    def _close_views(self) -> None:
+        if self.lock.closed:
+            return
+        for view in (self.acquired_at, self.header, self.rings, self.owners, self.ring):
+            view.release()
+        self.shared_memory.close()
+        self.lock.close()
+
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user.
+        return True
+    return True
@@ -0,0 +1,552 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Callable, Iterable
+from contextlib import suppress
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
+from sqlalchemy import (
+    ColumnElement,
+    Connection,
+    DateTime,
+    Integer,
+    RowMapping,
+    Select,
+    bindparam,
+    case,
+    cast,
+    create_engine,
+    func,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.dialects.sqlite import dialect as sqlite_dialect
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.schema import CreateTable
+
+from base_credentials_pool import (
+    BaseCredentialsPool,
+    CredentialMetadata,
+    CredentialNotFoundError,
+    FailureKind,
+    quarantine_seconds,
+)
+from credentials_store import SchedulingStrategy
+from models import Credential
+
+LOGGER = logging.getLogger(__name__)
+
+INSERT_BATCH_SIZE = 1000
+
+credentials_table = Credential.__table__
+
+acquired_columns = (
+    credentials_table.c.username,
+    credentials_table.c.password,
+    credentials_table.c.cookie,
+    credentials_table.c.id,
+    credentials_table.c.max_concurrency,
+    credentials_table.c.tag,
+    credentials_table.c.failure_count,
+)
+
+
+CREATE_TABLE = str(CreateTable(credentials_table, if_not_exists=True).compile(dialect=sqlite_dialect()))
+# Columns added after the first SQLite pool release, files created before it gain them on open.
+ADD_COLUMNS = {
+    'usage_count': 'ALTER TABLE credentials ADD COLUMN usage_count INTEGER DEFAULT 0 NOT NULL',
+    'total_hold_ms': 'ALTER TABLE credentials ADD COLUMN total_hold_ms BIGINT DEFAULT 0 NOT NULL',
+}
+
+# The indexes of ``models.Credential``, except that SQLite sorts NULLs first on its own and rejects NULLS FIRST.
+# Partial indexes are only used by queries repeating their ``in_use = 0`` term.
+CREATE_INDEXES = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_credentials_username ON credentials (username)',
+    'CREATE INDEX IF NOT EXISTS ix_credentials_date_last_usage ON credentials (date_last_usage)',
+    'CREATE INDEX IF NOT EXISTS ix_credentials_free_active_leases_date_last_usage '
+    'ON credentials (active_leases, date_last_usage) WHERE in_use = 0',
+    'CREATE INDEX IF NOT EXISTS ix_credentials_free_tag_active_leases_date_last_usage '
+    'ON credentials (tag, active_leases, date_last_usage) WHERE in_use = 0',
+    'CREATE INDEX IF NOT EXISTS ix_credentials_free_active_leases_usage_count '
+    'ON credentials (active_leases, usage_count) WHERE in_use = 0',
+    'CREATE INDEX IF NOT EXISTS ix_credentials_free_tag_active_leases_usage_count '
+    'ON credentials (tag, active_leases, usage_count) WHERE in_use = 0',
+    'CREATE INDEX IF NOT EXISTS ix_credentials_free_active_leases_total_hold_ms '
+    'ON credentials (active_leases, total_hold_ms) WHERE in_use = 0',
+    'CREATE INDEX IF NOT EXISTS ix_credentials_free_tag_active_leases_total_hold_ms '
+    'ON credentials (tag, active_leases, total_hold_ms) WHERE in_use = 0',
+    'CREATE INDEX IF NOT EXISTS ix_credentials_free_available_at ON credentials (available_at) WHERE in_use = 0',
+)
+
+
+def latest(first: ColumnElement, second: ColumnElement) -> ColumnElement:
+    """The later of two nullable timestamps, ``NULL`` only when both are, SQLite's ``max`` returns ``NULL`` for any."""
+    return case((or_(first.is_(None), second > first), second), else_=first)
+
+
+# The orderings of ``PersistentCredentialsPool``: least loaded first, then by strategy, never used first for LRU.
+STRATEGY_ORDERS = {
+    SchedulingStrategy.LRU: credentials_table.c.date_last_usage,
+    SchedulingStrategy.LEAST_USED: credentials_table.c.usage_count,
+    SchedulingStrategy.LEAST_HELD: credentials_table.c.total_hold_ms,
+}
+
+
+def free_credentials(strategy: SchedulingStrategy) -> Select:
+    return (
+        select(credentials_table.c.id)
+        .where(
+            credentials_table.c.in_use == False,
+            or_(credentials_table.c.available_at.is_(None), credentials_table.c.available_at <= bindparam('now')),
+        )
+        .order_by(credentials_table.c.active_leases, STRATEGY_ORDERS[strategy])
+        .limit(bindparam('n'))
+    )
+
+
+FREE_STATEMENTS = {strategy: free_credentials(strategy) for strategy in STRATEGY_ORDERS}
+FREE_TAGGED_STATEMENTS = {
+    strategy: statement.where(credentials_table.c.tag == bindparam('credential_tag'))
+    for strategy, statement in FREE_STATEMENTS.items()
+}
+
+TAKE_STATEMENT = (
+    update(credentials_table)
+    .where(credentials_table.c.id.in_(bindparam('credential_ids', expanding=True)))
+    .values(
+        active_leases=credentials_table.c.active_leases + 1,
+        in_use=credentials_table.c.active_leases + 1 >= credentials_table.c.max_concurrency,
+        date_last_usage=bindparam('now'),
+        usage_count=credentials_table.c.usage_count + 1,
+    )
+    .returning(*acquired_columns)
+)
+
+next_available_at = select(func.min(credentials_table.c.available_at)).where(credentials_table.c.in_use == False)
+
+NEXT_AVAILABLE_AT_STATEMENT = next_available_at
+NEXT_AVAILABLE_AT_TAGGED_STATEMENT = next_available_at.where(
+    credentials_table.c.tag.in_(bindparam('tags', expanding=True)),
+)
+
+# By id, or by username for credentials without one.
+by_credential = or_(
+    credentials_table.c.id == bindparam('credential_id'),
+    credentials_table.c.username == bindparam('credential_username'),
+)
+
+hold_ms = func.coalesce(
+    cast(
+        (func.julianday(bindparam('now', type_=DateTime)) - func.julianday(credentials_table.c.date_last_usage))
+        * 86_400_000,
+        Integer,
+    ),
+    0,
+)
+
+# Like ``PersistentCredentialsPool``, a credential with fewer leases than released slots is left alone.
+RELEASE_STATEMENT = (
+    update(credentials_table)
+    .where(by_credential, credentials_table.c.active_leases >= bindparam('slots'))
+    .values(
+        active_leases=credentials_table.c.active_leases - bindparam('slots'),
+        in_use=False,
+        available_at=latest(bindparam('available_from', type_=DateTime), credentials_table.c.quarantined_until),
+        cookie=func.coalesce(bindparam('refreshed_cookie'), credentials_table.c.cookie),
+        # Every released slot is counted from the latest acquisition of the credential.
+        total_hold_ms=credentials_table.c.total_hold_ms + bindparam('slots') * hold_ms,
+    )
+    .returning(credentials_table.c.id)
+)
+
+REPORT_FAILURE_STATEMENT = (
+    update(credentials_table)
+    .where(by_credential)
+    .values(
+        failure_count=credentials_table.c.failure_count + 1,
+        last_failure_kind=bindparam('failure_kind'),
+    )
+    .returning(credentials_table.c.failure_count)
+)
+
+quarantine_end = bindparam('quarantine_end', type_=DateTime)
+QUARANTINE_STATEMENT = (
+    update(credentials_table)
+    .where(by_credential)
+    .values(
+        quarantined_until=quarantine_end,
+        available_at=latest(credentials_table.c.available_at, quarantine_end),
+    )
+)
+
+REPORT_SUCCESS_STATEMENT = (
+    update(credentials_table)
+    .where(by_credential)
+    .values(failure_count=0, quarantined_until=None)
+    .returning(credentials_table.c.id)
+)
+
+# The database belongs to a single process, leases left by a previous run are over.
+END_LEASES_STATEMENT = (
+    update(credentials_table).where(credentials_table.c.active_leases > 0).values(active_leases=0, in_use=False)
+)
+
+INSERT_STATEMENT = insert(credentials_table).on_conflict_do_nothing(index_elements=['username'])
+
+Operation = Callable[[Connection, datetime], object]
+
+
+class SqliteCredentialsPool(BaseCredentialsPool):
+    """Credentials pool in an SQLite database file, for a single process that keeps its state across restarts.
+
+    The file holds the ``credentials`` table of ``models.Credential`` and its indexes, created on first open,
+    and runs in WAL mode.
+    Credentials passed to the constructor are inserted unless their username is already there, so a restart only
+    opens the file. Leases don't survive a restart, usage and health state, cooldowns and cookies do.
+
+    All statements run on one connection in a dedicated writer thread. Operations submitted while it is busy are
+    queued and run together, up to ``batch_size`` of them in a single transaction, so concurrent acquires and
+    releases share one commit. When a batch fails, it's rolled back and run again with a savepoint per operation,
+    so an operation that fails is rolled back alone and the others still commit. ``statement_seconds`` times these
+    transactions. Acquire orders credentials like ``PersistentCredentialsPool`` with the same ``strategy``, and a
+    release wakes as many waiting acquires of the pool as it freed slots.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        path: Path | str,
+        credentials: Iterable[CredentialMetadata] | None = None,
+        cooldown: float | None = None,
+        batch_size: int = 256,
+        strategy: SchedulingStrategy = SchedulingStrategy.LRU,
+    ):
+        if strategy not in FREE_STATEMENTS:
+            error_message = f'The SQLite pool supports the {", ".join(FREE_STATEMENTS)} strategies, not {strategy}'
+            raise ValueError(error_message)
+        self.free_statement = FREE_STATEMENTS[strategy]
+        self.free_tagged_statement = FREE_TAGGED_STATEMENTS[strategy]
+        self.path = Path(path)
+        self.cooldown = cooldown
+        self.batch_size = batch_size
+        self.next_available_at: datetime | None = None
+        # Tags of the acquire and its waiter, resolved with the tag of the slot that woke it.
+        self.waiters: deque[tuple[tuple[str, ...] | None, asyncio.Future[str | None]]] = deque()
+        # Refreshed cookie by (id, None), or (None, username), written by the release of the credential.
+        self.pending_cookies: dict[tuple[int | None, str | None], str] = {}
+        self.closed = False
+
+        self.engine = create_engine(f'sqlite:///{self.path}', connect_args={'check_same_thread': False})
+        self.connection = self.engine.connect()
+        self._open(credentials)
+
+        self.operations: queue.SimpleQueue[tuple[Operation, asyncio.Future] | None] = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write, name=f'sqlite-writer-{self.path.name}', daemon=True)
+        self.writer.start()
+
+    async def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.operations.put(None)
+            await asyncio.to_thread(self.writer.join)
+
+    async def _acquire(self, tags: tuple[str, ...] | None) -> CredentialMetadata | None:
+        credentials = await self._take(1, 1, tags)
+        return credentials[0] if credentials else None
+
+    async def _acquire_many(self, n: int, min_n: int, tags: tuple[str, ...] | None) -> list[CredentialMetadata]:
+        return await self._take(n, min_n, tags)
+
+    async def _release(self, credential: CredentialMetadata) -> None:
+        await self._release_many([credential])
+
+    async def _release_many(self, credentials: list[CredentialMetadata]) -> None:
+        # Several slots of the same credential are released with a single row update.
+        slots = Counter(self._credential_key(credential) for credential in credentials)
+        cookies = {key: self.pending_cookies[key] for key in slots if key in self.pending_cookies}
+
+        released_count = await self._submit(partial(self._release_rows, slots=slots, cookies=cookies))
+        # Refreshed cookies are only dropped once written, a failed release leaves them for the next one.
+        for key, cookie in cookies.items():
+            if self.pending_cookies.get(key) == cookie:
+                del self.pending_cookies[key]
+        for tag, count in Counter(credential.tag for credential in credentials).items():
+            if self.cooldown:
+                asyncio.get_running_loop().call_later(self.cooldown, self._wake, count, tag)
+            else:
+                self._wake(count, tag)
+
+        if released_count < len(slots):
+            error_message = f'Only {released_count} of {len(slots)} credentials were found leased to release'
+            raise CredentialNotFoundError(error_message)
+
+    async def _save_cookies(self, credentials: list[CredentialMetadata]) -> None:
+        for credential in credentials:
+            self.pending_cookies[self._credential_key(credential)] = credential.cookie
+
+    async def _report_failure(self, credential: CredentialMetadata, kind: FailureKind) -> None:
+        failure_count = await self._submit(
+            partial(self._count_failure, key=self._credential_key(credential), kind=kind),
+        )
+        if failure_count is None:
+            error_message = f'Credential {credential.username} is not in the database'
+            raise CredentialNotFoundError(error_message)
+        credential.failure_count = failure_count
+
+    async def _report_success(self, credential: CredentialMetadata) -> None:
+        # Most uses succeed, only a credential that failed since it was acquired costs a write.
+        if not credential.failure_count:
+            return
+        if not await self._submit(partial(self._reset_failures, key=self._credential_key(credential))):
+            error_message = f'Credential {credential.username} is not in the database'
+            raise CredentialNotFoundError(error_message)
+        credential.failure_count = 0
+
+    async def _wait_before_retry(self, wait_seconds: float, tags: tuple[str, ...] | None) -> None:
+        now = datetime.utcnow()
+        if self.next_available_at is not None and self.next_available_at > now:
+            wait_seconds = min(wait_seconds, (self.next_available_at - now).total_seconds())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append((tags, waiter))
+        try:
+            async with asyncio.timeout(wait_seconds):
+                await waiter
+        except TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._wake(1, waiter.result())
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                waiter.cancel()
+                with suppress(ValueError):
+                    self.waiters.remove((tags, waiter))
+
+    async def _take(self, n: int, min_n: int, tags: tuple[str, ...] | None) -> list[CredentialMetadata]:
+        future = self._enqueue(partial(self._take_rows, n=n, min_n=min_n, tags=tags))
+        try:
+            rows, self.next_available_at = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The transaction takes the credentials anyway, give them back once it's done.
+            future.add_done_callback(self._give_back)
+            raise
+        return [CredentialMetadata(**row) for row in rows]
+
+    def _give_back(self, future: asyncio.Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        rows, _ = future.result()
+        if rows:
+            slots = Counter((row['id'], None) for row in rows)
+            self._enqueue(partial(self._release_rows, slots=slots, cookies={})).add_done_callback(self._log_failure)
+
+    def _wake(self, count: int, tag: str | None) -> None:
+        """Wake the first ``count`` waiters that can take a slot tagged ``tag``, in the order they started waiting."""
+        while self.waiters and self.waiters[0][1].done():
+            self.waiters.popleft()
+
+        index = 0
+        while count and index < len(self.waiters):
+            tags, waiter = self.waiters[index]
+            if not waiter.done() and (tags is None or tag in tags):
+                del self.waiters[index]
+                waiter.set_result(tag)
+                count -= 1
+            else:
+                index += 1
+
+    async def _submit(self, operation: Operation) -> object:
+        return await asyncio.shield(self._enqueue(operation))
+
+    def _enqueue(self, operation: Operation) -> asyncio.Future:
+        if self.closed:
+            error_message = f'SQLite pool {self.path} is closed'
+            raise RuntimeError(error_message)
+        future = asyncio.get_running_loop().create_future()
+        self.operations.put((operation, future))
+        return future
+
+    def _open(self, credentials: Iterable[CredentialMetadata] | None) -> None:
+        self.connection.exec_driver_sql('PRAGMA journal_mode=WAL')
+        # With WAL, a commit is durable across crashes of the process and only waits for fsync at checkpoints.
+        self.connection.exec_driver_sql('PRAGMA synchronous=NORMAL')
+        self.connection.exec_driver_sql(CREATE_TABLE)
+        columns = {row.name for row in self.connection.exec_driver_sql('PRAGMA table_info(credentials)')}
+        for column, add_column in ADD_COLUMNS.items():
+            if column not in columns:
+                self.connection.exec_driver_sql(add_column)
+        for create_index in CREATE_INDEXES:
+            self.connection.exec_driver_sql(create_index)
+        self.connection.execute(END_LEASES_STATEMENT)
+
+        rows = (
+            {
+                'username': credential.username,
+                'password': credential.password,
+                'cookie': credential.cookie,
+                'max_concurrency': credential.max_concurrency,
+                'tag': credential.tag,
+            }
+            for credential in credentials or ()
+        )
+        while batch := list(islice(rows, INSERT_BATCH_SIZE)):
+            self.connection.execute(INSERT_STATEMENT, batch)
+        self.connection.commit()
+
+    def _write(self) -> None:
+        """Body of the writer thread: runs the queued operations in batches until ``close``."""
+        stopping = False
+        while not stopping:
+            batch = [self.operations.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.operations.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = None in batch
+            operations = [operation for operation in batch if operation is not None]
+            if operations:
+                self._run_batch(operations)
+
+        self.connection.close()
+        self.engine.dispose()
+
+    def _run_batch(self, operations: list[tuple[Operation, asyncio.Future]]) -> None:
+        started_at = time.perf_counter()
+        now = datetime.utcnow()
+        try:
+            results = [(operation(self.connection, now), None) for operation, _ in operations]
+            self.connection.commit()
+        except Exception:  # noqa: BLE001
+            self.connection.rollback()
+            results = self._run_isolated(operations, now)
+
+        loop = operations[0][1].get_loop()
+        loop.call_soon_threadsafe(self._resolve, operations, results, time.perf_counter() - started_at)
+
+    def _run_isolated(
+        self,
+        operations: list[tuple[Operation, asyncio.Future]],
+        now: datetime,
+    ) -> list[tuple[object, Exception | None]]:
+        """Run a failed batch again with a savepoint per operation, so that only the failing ones fail."""
+        results: list[tuple[object, Exception | None]] = []
+        try:
+            for operation, _ in operations:
+                savepoint = self.connection.begin_nested()
+                try:
+                    result = operation(self.connection, now)
+                except Exception as error:  # noqa: BLE001
+                    savepoint.rollback()
+                    results.append((None, error))
+                else:
+                    savepoint.commit()
+                    results.append((result, None))
+            self.connection.commit()
+        except Exception as error:  # noqa: BLE001
+            self.connection.rollback()
+            return [(None, error)] * len(operations)
+        return results
+
+    def _resolve(
+        self,
+        operations: list[tuple[Operation, asyncio.Future]],
+        results: list[tuple[object, Exception | None]],
+        elapsed: float,
+    ) -> None:
+        self.metrics.statement_seconds.observe(elapsed)
+        for (_, future), (result, error) in zip(operations, results, strict=True):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _take_rows(  # noqa: PLR0913
+        self,
+        connection: Connection,
+        now: datetime,
+        n: int,
+        min_n: int,
+        tags: tuple[str, ...] | None,
+    ) -> tuple[list[RowMapping], datetime | None]:
+        """The taken rows, or none and when the next cooling credential frees up."""
+        if tags is None:
+            attempts = [(self.free_statement, {'now': now, 'n': n})]
+        else:
+            attempts = [(self.free_tagged_statement, {'now': now, 'n': n, 'credential_tag': tag}) for tag in tags]
+
+        for statement, parameters in attempts:
+            credential_ids = connection.execute(statement, parameters).scalars().all()
+            if len(credential_ids) >= min_n:
+                rows = connection.execute(TAKE_STATEMENT, {'credential_ids': credential_ids, 'now': now})
+                return [dict(row) for row in rows.mappings()], None
+
+        if tags is None:
+            return [], connection.execute(NEXT_AVAILABLE_AT_STATEMENT).scalar()
+        return [], connection.execute(NEXT_AVAILABLE_AT_TAGGED_STATEMENT, {'tags': list(tags)}).scalar()
+
+    def _release_rows(
+        self,
+        connection: Connection,
+        now: datetime,
+        slots: Counter[tuple[int | None, str | None]],
+        cookies: dict[tuple[int | None, str | None], str],
+    ) -> int:
+        available_from = None if self.cooldown is None else now + timedelta(seconds=self.cooldown)
+        released_count = 0
+        for key, count in slots.items():
+            parameters = self._key_parameters(key) | {
+                'slots': count,
+                'available_from': available_from,
+                'refreshed_cookie': cookies.get(key),
+                'now': now,
+            }
+            released_count += len(connection.execute(RELEASE_STATEMENT, parameters).all())
+        return released_count
+
+    def _count_failure(
+        self,
+        connection: Connection,
+        now: datetime,
+        key: tuple[int | None, str | None],
+        kind: FailureKind,
+    ) -> int | None:
+        parameters = self._key_parameters(key)
+        failure_count = connection.execute(
+            REPORT_FAILURE_STATEMENT,
+            parameters | {'failure_kind': str(kind)},
+        ).scalar()
+        if failure_count is None:
+            return None
+
+        quarantined_until = now + timedelta(seconds=quarantine_seconds(kind, failure_count))
+        connection.execute(QUARANTINE_STATEMENT, parameters | {'quarantine_end': quarantined_until})
+        return failure_count
+
+    def _reset_failures(self, connection: Connection, _now: datetime, key: tuple[int | None, str | None]) -> bool:
+        return bool(connection.execute(REPORT_SUCCESS_STATEMENT, self._key_parameters(key)).all())
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            LOGGER.error('Failed to give back credentials of a cancelled acquire', exc_info=future.exception())
+
+    @staticmethod
+    def _credential_key(credential: CredentialMetadata) -> tuple[int | None, str | None]:
+        return (credential.id, None) if credential.id is not None else (None, credential.username)
+
+    @staticmethod
+    def _key_parameters(key: tuple[int | None, str | None]) -> dict:
+        credential_id, username = key
+        return {'credential_id': credential_id, 'credential_username': username}
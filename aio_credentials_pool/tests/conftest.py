@@ -6,7 +6,18 @@ import pytest
 tests_directory = Path(__file__).resolve().parent
 sys.path.insert(0, str(tests_directory.parent))
 
+from tracing import TRACER  # noqa: E402
+
 
 @pytest.fixture(scope='session')
 def database_name() -> str:
     return 'test'
+
+
+@pytest.fixture()
+def tracer():
+    TRACER.clear()
+    TRACER.enabled = True
+    yield TRACER
+    TRACER.enabled = False
+    TRACER.clear()
@@ -0,0 +1,47 @@
+import pytest
+
+from benchmark import BenchmarkConfig, create_pool, credentials, percentile, run_benchmark
+from credentials_store import CompactCredentialsStore
+from in_memory_credentials_pool import InMemoryCredentialsPool
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 1001)]
+
+    assert percentile(values, 0.5) == 500
+    assert percentile(values, 0.999) == 999
+    assert percentile([], 0.5) is None
+
+
+@pytest.mark.asyncio()
+async def test_run_benchmark_against_in_memory_pool():
+    config = BenchmarkConfig(workers=8, pool_size=4, duration=0.2, hold_time='constant', hold_mean=0.001, seed=0)
+    result = await run_benchmark(InMemoryCredentialsPool(credentials(config.pool_size)), config)
+
+    assert result['acquisitions'] > 0
+    assert result['failures'] == 0
+    assert result['statements_per_acquisition'] == 0
+    assert result['acquire_latency_seconds']['p50'] <= result['acquire_latency_seconds']['p999']
+    assert 0.9 < result['usage']['fairness'] <= 1
+
+
+@pytest.mark.asyncio()
+async def test_compact_pool_takes_less_memory_per_credential():
+    pool, memory = await create_pool('in_memory', 10000)
+    compact_pool, compact_memory = await create_pool('compact', 10000)
+
+    assert isinstance(compact_pool.credentials, CompactCredentialsStore)
+    assert 0 < compact_memory < memory / 2
+
+
+@pytest.mark.asyncio()
+async def test_sqlite_pool_batches_operations_into_transactions():
+    config = BenchmarkConfig(workers=16, pool_size=8, duration=0.2, hold_time='constant', hold_mean=0.001, seed=0)
+    pool, _ = await create_pool('sqlite', config.pool_size)
+    try:
+        result = await run_benchmark(pool, config)
+    finally:
+        await pool.close()
+
+    assert result['acquisitions'] > 0
+    assert result['statements_per_acquisition'] < 2
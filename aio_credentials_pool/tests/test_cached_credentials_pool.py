@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from base_credentials_pool import CredentialMetadata, CredentialNotFoundError, FailureKind, NoAvailableCredentialsError
+from cached_credentials_pool import CachedCredentialsPool
+from in_memory_credentials_pool import InMemoryCredentialsPool
+
+
+@pytest.fixture()
+def source_pool():
+    return InMemoryCredentialsPool([CredentialMetadata(f'user{i}', f'pass{i}', None) for i in range(10)])
+
+
+@pytest_asyncio.fixture()
+async def credentials_pool(source_pool):
+    pool = CachedCredentialsPool(source_pool, batch_size=4, low_watermark=1, high_watermark=5)
+    yield pool
+    await pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_acquire_reserves_batch_from_source(source_pool, credentials_pool):
+    credential = await credentials_pool.acquire(max_retries=0)
+
+    assert credential.username == 'user0'
+    assert len(source_pool.credentials) == 6
+    assert len(credentials_pool.credentials) == 3
+
+
+@pytest.mark.asyncio()
+async def test_surplus_is_returned_to_source(source_pool, credentials_pool):
+    acquired_credentials = [await credentials_pool.acquire(max_retries=0) for _ in range(8)]
+    assert len(source_pool.credentials) + len(credentials_pool.credentials) == 2
+
+    await credentials_pool.release_many(acquired_credentials)
+
+    assert len(credentials_pool.credentials) <= credentials_pool.high_watermark
+    assert len(source_pool.credentials) + len(credentials_pool.credentials) == 10
+
+
+@pytest.mark.asyncio()
+async def test_failed_surplus_return_keeps_the_surplus_locally(source_pool, credentials_pool, monkeypatch):
+    async def fail_release_many(*_):
+        raise CredentialNotFoundError
+
+    acquired_credentials = [await credentials_pool.acquire(max_retries=0) for _ in range(8)]
+    monkeypatch.setattr(source_pool, 'release_many', fail_release_many)
+
+    await credentials_pool.release_many(acquired_credentials)
+
+    assert len(source_pool.credentials) + len(credentials_pool.credentials) == 10
+    monkeypatch.undo()
+    await credentials_pool.close()
+    assert len(source_pool.credentials) == 10
+
+
+@pytest.mark.asyncio()
+async def test_close_flushes_free_credentials_to_source(source_pool, credentials_pool):
+    credential = await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.close()
+    assert len(source_pool.credentials) == 9
+
+    await credentials_pool.release(credential)
+    assert len(source_pool.credentials) == 10
+
+
+@pytest.mark.asyncio()
+async def test_waiter_is_served_once_source_has_credentials(source_pool, credentials_pool):
+    acquired_credentials = await source_pool.acquire_many(10)
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0)
+
+    waiter = asyncio.create_task(credentials_pool.acquire(timeout=3))
+    await asyncio.sleep(0.1)
+    await source_pool.release(acquired_credentials[0])
+
+    assert await waiter == acquired_credentials[0]
+
+
+@pytest.mark.asyncio()
+async def test_failures_are_reported_to_source(source_pool, credentials_pool):
+    credential = await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.report_failure(credential, FailureKind.BANNED)
+    await credentials_pool.release(credential)
+
+    assert source_pool.failure_counts == {credential.username: 1}
+    assert all(acquired.username != credential.username for acquired in await credentials_pool.acquire_many(3))
+
+    # The source quarantines the credential returned on close.
+    await credentials_pool.close()
+    assert [resting.username for _, _, resting in source_pool.cooling] == [credential.username]
+
+    await credentials_pool.report_success(credential)
+    assert not source_pool.failure_counts
+
+
+@pytest.mark.asyncio()
+async def test_refreshed_cookies_are_saved_to_source_on_return(source_pool, credentials_pool):
+    credential = await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.release(credential, cookie='fresh')
+    assert credentials_pool.refreshed_cookies == {credential.username: 'fresh'}
+
+    await credentials_pool.close()
+    assert not credentials_pool.refreshed_cookies
+    source_credentials = await source_pool.acquire_many(10)
+    assert {source.username: source.cookie for source in source_credentials}[credential.username] == 'fresh'
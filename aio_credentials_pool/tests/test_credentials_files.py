@@ -0,0 +1,66 @@
+import io
+import json
+
+import pytest
+
+from base_credentials_pool import NoAvailableCredentialsError
+from credentials_files import CredentialsFormat, iter_credentials, iter_json_array
+from in_memory_credentials_pool import InMemoryCredentialsPool
+
+CREDENTIALS = [
+    {'username': 'user1', 'password': 'pass1', 'cookie': None},
+    {'username': 'user2', 'password': 'pa"ss, [2]', 'cookie': 'cookie2', 'max_concurrency': 2, 'tag': 'site-a'},
+    {'username': 'user3', 'password': 'pass3', 'cookie': '', 'max_concurrency': 12345},
+]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 16])
+def test_json_array_is_parsed_in_chunks(chunk_size):
+    file = io.StringIO(json.dumps(CREDENTIALS, indent=4))
+    assert list(iter_json_array(file, chunk_size)) == CREDENTIALS
+    assert list(iter_json_array(io.StringIO(' [ ] '), chunk_size)) == []
+
+
+def test_malformed_json_array_is_rejected():
+    with pytest.raises(ValueError, match='JSON array'):
+        list(iter_json_array(io.StringIO('{"username": "user1"}')))
+    with pytest.raises(ValueError, match='after an item'):
+        list(iter_json_array(io.StringIO('[{"username": "user1"} {"username": "user2"}]')))
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array(io.StringIO('[{"username": "user1"'), chunk_size=4))
+
+
+def test_every_format_yields_the_same_records(tmp_path):
+    (tmp_path / 'credentials.json').write_text(json.dumps(CREDENTIALS))
+    (tmp_path / 'credentials.jsonl').write_text('\n'.join(json.dumps(credential) for credential in CREDENTIALS) + '\n')
+    (tmp_path / 'credentials.txt').write_text(
+        'username,password,cookie,max_concurrency,tag\n'
+        'user1,pass1,,,\n'
+        'user2,"pa""ss, [2]",cookie2,2,site-a\n'
+        'user3,pass3,,12345,\n',
+    )
+
+    expected = list(iter_credentials(tmp_path / 'credentials.json'))
+    assert expected[1] == {
+        'username': 'user2',
+        'password': 'pa"ss, [2]',
+        'cookie': 'cookie2',
+        'max_concurrency': 2,
+        'tag': 'site-a',
+    }
+    assert expected[2]['cookie'] is None
+    assert list(iter_credentials(tmp_path / 'credentials.jsonl')) == expected
+    assert list(iter_credentials(tmp_path / 'credentials.txt', CredentialsFormat.CSV)) == expected
+
+
+@pytest.mark.asyncio()
+async def test_in_memory_pool_from_file(tmp_path):
+    path = tmp_path / 'credentials.jsonl'
+    path.write_text('\n'.join(json.dumps(credential) for credential in CREDENTIALS[:2]))
+
+    pool = InMemoryCredentialsPool.from_file(path)
+    credentials = await pool.acquire_many(3, max_retries=0)
+    assert sorted(credential.username for credential in credentials) == ['user1', 'user2', 'user2']
+    assert {credential.tag for credential in credentials} == {None, 'site-a'}
+    with pytest.raises(NoAvailableCredentialsError):
+        await pool.acquire(max_retries=0)
@@ -0,0 +1,72 @@
+import pytest
+
+from base_credentials_pool import CredentialMetadata
+from credentials_store import (
+    CompactCredentialsStore,
+    LeastUsedCredentialsStore,
+    LruCredentialsStore,
+    RowRing,
+    StringColumn,
+    TaggedCredentialsStore,
+)
+
+
+def test_row_ring_keeps_fifo_order_while_growing():
+    ring = RowRing(range(10))
+    assert [ring.pop() for _ in range(5)] == [0, 1, 2, 3, 4]
+
+    for row in range(10, 40):
+        ring.push(row)
+
+    assert len(ring) == 35
+    assert [ring.pop() for _ in range(35)] == list(range(5, 40))
+    assert ring.pop() is None
+
+
+def test_string_column_round_trips_strings():
+    column = StringColumn(nullable=True)
+    values = ['user1', None, '', 'пароль', 'p@ss"']
+    for value in values:
+        column.append(value)
+
+    assert [column[row] for row in range(len(values))] == values
+
+
+def test_compact_store_materializes_credentials_on_pop():
+    credentials = [
+        CredentialMetadata('user1', 'pass1', None, id=7, tag='site-a'),
+        CredentialMetadata('user2', 'pass2', 'cookie2', max_concurrency=2),
+    ]
+    store = CompactCredentialsStore(credentials)
+    assert len(store) == 3
+    assert store.count(('site-a',)) == 1
+
+    popped = [store.pop(), store.pop(), store.pop()]
+    popped_usernames = sorted(credential.username for credential in popped)
+    assert popped_usernames == ['user1', 'user2', 'user2']
+    assert popped[0] == credentials[0]
+    assert store.pop() is None
+
+    for credential in popped:
+        store.push(credential)
+    store.push(CredentialMetadata('user3', 'pass3', None))
+
+    assert len(store) == 4
+    assert store.pop(('site-a',)) == credentials[0]
+
+
+@pytest.mark.parametrize('store_class', [LruCredentialsStore, LeastUsedCredentialsStore])
+def test_untagged_pop_keeps_the_order_across_tags(store_class):
+    credentials = [
+        CredentialMetadata('user1', 'pass1', None, tag='site-a'),
+        CredentialMetadata('user2', 'pass2', None, tag='site-a'),
+        CredentialMetadata('user3', 'pass3', None, tag='site-b'),
+    ]
+    store = TaggedCredentialsStore(store_class, credentials)
+    for _ in range(3):
+        store.push(store.pop(('site-b',)))
+
+    popped = [store.pop() for _ in credentials]
+
+    # Taking from the tags in turn would hand out the used user3 before the unused user2.
+    assert [credential.username for credential in popped] == ['user1', 'user2', 'user3']
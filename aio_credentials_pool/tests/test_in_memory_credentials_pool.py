@@ -2,7 +2,9 @@ import asyncio
 
 import pytest
 
-from base_credentials_pool import NoAvailableCredentialsError
+import base_credentials_pool
+from base_credentials_pool import FailureKind, NoAvailableCredentialsError
+from credentials_store import SchedulingStrategy
 from in_memory_credentials_pool import (
     CredentialMetadata,
     InMemoryCredentialsPool,
@@ -54,3 +56,364 @@ async def test_no_available_credentials(credentials):
     no_available_count = sum(isinstance(result, NoAvailableCredentialsError) for result in results)
 
     assert no_available_count >= 1, 'Expected one or more NoAvailableCredentialsError exceptions'
+
+
+@pytest.mark.asyncio()
+async def test_release_hands_credential_to_waiter(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials[:1])
+    acquired_credential = await credentials_pool.acquire()
+
+    waiter = asyncio.create_task(credentials_pool.acquire(timeout=5))
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+
+    loop = asyncio.get_running_loop()
+    released_at = loop.time()
+    await credentials_pool.release(acquired_credential)
+
+    assert await waiter == acquired_credential
+    assert loop.time() - released_at < 0.1
+
+
+@pytest.mark.asyncio()
+async def test_waiters_are_served_in_fifo_order(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials[:1])
+    acquired_credential = await credentials_pool.acquire()
+
+    order = []
+
+    async def acquire_and_release(worker_id: int):
+        credential = await credentials_pool.acquire(timeout=5)
+        order.append(worker_id)
+        await credentials_pool.release(credential)
+
+    tasks = []
+    for worker_id in range(5):
+        tasks.append(asyncio.create_task(acquire_and_release(worker_id)))
+        await asyncio.sleep(0)
+
+    await credentials_pool.release(acquired_credential)
+    await asyncio.gather(*tasks)
+
+    assert order == list(range(5))
+
+
+@pytest.mark.asyncio()
+async def test_acquire_timeout_leaves_no_waiter_behind(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials[:1])
+    acquired_credential = await credentials_pool.acquire()
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(timeout=0.05)
+
+    cancelled_waiter = asyncio.create_task(credentials_pool.acquire(timeout=5))
+    await asyncio.sleep(0.01)
+    cancelled_waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled_waiter
+
+    assert not credentials_pool.waiters
+
+    await credentials_pool.release(acquired_credential)
+    assert await credentials_pool.acquire(max_retries=0) == acquired_credential
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.asyncio()
+async def test_fifo_strategy_hands_out_in_release_order(credentials, compact):
+    credentials_pool = InMemoryCredentialsPool(credentials, strategy=SchedulingStrategy.FIFO, compact=compact)
+
+    first = await credentials_pool.acquire()
+    second = await credentials_pool.acquire()
+    await credentials_pool.release(second)
+    await credentials_pool.release(first)
+
+    acquired = [await credentials_pool.acquire() for _ in credentials]
+
+    assert [credential.username for credential in acquired] == ['user3', 'user2', 'user1']
+
+
+@pytest.mark.asyncio()
+async def test_lru_strategy_hands_out_least_recently_used_first(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials, strategy=SchedulingStrategy.LRU)
+
+    first = await credentials_pool.acquire()
+    second = await credentials_pool.acquire()
+    await credentials_pool.release(second)
+    await credentials_pool.release(first)
+
+    acquired = [await credentials_pool.acquire() for _ in credentials]
+
+    assert [credential.username for credential in acquired] == ['user3', 'user1', 'user2']
+
+
+async def hand_over_to_waiters(credentials_pool: InMemoryCredentialsPool, credential: CredentialMetadata, times: int):
+    """Release ``credential`` to a waiting acquire ``times`` times, it never goes back to the store."""
+    for _ in range(times):
+        waiting = asyncio.create_task(credentials_pool.acquire(max_retries=1, min_wait=1))
+        await asyncio.sleep(0)
+        await credentials_pool.release(credential)
+        credential = await waiting
+    return credential
+
+
+@pytest.mark.asyncio()
+async def test_lru_strategy_counts_credentials_handed_to_waiters(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials[:2], strategy=SchedulingStrategy.LRU)
+
+    first, second = [await credentials_pool.acquire() for _ in range(2)]
+    first = await hand_over_to_waiters(credentials_pool, first, 3)
+    await credentials_pool.release(first)
+    await credentials_pool.release(second)
+
+    # user1 was used last by the waiters, even though it was first out of the store.
+    assert (await credentials_pool.acquire()).username == 'user2'
+
+
+@pytest.mark.asyncio()
+async def test_least_used_strategy_hands_out_least_used_first(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials, strategy=SchedulingStrategy.LEAST_USED)
+
+    first = await credentials_pool.acquire()
+    for _ in range(3):
+        await credentials_pool.release(await credentials_pool.acquire())
+    await credentials_pool.release(first)
+
+    acquired = [await credentials_pool.acquire() for _ in credentials]
+
+    # user2 was used twice, LRU would hand it out before user1.
+    assert [credential.username for credential in acquired] == ['user3', 'user1', 'user2']
+
+
+@pytest.mark.asyncio()
+async def test_least_used_strategy_counts_credentials_handed_to_waiters(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials[:2], strategy=SchedulingStrategy.LEAST_USED)
+
+    first, second = [await credentials_pool.acquire() for _ in range(2)]
+    first = await hand_over_to_waiters(credentials_pool, first, 10)
+    await credentials_pool.release(first)
+    await credentials_pool.release(second)
+
+    # user1 was used 11 times, user2 once.
+    assert (await credentials_pool.acquire()).username == 'user2'
+
+
+@pytest.mark.asyncio()
+async def test_least_held_strategy_hands_out_least_held_first(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials, strategy=SchedulingStrategy.LEAST_HELD)
+
+    first, second, third = [await credentials_pool.acquire() for _ in credentials]
+    await credentials_pool.release(second)
+    await asyncio.sleep(0.02)
+    await credentials_pool.release(first)
+    await asyncio.sleep(0.02)
+    await credentials_pool.release(third)
+
+    acquired = [await credentials_pool.acquire() for _ in credentials]
+
+    assert [credential.username for credential in acquired] == ['user2', 'user1', 'user3']
+
+
+@pytest.mark.asyncio()
+async def test_acquiring_and_releasing_many_credentials(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials)
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire_many(4, max_retries=0)
+
+    acquired_credentials = await credentials_pool.acquire_many(2)
+    assert [credential.username for credential in acquired_credentials] == ['user1', 'user2']
+
+    assert len(await credentials_pool.acquire_many(5, min_n=1)) == 1
+
+    waiter = asyncio.create_task(credentials_pool.acquire(timeout=1))
+    await asyncio.sleep(0)
+    await credentials_pool.release_many(acquired_credentials)
+
+    assert await waiter == acquired_credentials[0]
+    assert await credentials_pool.acquire(max_retries=0) == acquired_credentials[1]
+
+
+@pytest.mark.asyncio()
+async def test_lease_releases_credential_exactly_once(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials[:1])
+
+    lease = credentials_pool.lease()
+    async with lease as credential:
+        await lease.release()
+        await lease.release()
+        assert await credentials_pool.acquire(max_retries=0) == credential
+        await credentials_pool.release(credential)
+
+    assert len(credentials_pool.credentials) == 1
+
+
+@pytest.mark.asyncio()
+async def test_lease_releases_credential_when_cancelled(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials[:1])
+    entered = asyncio.Event()
+
+    async def hold_forever():
+        async with credentials_pool.lease():
+            entered.set()
+            await asyncio.sleep(10)
+
+    task = asyncio.create_task(hold_forever())
+    await entered.wait()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert len(credentials_pool.credentials) == 1
+
+
+@pytest.mark.asyncio()
+async def test_released_credential_cools_down_before_reuse(credentials):
+    credentials_pool = InMemoryCredentialsPool(credentials[:1], cooldown=0.2)
+    credential = await credentials_pool.acquire()
+    await credentials_pool.release(credential)
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0)
+
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+
+    assert await credentials_pool.acquire(timeout=1) == credential
+    assert 0.1 < loop.time() - started_at < 0.5
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.asyncio()
+async def test_credential_is_leased_up_to_max_concurrency(credentials, compact):
+    for credential in credentials[:2]:
+        credential.max_concurrency = 2
+    credentials_pool = InMemoryCredentialsPool(credentials[:2], compact=compact)
+
+    first_credentials = [await credentials_pool.acquire(max_retries=0) for _ in range(2)]
+    assert {credential.username for credential in first_credentials} == {'user1', 'user2'}
+
+    second_credentials = [await credentials_pool.acquire(max_retries=0) for _ in range(2)]
+    assert {credential.username for credential in second_credentials} == {'user1', 'user2'}
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0)
+
+    await credentials_pool.release(first_credentials[0])
+    assert await credentials_pool.acquire(max_retries=0) == first_credentials[0]
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.asyncio()
+async def test_holders_of_one_credential_get_objects_of_their_own(credentials, compact):
+    credentials[0].max_concurrency = 2
+    credentials_pool = InMemoryCredentialsPool(credentials[:1], compact=compact)
+
+    first, second = [await credentials_pool.acquire(max_retries=0) for _ in range(2)]
+    assert first is not second
+    await credentials_pool.release(first, cookie='cookie1b')
+    assert second.cookie == 'cookie1'
+
+    # The slot released with the stale cookie is handed out with the refreshed one.
+    await credentials_pool.release(second)
+    first, second = [await credentials_pool.acquire(max_retries=0) for _ in range(2)]
+    assert [first.cookie, second.cookie] == ['cookie1b', 'cookie1b']
+
+    await credentials_pool.report_failure(first)
+    assert (first.failure_count, second.failure_count) == (1, 0)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.asyncio()
+async def test_acquiring_credentials_by_tags(credentials, compact):
+    credentials[0].tag = 'site-a'
+    credentials[1].tag = credentials[2].tag = 'site-b'
+    credentials_pool = InMemoryCredentialsPool(credentials, compact=compact)
+
+    assert await credentials_pool.acquire(max_retries=0, tags=['site-a']) == credentials[0]
+    assert len(await credentials_pool.acquire_many(3, min_n=1, max_retries=0, tags=['site-a', 'site-b'])) == 2
+
+    waiter = asyncio.create_task(credentials_pool.acquire(tags=['site-a'], timeout=1))
+    await asyncio.sleep(0)
+    await credentials_pool.release(credentials[1])
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    await credentials_pool.release(credentials[0])
+    assert await waiter == credentials[0]
+    assert await credentials_pool.acquire(max_retries=0) == credentials[1]
+
+
+def test_compact_store_only_supports_fifo(credentials):
+    with pytest.raises(ValueError, match='fifo'):
+        InMemoryCredentialsPool(credentials, strategy=SchedulingStrategy.LRU, compact=True)
+
+
+@pytest.mark.asyncio()
+async def test_retries_are_jittered_and_adapt_to_the_miss_rate(credentials, mocker):
+    credentials_pool = InMemoryCredentialsPool(credentials)
+    wait_before_retry = mocker.patch.object(credentials_pool, '_wait_before_retry')
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire_many(4, max_retries=20, min_wait=1, max_wait=8)
+
+    waits = [call.args[0] for call in wait_before_retry.call_args_list]
+    assert len(waits) == 20
+    assert all(1 <= wait <= 8 for wait in waits)
+    assert len(set(waits)) > 1
+
+    credentials_pool.miss_rate = 0.0
+    assert all(1 <= credentials_pool._backoff(2, 1, 32) <= 3 for _ in range(100))  # noqa: SLF001
+    credentials_pool.miss_rate = 1.0
+    assert max(credentials_pool._backoff(2, 1, 32) for _ in range(100)) > 3  # noqa: SLF001
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.asyncio()
+async def test_failed_credential_is_quarantined_exponentially(credentials, compact, monkeypatch):
+    monkeypatch.setitem(base_credentials_pool.QUARANTINE_SECONDS, FailureKind.RATE_LIMITED, 0.1)
+    credentials_pool = InMemoryCredentialsPool(credentials[:2], compact=compact)
+    loop = asyncio.get_running_loop()
+
+    credential = await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.report_failure(credential, FailureKind.RATE_LIMITED)
+    await credentials_pool.release(credential)
+    assert credential.failure_count == 1
+    assert (await credentials_pool.acquire(max_retries=0)).username == 'user2'
+
+    started_at = loop.time()
+    credential = await credentials_pool.acquire(timeout=1)
+    assert credential.username == 'user1'
+    assert 0.05 < loop.time() - started_at < 0.2
+
+    # Reported after the release, acquire skips the free slot instead.
+    await credentials_pool.release(credential)
+    await credentials_pool.report_failure(credential, FailureKind.RATE_LIMITED)
+    assert credential.failure_count == 2
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0)
+
+    started_at = loop.time()
+    credential = await credentials_pool.acquire(timeout=1)
+    assert 0.15 < loop.time() - started_at < 0.3
+    assert credential.failure_count == 2
+
+    await credentials_pool.report_success(credential)
+    await credentials_pool.report_failure(credential, FailureKind.RATE_LIMITED)
+    assert credential.failure_count == 1
+    assert credentials_pool.stats()['reported_failures_total'] == 3
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.asyncio()
+async def test_released_cookie_is_handed_to_the_next_holder(credentials, compact):
+    credentials_pool = InMemoryCredentialsPool(credentials[:2], compact=compact)
+
+    credential = await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.release(credential, cookie='cookie1b')
+    acquired_credentials = await credentials_pool.acquire_many(2, max_retries=0)
+    assert [credential.cookie for credential in acquired_credentials] == ['cookie2', 'cookie1b']
+
+    await credentials_pool.release_many(acquired_credentials, cookies=['cookie2b', None])
+    acquired_credentials = await credentials_pool.acquire_many(2, max_retries=0)
+    assert [credential.cookie for credential in acquired_credentials] == ['cookie2b', 'cookie1b']
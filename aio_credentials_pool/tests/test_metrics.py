@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from base_credentials_pool import CredentialMetadata, NoAvailableCredentialsError
+from in_memory_credentials_pool import InMemoryCredentialsPool
+from metrics import Histogram, MetricsRegistry, PoolMetrics, start_metrics_server
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(1) == float('inf')
+    assert list(histogram.samples())[:3] == [
+        ('test_seconds_bucket', {'le': '0.1'}, 2),
+        ('test_seconds_bucket', {'le': '1'}, 3),
+        ('test_seconds_bucket', {'le': '+Inf'}, 4),
+    ]
+
+
+@pytest.mark.asyncio()
+async def test_pool_stats():
+    credentials_pool = InMemoryCredentialsPool([CredentialMetadata('user1', 'pass1', None)])
+
+    credential = await credentials_pool.acquire(max_retries=0)
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.release(credential)
+
+    stats = credentials_pool.stats()
+    assert stats['acquisitions_total'] == 1
+    assert stats['releases_total'] == 1
+    assert stats['misses_total'] == 1
+    assert stats['failures_total'] == 1
+    assert stats['in_use'] == 0
+    assert stats['free'] == 1
+    assert stats['acquire_seconds']['count'] == 1
+    assert stats['hold_seconds']['count'] == 1
+
+
+@pytest.mark.asyncio()
+async def test_metrics_endpoint_serves_prometheus_text():
+    registry = MetricsRegistry()
+    pool_metrics = PoolMetrics('TestPool', free=lambda: 3, registry=registry)
+    pool_metrics.acquisitions.inc()
+
+    server = await start_metrics_server(port=0, registry=registry)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = (await reader.read()).decode()
+        writer.close()
+    finally:
+        server.close()
+
+    assert response.startswith('HTTP/1.1 200 OK')
+    assert '# TYPE credentials_pool_acquisitions_total counter' in response
+    assert 'credentials_pool_acquisitions_total{pool="TestPool"} 1' in response
+    assert 'credentials_pool_free{pool="TestPool"} 3' in response
@@ -1,15 +1,26 @@
 import asyncio
 import logging
+import time
+from datetime import datetime, timedelta
 
 import asyncpg
 import pytest
 import pytest_asyncio
-from sqlalchemy import make_url
+from sqlalchemy import make_url, select
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 
-from base_credentials_pool import CredentialMetadata, NoAvailableCredentialsError
+import base_credentials_pool
+from asyncpg_credentials_pool import AsyncpgCredentialsPool
+from base_credentials_pool import CredentialMetadata, FailureKind, NoAvailableCredentialsError
+from credentials_store import SchedulingStrategy
+from import_credentials import import_credentials
 from models import Base, Credential
-from persistent_credentials_pool import CredentialNotFoundError, NoCredentialsAtDatabaseError, PersistentCredentialsPool
+from persistent_credentials_pool import (
+    SAVE_COOKIES_STATEMENT,
+    CredentialNotFoundError,
+    NoCredentialsAtDatabaseError,
+    PersistentCredentialsPool,
+)
 from settings import POSTGRES_URL
 
 
@@ -49,16 +60,26 @@ async def db_session(engine, schema_manager, mocker):  # noqa: ARG001
     yield async_session
 
 
+@pytest.fixture(params=[PersistentCredentialsPool, AsyncpgCredentialsPool])
+def pool_class(request):
+    return request.param
+
+
+@pytest_asyncio.fixture()
+async def credentials_pool(pool_class, db_session):  # noqa: ARG001
+    pool = pool_class()
+    yield pool
+    await pool.close()
+
+
 @pytest.mark.asyncio()
-async def test_acquiring_single_credential_without_retries(db_session):
+async def test_acquiring_single_credential_without_retries(db_session, credentials_pool):
     single_credential = Credential(username='test_user3', password='pass1', in_use=False)
 
     async with db_session() as session:
         session.add(single_credential)
         await session.commit()
 
-    credentials_pool = PersistentCredentialsPool()
-
     num_workers = 10
     tasks = [credentials_pool.acquire(max_retries=0) for _ in range(num_workers)]
 
@@ -86,7 +107,7 @@ async def test_acquiring_single_credential_without_retries(db_session):
 
 
 @pytest.mark.asyncio()
-async def test_acquiring_single_credential_with_retries(db_session):
+async def test_acquiring_single_credential_with_retries(db_session, credentials_pool):
     async def acquire_and_release(pool: PersistentCredentialsPool) -> None:
         credential = await pool.acquire(max_retries=5, min_wait=0.05)
         await asyncio.sleep(0.01)
@@ -98,8 +119,6 @@ async def test_acquiring_single_credential_with_retries(db_session):
         session.add(single_credential)
         await session.commit()
 
-    credentials_pool = PersistentCredentialsPool()
-
     num_workers = 3
     tasks = [acquire_and_release(credentials_pool) for _ in range(num_workers)]
 
@@ -109,77 +128,690 @@ async def test_acquiring_single_credential_with_retries(db_session):
 
 
 @pytest.mark.asyncio()
-async def test_acquiring_and_releasing_coherence(db_session, caplog):
+async def test_acquiring_and_releasing_coherence(db_session, credentials_pool, tracer):
     async def acquire_and_release(pool: PersistentCredentialsPool) -> None:
         cred = await pool.acquire(max_retries=5, min_wait=0.05)
         await asyncio.sleep(0.01)
         await pool.release(cred)
 
-    def check_log_release(log_msg: str, cred: CredentialMetadata, released: bool) -> bool:
-        log_content = log_msg.split('Credential released: ')
-        if len(log_content) == 2 and log_content[1] == repr(cred):
-            assert not released
-            released = True
-        return released
-
-    def check_log_acquire(log_msg: str, cred: CredentialMetadata, released: bool) -> bool:
-        log_content = log_msg.split('Credential acquired: ')
-        if len(log_content) == 2 and log_content[1] == repr(cred):
-            assert released
-            released = False
-        return released
-
-    caplog.set_level(level=logging.INFO)
-
     credentials = [
         Credential(username='test_user1', password='pass1', in_use=False),
         Credential(username='test_user2', password='pass2', in_use=False),
         Credential(username='test_user3', password='pass3', in_use=False),
     ]
 
-    credential_metadata = [CredentialMetadata.from_orm(cred) for cred in credentials]
-
     async with db_session() as session:
         for credential in credentials:
             session.add(credential)
         await session.commit()
 
-    credentials_pool = PersistentCredentialsPool()
-
     num_workers = 7
     tasks = [acquire_and_release(credentials_pool) for _ in range(num_workers)]
 
     results = await asyncio.gather(*tasks, return_exceptions=True)
     assert results == [None] * num_workers
 
-    credential_released = [True] * len(credentials)
+    # A credential is held from the end of its acquire until the start of its release,
+    # the holding periods of one credential must not overlap.
+    events = tracer.dump()
+    for credential in credentials:
+        acquired = sorted(
+            e['finished_at'] for e in events if e['op'] == 'acquire' and e['credential_id'] == credential.id
+        )
+        released = sorted(
+            e['started_at'] for e in events if e['op'] == 'release' and e['credential_id'] == credential.id
+        )
 
-    for log_message in caplog.messages:
-        for i, metadata in enumerate(credential_metadata):
-            credential_released[i] = check_log_release(log_message, metadata, credential_released[i])
-            credential_released[i] = check_log_acquire(log_message, metadata, credential_released[i])
+        assert len(acquired) == len(released)
+        for previous_release, acquire in zip(released, acquired[1:], strict=False):
+            assert previous_release < acquire
+        for acquire, release in zip(acquired, released, strict=True):
+            assert acquire < release
 
+    assert sum(event['op'] == 'acquire' for event in events) == num_workers
 
-@pytest.mark.asyncio()
-async def test_no_credentials_at_database(db_session):  # noqa: ARG001
-    credentials_pool = PersistentCredentialsPool()
 
+@pytest.mark.asyncio()
+async def test_no_credentials_at_database(credentials_pool):
     with pytest.raises(NoCredentialsAtDatabaseError):
         await credentials_pool.acquire(max_retries=0)
 
 
 @pytest.mark.asyncio()
-async def test_credential_not_found_while_releasing(db_session):
+async def test_credential_not_found_while_releasing(db_session, credentials_pool):
     single_credential = Credential(username='test_user1', password='pass1', in_use=False)
 
     async with db_session() as session:
         session.add(single_credential)
         await session.commit()
 
-    credentials_pool = PersistentCredentialsPool()
+    credential = await credentials_pool.acquire(max_retries=0)
+    credential.id = single_credential.id + 1
+
+    with pytest.raises(CredentialNotFoundError):
+        await credentials_pool.release(credential)
+
+
+@pytest.mark.asyncio()
+async def test_releasing_credential_without_id(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', in_use=False))
+        await session.commit()
 
     credential = await credentials_pool.acquire(max_retries=0)
-    credential.username = 'changed_username'
+    await credentials_pool.release(CredentialMetadata(credential.username, credential.password, credential.cookie))
+
+    assert await credentials_pool.acquire(max_retries=0) == credential
+
+
+@pytest.mark.asyncio()
+async def test_release_notification_wakes_waiter(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', in_use=False))
+        await session.commit()
+
+    acquired_credential = await credentials_pool.acquire(max_retries=0)
+    waiter = asyncio.create_task(credentials_pool.acquire(max_retries=1, min_wait=10))
+    await asyncio.sleep(0.5)
+    assert not waiter.done()
+
+    loop = asyncio.get_running_loop()
+    released_at = loop.time()
+    await credentials_pool.release(acquired_credential)
+
+    assert await waiter == acquired_credential
+    assert loop.time() - released_at < 1
+
+
+@pytest.mark.asyncio()
+async def test_release_notification_wakes_waiter_of_the_released_tag(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', tag='site-a'))
+        session.add(Credential(username='test_user2', password='pass2', tag='site-b'))
+        await session.commit()
+
+    acquired_credentials = await credentials_pool.acquire_many(2, max_retries=0)
+    other_tag_waiter = asyncio.create_task(credentials_pool.acquire(max_retries=1, min_wait=10, tags=['site-a']))
+    await asyncio.sleep(0.5)
+    waiter = asyncio.create_task(credentials_pool.acquire(max_retries=1, min_wait=10, tags=['site-b']))
+    await asyncio.sleep(0.5)
+
+    loop = asyncio.get_running_loop()
+    released_at = loop.time()
+    await credentials_pool.release(
+        next(credential for credential in acquired_credentials if credential.tag == 'site-b')
+    )
+
+    assert (await waiter).username == 'test_user2'
+    assert loop.time() - released_at < 1
+    assert not other_tag_waiter.done()
+    other_tag_waiter.cancel()
+
+
+@pytest.mark.asyncio()
+async def test_acquiring_and_releasing_many_credentials(db_session, credentials_pool):
+    async with db_session() as session:
+        for i in range(5):
+            session.add(Credential(username=f'test_user{i}', password=f'pass{i}', in_use=False))
+        await session.commit()
+
+    acquired_credentials = await credentials_pool.acquire_many(3, max_retries=0)
+    assert len({credential.id for credential in acquired_credentials}) == 3
+
+    remaining_credentials = await credentials_pool.acquire_many(3, min_n=1, max_retries=0)
+    assert len(remaining_credentials) == 2
+
+    await credentials_pool.release_many(acquired_credentials + remaining_credentials)
+
+    assert len(await credentials_pool.acquire_many(5, max_retries=0)) == 5
+
+
+@pytest.mark.asyncio()
+async def test_acquiring_many_credentials_is_all_or_nothing(db_session, credentials_pool):
+    async with db_session() as session:
+        for i in range(3):
+            session.add(Credential(username=f'test_user{i}', password=f'pass{i}', in_use=False))
+        await session.commit()
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire_many(4, min_n=4, max_retries=0)
+
+    assert len(await credentials_pool.acquire_many(3, max_retries=0)) == 3
+
+
+@pytest.mark.asyncio()
+async def test_acquiring_credential_with_expired_lease(db_session):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', in_use=False))
+        await session.commit()
+
+    crashed_pool = PersistentCredentialsPool(lease_ttl=0.1, heartbeat_interval=10)
+    abandoned_credential = await crashed_pool.acquire(max_retries=0)
+    await crashed_pool.close()
+
+    credentials_pool = PersistentCredentialsPool(lease_ttl=10)
+    try:
+        with pytest.raises(NoAvailableCredentialsError):
+            await credentials_pool.acquire(max_retries=0)
 
+        await asyncio.sleep(0.2)
+        assert await credentials_pool.acquire(max_retries=0) == abandoned_credential
+    finally:
+        await credentials_pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_heartbeat_keeps_lease_alive(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', in_use=False))
+        await session.commit()
+
+    live_pool = PersistentCredentialsPool(lease_ttl=0.3, heartbeat_interval=0.05)
+    try:
+        await live_pool.acquire(max_retries=0)
+        await asyncio.sleep(0.6)
+
+        with pytest.raises(NoAvailableCredentialsError):
+            await credentials_pool.acquire(max_retries=0)
+    finally:
+        await live_pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_slot_of_a_crashed_holder_expires_while_other_slots_are_used(db_session, pool_class):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', max_concurrency=2))
+        await session.commit()
+
+    async def active_leases():
+        async with db_session() as session:
+            return (await session.execute(select(Credential.active_leases))).scalar_one()
+
+    crashed_pool = pool_class(lease_ttl=0.3, heartbeat_interval=10)
+    await crashed_pool.acquire(max_retries=0)
+    await crashed_pool.close()
+
+    live_pool = pool_class(lease_ttl=0.3, heartbeat_interval=0.05, reap_interval=0.1)
+    try:
+        held = await live_pool.acquire(max_retries=0)
+        for _ in range(5):
+            await asyncio.sleep(0.1)
+            await live_pool.release(await live_pool.acquire(max_retries=0, timeout=1))
+        # The crashed slot is reaped, the held one is kept alive by the heartbeat.
+        assert await active_leases() == 1
+        await live_pool.release(held)
+    finally:
+        await live_pool.close()
+
+    assert await active_leases() == 0
+
+
+@pytest.mark.asyncio()
+async def test_reaping_expired_leases(db_session, credentials_pool):
+    async with db_session() as session:
+        for i in range(3):
+            session.add(Credential(username=f'test_user{i}', password=f'pass{i}', in_use=False))
+        await session.commit()
+
+    crashed_pool = PersistentCredentialsPool(lease_ttl=0.1, heartbeat_interval=10)
+    await crashed_pool.acquire_many(2, max_retries=0)
+    await crashed_pool.close()
+    await asyncio.sleep(0.2)
+
+    assert await credentials_pool.reap_expired_leases() == 2
+    assert await credentials_pool.reap_expired_leases() == 0
+    assert len(await credentials_pool.acquire_many(3, max_retries=0)) == 3
+
+
+@pytest.mark.asyncio()
+async def test_released_credential_cools_down_before_reuse(db_session, pool_class):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', in_use=False))
+        await session.commit()
+
+    credentials_pool = pool_class(cooldown=0.5)
+    try:
+        credential = await credentials_pool.acquire(max_retries=0)
+        await credentials_pool.release(credential)
+
+        with pytest.raises(NoAvailableCredentialsError):
+            await credentials_pool.acquire(max_retries=0)
+
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+
+        assert await credentials_pool.acquire(max_retries=2, min_wait=10) == credential
+        assert loop.time() - started_at < 2
+    finally:
+        await credentials_pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_credential_is_leased_up_to_max_concurrency(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', max_concurrency=2))
+        session.add(Credential(username='test_user2', password='pass2', max_concurrency=2))
+        await session.commit()
+
+    first_credentials = [await credentials_pool.acquire(max_retries=0) for _ in range(2)]
+    assert {credential.username for credential in first_credentials} == {'test_user1', 'test_user2'}
+
+    second_credentials = [await credentials_pool.acquire(max_retries=0) for _ in range(2)]
+    assert {credential.username for credential in second_credentials} == {'test_user1', 'test_user2'}
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0)
+
+    await credentials_pool.release_many(first_credentials[:1] + second_credentials)
+    acquired_credentials = await credentials_pool.acquire_many(2, max_retries=0)
+    assert {credential.username for credential in acquired_credentials} == {'test_user1', 'test_user2'}
+
+    await credentials_pool.release(first_credentials[1])
+    await credentials_pool.release_many(acquired_credentials)
+    assert len(await credentials_pool.acquire_many(2, max_retries=0)) == 2
+
+
+@pytest.mark.asyncio()
+async def test_acquiring_credentials_by_tags(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', tag='site-a'))
+        session.add(Credential(username='test_user2', password='pass2', tag='site-b'))
+        session.add(Credential(username='test_user3', password='pass3', tag='site-b'))
+        await session.commit()
+
+    credential = await credentials_pool.acquire(max_retries=0, tags=['site-a'])
+    assert credential.username == 'test_user1'
+    assert credential.tag == 'site-a'
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0, tags=['site-a'])
+
+    assert (await credentials_pool.acquire(max_retries=0, tags=['site-a', 'site-b'])).tag == 'site-b'
+    assert len(await credentials_pool.acquire_many(2, min_n=1, max_retries=0, tags=['site-b'])) == 1
+
+    with pytest.raises(NoCredentialsAtDatabaseError):
+        await credentials_pool.acquire(max_retries=0, tags=['site-c'])
+
+
+@pytest.mark.asyncio()
+async def test_statement_timings_are_recorded(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1'))
+        await session.commit()
+
+    credential = await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.release(credential)
+
+    stats = credentials_pool.stats()
+    assert stats['statement_seconds']['count'] == 2
+    assert stats['acquisitions_total'] == stats['releases_total'] == 1
+    assert 'free' not in stats
+
+
+@pytest.mark.asyncio()
+async def test_importing_credentials_updates_existing_ones(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='old', cookie='cookie1', tag='site-a'))
+        await session.commit()
+
+    credential = await credentials_pool.acquire(max_retries=0)
+
+    def record(username, password, cookie=None, tag=None):
+        return {'username': username, 'password': password, 'cookie': cookie, 'max_concurrency': None, 'tag': tag}
+
+    inserted, updated = await import_credentials(
+        iter([record('test_user1', 'new'), record('test_user2', 'pass2'), record('test_user2', 'pass2b', tag='b')]),
+    )
+    assert (inserted, updated) == (1, 1)
+
+    async with db_session() as session:
+        credentials = {c.username: c for c in (await session.execute(select(Credential))).scalars()}
+    assert {username: credential.password for username, credential in credentials.items()} == {
+        'test_user1': 'new',
+        'test_user2': 'pass2b',
+    }
+    assert credentials['test_user1'].cookie == 'cookie1'
+    assert credentials['test_user1'].tag == 'site-a'
+    assert credentials['test_user1'].in_use
+    assert credentials['test_user1'].date_last_usage is not None
+    assert credentials['test_user2'].max_concurrency == 1
+    assert not credentials['test_user2'].in_use
+
+    await credentials_pool.release(credential)
+
+
+@pytest.mark.asyncio()
+async def test_acquire_timeout_is_a_deadline(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', in_use=True, active_leases=1))
+        await session.commit()
+
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    with pytest.raises(NoAvailableCredentialsError, match='within 0.3 seconds'):
+        await credentials_pool.acquire(max_retries=100, min_wait=10, timeout=0.3)
+
+    assert 0.3 <= loop.time() - started_at < 1
+    assert not credentials_pool.release_listener.waiters
+    assert credentials_pool.miss_rate > 0
+
+
+@pytest.mark.asyncio()
+async def test_failed_credential_is_quarantined_exponentially(db_session, credentials_pool, monkeypatch):
+    monkeypatch.setitem(base_credentials_pool.QUARANTINE_SECONDS, FailureKind.RATE_LIMITED, 0.3)
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', in_use=False))
+        await session.commit()
+
+    credential = await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.report_failure(credential, FailureKind.RATE_LIMITED)
+    await credentials_pool.release(credential)
+    assert credential.failure_count == 1
+
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0)
+
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    credential = await credentials_pool.acquire(max_retries=2, min_wait=10)
+    assert loop.time() - started_at < 1
+    assert credential.failure_count == 1
+
+    await credentials_pool.report_failure(CredentialMetadata('test_user1', 'pass1', None), FailureKind.RATE_LIMITED)
+    await credentials_pool.release(credential)
+    async with db_session() as session:
+        stored = (await session.execute(select(Credential))).scalar_one()
+    assert stored.failure_count == 2
+    assert stored.last_failure_kind == 'rate_limited'
+    assert stored.available_at == stored.quarantined_until
+    assert timedelta(seconds=0.5) < stored.quarantined_until - datetime.utcnow() < timedelta(seconds=0.6)
+
+    credential = await credentials_pool.acquire(timeout=2)
+    await credentials_pool.report_success(credential)
+    await credentials_pool.release(credential)
+    async with db_session() as session:
+        stored = (await session.execute(select(Credential))).scalar_one()
+    assert stored.failure_count == 0
+    assert stored.quarantined_until is None
+
+
+@pytest.mark.asyncio()
+async def test_refreshed_cookies_are_written_behind(db_session, pool_class):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', cookie='cookie1'))
+        await session.commit()
+
+    async def stored_cookies():
+        async with db_session() as session:
+            return dict((await session.execute(select(Credential.username, Credential.cookie))).all())
+
+    credentials_pool = pool_class(cookie_flush_size=2, cookie_flush_interval=0.2)
+    try:
+        # Both refreshes are coalesced into one pending write, the pool hands out the pending cookie.
+        credential = await credentials_pool.acquire(max_retries=0)
+        await credentials_pool.release(credential, cookie='cookie1b')
+        credential = await credentials_pool.acquire(max_retries=0)
+        assert credential.cookie == 'cookie1b'
+        await credentials_pool.release_many([credential], cookies=['cookie1c'])
+        assert await stored_cookies() == {'test_user1': 'cookie1'}
+
+        await asyncio.sleep(0.3)
+        assert await stored_cookies() == {'test_user1': 'cookie1c'}
+
+        async with db_session() as session:
+            session.add(Credential(username='test_user2', password='pass2', cookie='cookie2'))
+            await session.commit()
+
+        # Two pending credentials reach the flush size.
+        acquired_credentials = await credentials_pool.acquire_many(2, max_retries=0)
+        await credentials_pool.release_many(acquired_credentials, cookies=['cookie_a', 'cookie_b'])
+        await asyncio.sleep(0.05)
+        assert set((await stored_cookies()).values()) == {'cookie_a', 'cookie_b'}
+
+        credential = await credentials_pool.acquire(max_retries=0)
+        await credentials_pool.release(credential, cookie='cookie_on_close')
+    finally:
+        await credentials_pool.close()
+
+    assert 'cookie_on_close' in (await stored_cookies()).values()
+
+
+@pytest.mark.asyncio()
+async def test_usage_counters_and_strategies(db_session, pool_class):
+    async with db_session() as session:
+        # Never used by date, LRU would hand it out first.
+        session.add(Credential(username='test_user1', password='pass1', usage_count=5, total_hold_ms=100))
+        session.add(
+            Credential(username='test_user2', password='pass2', date_last_usage=datetime.utcnow(), total_hold_ms=500),
+        )
+        await session.commit()
+
+    async def usage_counters():
+        async with db_session() as session:
+            statement = select(Credential.username, Credential.usage_count, Credential.total_hold_ms)
+            return {
+                username: (usage_count, total_hold_ms)
+                for username, usage_count, total_hold_ms in (await session.execute(statement)).all()
+            }
+
+    least_used_pool = pool_class(strategy=SchedulingStrategy.LEAST_USED)
+    least_held_pool = pool_class(strategy=SchedulingStrategy.LEAST_HELD)
+    try:
+        credential = await least_used_pool.acquire(max_retries=0)
+        assert credential.username == 'test_user2'
+        await asyncio.sleep(0.05)
+        await least_used_pool.release(credential)
+
+        # Rows returned by one acquire_many come in no particular order, take the least held one alone.
+        least_held = await least_held_pool.acquire(max_retries=0)
+        assert least_held.username == 'test_user1'
+        acquired_credentials = await least_held_pool.acquire_many(1, max_retries=0)
+        assert [credential.username for credential in acquired_credentials] == ['test_user2']
+        await least_held_pool.release_many([least_held, *acquired_credentials])
+    finally:
+        await least_used_pool.close()
+        await least_held_pool.close()
+
+    counters = await usage_counters()
+    assert counters['test_user1'][0] == 6
+    assert counters['test_user2'][0] == 2
+    assert counters['test_user2'][1] >= 550
+
+    with pytest.raises(ValueError, match='strategies'):
+        pool_class(strategy=SchedulingStrategy.FIFO)
+
+
+@pytest.mark.asyncio()
+async def test_closing_during_a_timed_cookie_flush_keeps_the_cookies(db_session, pool_class, mocker):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', cookie='cookie1'))
+        await session.commit()
+
+    credentials_pool = pool_class(cookie_flush_interval=0.05)
+    execute = credentials_pool._execute  # noqa: SLF001
+    flush_started = asyncio.Event()
+
+    async def slow_execute(statement, parameters):
+        if statement is SAVE_COOKIES_STATEMENT and not flush_started.is_set():
+            flush_started.set()
+            await asyncio.sleep(10)
+        return await execute(statement, parameters)
+
+    mocker.patch.object(credentials_pool, '_execute', slow_execute)
+    credential = await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.release(credential, cookie='cookie1b')
+    await flush_started.wait()
+    await credentials_pool.close()
+
+    async with db_session() as session:
+        assert (await session.execute(select(Credential.cookie))).scalar_one() == 'cookie1b'
+
+
+@pytest.mark.asyncio()
+async def test_failed_cookie_flush_does_not_keep_the_credential_leased(db_session, pool_class, mocker):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', cookie='cookie1'))
+        await session.commit()
+
+    credentials_pool = pool_class(cookie_flush_size=1, cookie_flush_interval=60)
+    execute = credentials_pool._execute  # noqa: SLF001
+
+    async def failing_execute(statement, parameters):
+        if statement is SAVE_COOKIES_STATEMENT:
+            raise OSError('connection lost')
+        return await execute(statement, parameters)
+
+    mocker.patch.object(credentials_pool, '_execute', failing_execute)
+    try:
+        credential = await credentials_pool.acquire(max_retries=0)
+        await credentials_pool.release(credential, cookie='cookie1b')
+        await asyncio.sleep(0.05)
+
+        async with db_session() as session:
+            stored = (await session.execute(select(Credential))).scalar_one()
+        assert (stored.in_use, stored.active_leases, stored.cookie) == (False, 0, 'cookie1')
+        # The cookie stays buffered for the next flush.
+        assert (await credentials_pool.acquire(max_retries=0)).cookie == 'cookie1b'
+    finally:
+        mocker.patch.object(credentials_pool, '_execute', execute)
+        await credentials_pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_buffered_cookie_does_not_overwrite_a_newer_one(db_session, pool_class):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', cookie='cookie1'))
+        await session.commit()
+
+    first_pool = pool_class(cookie_flush_interval=60)
+    second_pool = pool_class(cookie_flush_interval=60)
+    try:
+        credential = await first_pool.acquire(max_retries=0)
+        await first_pool.release(credential, cookie='stale_cookie')
+
+        credential = await second_pool.acquire(max_retries=0)
+        await second_pool.release(credential, cookie='newer_cookie')
+        await second_pool.flush_cookies()
+        # The first pool drops its stale buffered cookie instead of handing it out.
+        credential = await first_pool.acquire(max_retries=0)
+        assert credential.cookie == 'newer_cookie'
+        await first_pool.release(credential)
+        await first_pool.flush_cookies()
+    finally:
+        await first_pool.close()
+        await second_pool.close()
+
+    async with db_session() as session:
+        assert (await session.execute(select(Credential.cookie))).scalar_one() == 'newer_cookie'
+
+
+@pytest.mark.asyncio()
+async def test_buffered_cookie_is_written_after_a_use_elsewhere(db_session, pool_class):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', cookie='cookie1'))
+        await session.commit()
+
+    first_pool = pool_class(cookie_flush_interval=60)
+    second_pool = pool_class(cookie_flush_interval=60)
+    try:
+        credential = await first_pool.acquire(max_retries=0)
+        await first_pool.release(credential, cookie='fresh_cookie')
+
+        # Used elsewhere without refreshing the cookie before the flush.
+        await second_pool.release(await second_pool.acquire(max_retries=0))
+        await first_pool.flush_cookies()
+    finally:
+        await first_pool.close()
+        await second_pool.close()
+
+    async with db_session() as session:
+        assert (await session.execute(select(Credential.cookie))).scalar_one() == 'fresh_cookie'
+
+
+@pytest.mark.asyncio()
+async def test_only_leased_slots_are_released_and_reaped(db_session, credentials_pool):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1', max_concurrency=2))
+        await session.commit()
+
+    started_at = time.perf_counter()
+    credential = await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.release(credential)
     with pytest.raises(CredentialNotFoundError):
         await credentials_pool.release(credential)
+    with pytest.raises(CredentialNotFoundError):
+        await credentials_pool.release_many([credential, credential])
+
+    crashed_pool = PersistentCredentialsPool(lease_ttl=0.1, heartbeat_interval=10)
+    crashed_credential = await crashed_pool.acquire(max_retries=0)
+    await crashed_pool.close()
+    await asyncio.sleep(0.2)
+    assert await credentials_pool.reap_expired_leases() == 1
+    elapsed_ms = (time.perf_counter() - started_at) * 1000
+
+    with pytest.raises(CredentialNotFoundError):
+        await credentials_pool.release(crashed_credential)
+    async with db_session() as session:
+        total_hold_ms = (await session.execute(select(Credential.total_hold_ms))).scalar_one()
+    # Only the slot that was held counts, not every slot of the credential.
+    assert 200 <= total_hold_ms <= elapsed_ms
+
+
+@pytest.mark.asyncio()
+async def test_cancelled_acquire_gives_back_what_it_took(db_session, credentials_pool, mocker):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1'))
+        session.add(Credential(username='test_user2', password='pass2'))
+        await session.commit()
+
+    execute = credentials_pool._execute  # noqa: SLF001
+    taken = asyncio.Event()
+
+    async def slow_after_commit(statement, parameters):
+        rows = await execute(statement, parameters)
+        if rows and not taken.is_set():
+            taken.set()
+            await asyncio.sleep(0.1)
+        return rows
+
+    mocker.patch.object(credentials_pool, '_execute', slow_after_commit)
+    acquiring = asyncio.create_task(credentials_pool.acquire_many(2, max_retries=0))
+    await taken.wait()
+    acquiring.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await acquiring
+
+    await asyncio.sleep(0.2)
+    assert len(await credentials_pool.acquire_many(2, max_retries=0)) == 2
+
+
+@pytest.mark.asyncio()
+async def test_lease_cancelled_while_acquiring_leaks_nothing(db_session, credentials_pool, mocker):
+    async with db_session() as session:
+        session.add(Credential(username='test_user1', password='pass1'))
+        await session.commit()
+
+    execute = credentials_pool._execute  # noqa: SLF001
+    taken = asyncio.Event()
+
+    async def slow_after_commit(statement, parameters):
+        rows = await execute(statement, parameters)
+        if rows and not taken.is_set():
+            taken.set()
+            await asyncio.sleep(0.1)
+        return rows
+
+    async def use_credential():
+        async with credentials_pool.lease(max_retries=0):
+            await asyncio.sleep(10)
+
+    mocker.patch.object(credentials_pool, '_execute', slow_after_commit)
+    worker = asyncio.create_task(use_credential())
+    await taken.wait()
+    worker.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await worker
+
+    await asyncio.sleep(0.2)
+    async with credentials_pool.lease(max_retries=0) as credential:
+        assert credential.username == 'test_user1'
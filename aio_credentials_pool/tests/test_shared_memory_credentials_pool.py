@@ -0,0 +1,162 @@
+import asyncio
+import multiprocessing
+import tempfile
+import uuid
+from contextlib import suppress
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+import pytest
+
+import shared_memory_credentials_pool
+from base_credentials_pool import CredentialMetadata, CredentialNotFoundError, NoAvailableCredentialsError
+from shared_memory_credentials_pool import FileLock, SharedMemoryCredentialsPool
+
+
+@pytest.fixture()
+def credentials():
+    return [
+        CredentialMetadata('user1', 'pass1', 'cookie1'),
+        CredentialMetadata('user2', 'pass2', None, max_concurrency=2, tag='site-a'),
+        CredentialMetadata('user3', 'pass3', None, tag='site-b'),
+    ]
+
+
+@pytest.fixture()
+def pool_name():
+    name = f'test_pool_{uuid.uuid4().hex[:8]}'
+    yield name
+    with suppress(FileNotFoundError):
+        SharedMemory(name).unlink()
+    (Path(tempfile.gettempdir()) / f'{name}.lock').unlink(missing_ok=True)
+
+
+def acquire_and_exit(credentials, pool_name):
+    pool = SharedMemoryCredentialsPool(credentials, pool_name)
+    asyncio.run(pool.acquire_many(4, max_retries=0))
+
+
+def acquire_and_wait(credentials, pool_name, acquired, stop):
+    acquire_and_exit(credentials, pool_name)
+    acquired.set()
+    stop.wait()
+
+
+@pytest.mark.asyncio()
+async def test_acquire_and_release(credentials, pool_name):
+    pool = SharedMemoryCredentialsPool(credentials, pool_name)
+
+    acquired = [await pool.acquire(max_retries=0) for _ in range(4)]
+    assert sorted(credential.username for credential in acquired) == ['user1', 'user2', 'user2', 'user3']
+    assert pool.stats()['free'] == 0
+    with pytest.raises(NoAvailableCredentialsError):
+        await pool.acquire(max_retries=0)
+
+    await pool.release_many(acquired[:2])
+    await pool.release(acquired[2])
+    assert pool.stats()['free'] == 3
+    assert (await pool.acquire(max_retries=0, tags=['site-b', 'site-a'])).tag in {'site-a', 'site-b'}
+    with pytest.raises(CredentialNotFoundError, match='not leased'):
+        await pool.release(CredentialMetadata('user4', 'pass4', None))
+
+    await pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_pools_with_the_same_name_share_their_state(credentials, pool_name):
+    first_pool = SharedMemoryCredentialsPool(credentials, pool_name)
+    second_pool = SharedMemoryCredentialsPool(credentials, pool_name)
+
+    site_a_credentials = await first_pool.acquire_many(2, max_retries=0, tags=['site-a'])
+    assert {credential.username for credential in site_a_credentials} == {'user2'}
+    with pytest.raises(NoAvailableCredentialsError):
+        await second_pool.acquire(max_retries=0, tags=['site-a'])
+
+    await first_pool.release(site_a_credentials[0])
+    assert (await second_pool.acquire(max_retries=0, tags=['site-a'])).username == 'user2'
+
+    with pytest.raises(ValueError, match='other credentials'):
+        SharedMemoryCredentialsPool(credentials[:2], pool_name)
+
+    await first_pool.close()
+    await second_pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_slots_of_exited_processes_are_reclaimed(credentials, pool_name):
+    pool = SharedMemoryCredentialsPool(credentials, pool_name)
+
+    process = multiprocessing.get_context('fork').Process(target=acquire_and_exit, args=(credentials, pool_name))
+    process.start()
+    process.join()
+    assert pool.stats()['free'] == 0
+
+    acquired = await pool.acquire_many(4, max_retries=0)
+    assert len(acquired) == 4
+    await pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_waiting_for_the_lock_does_not_block_the_event_loop(credentials, pool_name):
+    pool = SharedMemoryCredentialsPool(credentials, pool_name)
+    # Another open file description of the lock file contends like another process would.
+    other_process_lock = FileLock(Path(tempfile.gettempdir()) / f'{pool_name}.lock')
+
+    with other_process_lock:
+        acquiring = asyncio.create_task(pool.acquire(max_retries=0))
+        await asyncio.sleep(0.05)
+        assert not acquiring.done()
+
+    assert (await acquiring).username in {'user1', 'user2', 'user3'}
+    other_process_lock.close()
+    await pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_failed_or_cancelled_release_leaves_the_slots_releasable(credentials, pool_name):
+    pool = SharedMemoryCredentialsPool(credentials, pool_name)
+    other_process_lock = FileLock(Path(tempfile.gettempdir()) / f'{pool_name}.lock')
+    acquired = await pool.acquire_many(2, max_retries=0)
+
+    with pytest.raises(CredentialNotFoundError):
+        await pool.release_many([*acquired, CredentialMetadata('user4', 'pass4', None)])
+
+    with other_process_lock:
+        releasing = asyncio.create_task(pool.release_many(acquired))
+        await asyncio.sleep(0.05)
+        releasing.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await releasing
+
+    assert pool.stats()['free'] == 2
+    await pool.release_many(acquired)
+    assert pool.stats()['free'] == 4
+    other_process_lock.close()
+    await pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_reclaiming_is_rate_limited(credentials, pool_name, mocker):
+    pool = SharedMemoryCredentialsPool(credentials, pool_name, reclaim_interval=0.2)
+    process_exists = mocker.spy(shared_memory_credentials_pool, 'process_exists')
+
+    context = multiprocessing.get_context('fork')
+    acquired, stop = context.Event(), context.Event()
+    process = context.Process(target=acquire_and_wait, args=(credentials, pool_name, acquired, stop))
+    process.start()
+    try:
+        acquired.wait()
+        for _ in range(3):
+            with pytest.raises(NoAvailableCredentialsError):
+                await pool.acquire(max_retries=0)
+        # One check for the single owner of the four slots, the misses after it are within the interval.
+        assert process_exists.call_count == 1
+
+        await asyncio.sleep(0.25)
+        with pytest.raises(NoAvailableCredentialsError):
+            await pool.acquire(max_retries=0)
+        assert process_exists.call_count == 2
+    finally:
+        stop.set()
+        process.join()
+    await pool.close()
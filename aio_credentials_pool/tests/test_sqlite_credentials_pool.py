@@ -0,0 +1,207 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+import pytest_asyncio
+
+import base_credentials_pool
+from base_credentials_pool import (
+    CredentialMetadata,
+    CredentialNotFoundError,
+    FailureKind,
+    NoAvailableCredentialsError,
+)
+from credentials_store import SchedulingStrategy
+from sqlite_credentials_pool import SqliteCredentialsPool
+
+
+@pytest.fixture()
+def credentials():
+    return [
+        CredentialMetadata('user1', 'pass1', 'cookie1'),
+        CredentialMetadata('user2', 'pass2', None, max_concurrency=2, tag='site-a'),
+        CredentialMetadata('user3', 'pass3', None, tag='site-b'),
+    ]
+
+
+@pytest.fixture()
+def path(tmp_path):
+    return tmp_path / 'credentials.sqlite3'
+
+
+@pytest_asyncio.fixture()
+async def credentials_pool(path, credentials):
+    pool = SqliteCredentialsPool(path, credentials)
+    yield pool
+    await pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_acquire_and_release(credentials_pool):
+    # Like in the persistent pool, a batch takes one slot per credential.
+    acquired = await credentials_pool.acquire_many(4, min_n=1, max_retries=0)
+    acquired.append(await credentials_pool.acquire(max_retries=0))
+    assert sorted(credential.username for credential in acquired) == ['user1', 'user2', 'user2', 'user3']
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0)
+
+    await credentials_pool.release_many(acquired[:3])
+    # The second slot of user2 is still held.
+    released = next(credential for credential in acquired[:3] if credential.username != 'user2')
+    with pytest.raises(CredentialNotFoundError, match='found leased'):
+        await credentials_pool.release(released)
+    assert (await credentials_pool.acquire(max_retries=0, tags=['site-b', 'site-a'])).tag in {'site-a', 'site-b'}
+    with pytest.raises(CredentialNotFoundError, match='found leased'):
+        await credentials_pool.release(CredentialMetadata('user4', 'pass4', None))
+
+
+@pytest.mark.asyncio()
+async def test_concurrent_operations_share_a_transaction(credentials_pool):
+    acquired = await asyncio.gather(*(credentials_pool.acquire(max_retries=0) for _ in range(4)))
+    await asyncio.gather(*(credentials_pool.release(credential) for credential in acquired))
+
+    assert credentials_pool.stats()['statement_seconds']['count'] < 8
+
+
+@pytest.mark.asyncio()
+async def test_release_wakes_waiter(credentials_pool):
+    acquired = [await credentials_pool.acquire(max_retries=0) for _ in range(4)]
+
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    waiter = asyncio.create_task(credentials_pool.acquire(max_retries=1, min_wait=10))
+    await asyncio.sleep(0.05)
+    await credentials_pool.release(acquired[0])
+
+    assert (await waiter).username == acquired[0].username
+    assert loop.time() - started_at < 1
+
+
+@pytest.mark.asyncio()
+async def test_release_wakes_waiter_of_the_released_tag(credentials_pool):
+    acquired = [await credentials_pool.acquire(max_retries=0) for _ in range(4)]
+
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    other_tag_waiter = asyncio.create_task(credentials_pool.acquire(max_retries=1, min_wait=10, tags=['site-a']))
+    waiter = asyncio.create_task(credentials_pool.acquire(max_retries=1, min_wait=10, tags=['site-b']))
+    await asyncio.sleep(0.05)
+    await credentials_pool.release(next(credential for credential in acquired if credential.tag == 'site-b'))
+
+    assert (await waiter).username == 'user3'
+    assert loop.time() - started_at < 1
+    assert not other_tag_waiter.done()
+    other_tag_waiter.cancel()
+
+
+@pytest.mark.asyncio()
+async def test_state_survives_a_restart(path, credentials, monkeypatch):
+    monkeypatch.setitem(base_credentials_pool.QUARANTINE_SECONDS, FailureKind.BANNED, 60)
+    credentials_pool = SqliteCredentialsPool(path, credentials)
+    credential = await credentials_pool.acquire(max_retries=0, tags=['site-b'])
+    await credentials_pool.report_failure(credential, FailureKind.BANNED)
+    await credentials_pool.release(credential)
+    credential = await credentials_pool.acquire(max_retries=0, tags=['site-a'])
+    await credentials_pool.release(credential, cookie='cookie2')
+    # Held when the process stops.
+    await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.close()
+
+    credentials_pool = SqliteCredentialsPool(path, [*credentials, CredentialMetadata('user4', 'pass4', None)])
+    try:
+        acquired = [await credentials_pool.acquire(max_retries=0) for _ in range(4)]
+        assert sorted(credential.username for credential in acquired) == ['user1', 'user2', 'user2', 'user4']
+        assert {credential.username: credential.cookie for credential in acquired}['user2'] == 'cookie2'
+        with pytest.raises(NoAvailableCredentialsError):
+            await credentials_pool.acquire(max_retries=0, tags=['site-b'])
+    finally:
+        await credentials_pool.close()
+
+
+@pytest.mark.asyncio()
+async def test_least_used_strategy_counts_uses_and_hold_time(path, credentials):
+    credentials_pool = SqliteCredentialsPool(path, credentials, strategy=SchedulingStrategy.LEAST_USED)
+    try:
+        first = await credentials_pool.acquire(max_retries=0)
+        for _ in range(3):
+            await credentials_pool.release(await credentials_pool.acquire(max_retries=0))
+        await asyncio.sleep(0.05)
+        await credentials_pool.release(first)
+    finally:
+        await credentials_pool.close()
+
+    connection = sqlite3.connect(path)
+    try:
+        counters = {
+            row[0]: row[1:]
+            for row in connection.execute('SELECT username, usage_count, total_hold_ms FROM credentials')
+        }
+    finally:
+        connection.close()
+    # Every credential was used once before any of them was used twice.
+    assert sorted(usage_count for usage_count, _ in counters.values()) == [1, 1, 2]
+    assert counters[first.username][1] >= 50
+
+    with pytest.raises(ValueError, match='strategies'):
+        SqliteCredentialsPool(path, strategy=SchedulingStrategy.FIFO)
+
+
+@pytest.mark.asyncio()
+async def test_failing_operation_only_fails_itself(credentials_pool):
+    writer_busy = threading.Event()
+
+    def wait_for_batch(_connection, _now):
+        writer_busy.wait()
+
+    def fail(connection, _now):
+        connection.exec_driver_sql("UPDATE credentials SET cookie = 'lost' WHERE username = 'user1'")
+        error_message = 'failed operation'
+        raise RuntimeError(error_message)
+
+    # The writer thread is held up until every operation below is queued, so they all run in one batch.
+    blocker = credentials_pool._submit(wait_for_batch)  # noqa: SLF001
+    operations = asyncio.gather(
+        *(credentials_pool.acquire(max_retries=0) for _ in range(3)),
+        credentials_pool._submit(fail),  # noqa: SLF001
+        return_exceptions=True,
+    )
+    await asyncio.sleep(0.05)
+    writer_busy.set()
+    await blocker
+
+    *acquired, error = await operations
+    assert isinstance(error, RuntimeError)
+    assert all(isinstance(credential, CredentialMetadata) for credential in acquired)
+    await credentials_pool.release_many(acquired)
+
+    connection = sqlite3.connect(credentials_pool.path)
+    try:
+        assert connection.execute("SELECT cookie FROM credentials WHERE username = 'user1'").fetchone() == ('cookie1',)
+    finally:
+        connection.close()
+
+
+@pytest.mark.asyncio()
+async def test_failed_release_keeps_the_refreshed_cookie(credentials_pool, mocker):
+    release_rows = credentials_pool._release_rows  # noqa: SLF001
+    calls = []
+
+    def fail_first_release(*args, **kwargs):
+        calls.append(args)
+        # The batch and its isolated rerun.
+        if len(calls) <= 2:
+            error_message = 'disk I/O error'
+            raise RuntimeError(error_message)
+        return release_rows(*args, **kwargs)
+
+    mocker.patch.object(credentials_pool, '_release_rows', fail_first_release)
+
+    credential = await credentials_pool.acquire(max_retries=0, tags=['site-b'])
+    with pytest.raises(RuntimeError):
+        await credentials_pool.release(credential, cookie='cookie3')
+    await credentials_pool.release(credential)
+
+    assert (await credentials_pool.acquire(max_retries=0, tags=['site-b'])).cookie == 'cookie3'
+    with pytest.raises(CredentialNotFoundError):
+        await credentials_pool.report_failure(CredentialMetadata('user4', 'pass4', None))
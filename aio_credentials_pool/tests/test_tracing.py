@@ -0,0 +1,35 @@
+import io
+import json
+
+import pytest
+
+from base_credentials_pool import CredentialMetadata, NoAvailableCredentialsError
+from in_memory_credentials_pool import InMemoryCredentialsPool
+from tracing import TraceOp, Tracer
+
+
+def test_ring_buffer_keeps_latest_sampled_events():
+    tracer = Tracer(capacity=3, sample_every=2, enabled=True)
+    for credential_id in range(10):
+        tracer.record(TraceOp.ACQUIRE, credential_id, 0.0, 1.0)
+
+    assert [event['credential_id'] for event in tracer.dump()] == [5, 7, 9]
+
+    file = io.StringIO()
+    tracer.dump_to(file)
+    assert json.loads(file.getvalue().splitlines()[0])['op'] == 'acquire'
+
+
+@pytest.mark.asyncio()
+async def test_pool_operations_are_traced(tracer):
+    credentials_pool = InMemoryCredentialsPool([CredentialMetadata('user1', 'pass1', None, id=1)])
+
+    credential = await credentials_pool.acquire(max_retries=0)
+    with pytest.raises(NoAvailableCredentialsError):
+        await credentials_pool.acquire(max_retries=0)
+    await credentials_pool.release(credential)
+
+    events = tracer.dump()
+    assert [event['op'] for event in events] == ['acquire', 'miss', 'failure', 'release']
+    assert events[0]['credential_id'] == events[3]['credential_id'] == 1
+    assert all(event['started_at'] <= event['finished_at'] for event in events)
@@ -0,0 +1,73 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import suppress
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+import worker
+from in_memory_credentials_pool import read_credentials
+from shared_memory_credentials_pool import SharedMemoryCredentialsPool
+from worker import CREDENTIALS_FILE, split_workers
+
+WORKER_DIRECTORY = Path(worker.__file__).parent
+WORKER_COMMAND = [sys.executable, 'worker.py', '--processes', '2', '--pool_type', 'shared_memory', '--workers', '4']
+
+
+def wait_for(condition, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def segment_exists(name: str) -> bool:
+    try:
+        SharedMemory(name).close()
+    except (FileNotFoundError, ValueError):
+        # Not created yet, or created but not sized yet.
+        return False
+    return True
+
+
+def test_workers_are_split_evenly_across_processes():
+    assert split_workers(10, 3) == [4, 3, 3]
+    assert split_workers(2, 4) == [1, 1, 0, 0]
+    assert sum(split_workers(2000, 7)) == 2000
+
+
+def test_processes_release_everything_and_the_segment_is_removed_on_sigterm():
+    process = subprocess.Popen(
+        WORKER_COMMAND,  # noqa: S603
+        cwd=WORKER_DIRECTORY,
+        # A process group of its own, so a failed run kills the forked processes as well.
+        start_new_session=True,
+    )
+    name = f'aio_credentials_pool_{process.pid}'
+    pool = None
+    try:
+        wait_for(lambda: segment_exists(name))
+        # Attached before the parent unlinks the segment, so its mapping outlives it.
+        pool = SharedMemoryCredentialsPool(read_credentials(WORKER_DIRECTORY / CREDENTIALS_FILE), name)
+        slot_count = len(pool.slot_rows)
+        # Both processes hold slots, so both have their signal handlers in place.
+        wait_for(lambda: len(set(pool.owners) - {0}) == 2)
+
+        process.send_signal(signal.SIGTERM)
+        # Non-zero if any of the forked processes failed.
+        assert process.wait(timeout=30) == 0
+        assert pool._free_count() == slot_count  # noqa: SLF001
+        assert not segment_exists(name)
+    finally:
+        if pool is not None:
+            asyncio.run(pool.close())
+        with suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        with suppress(FileNotFoundError):
+            SharedMemory(name).unlink()
+        (Path(tempfile.gettempdir()) / f'{name}.lock').unlink(missing_ok=True)
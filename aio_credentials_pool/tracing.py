@@ -0,0 +1,79 @@
+import json
+from array import array
+from enum import IntEnum
+from typing import TextIO
+
+
+class TraceOp(IntEnum):
+    ACQUIRE = 1
+    RELEASE = 2
+    MISS = 3
+    FAILURE = 4
+
+
+class Tracer:
+    """Ring buffer of the last ``capacity`` pool events, stored column-wise in preallocated arrays.
+
+    Recording an event writes five numbers and allocates nothing. Hot paths guard it with ``if TRACER.enabled``,
+    so a disabled tracer costs a single branch. With ``sample_every`` set to n, only every n-th event is kept.
+    Credentials without an id, such as those of the in-memory pool, are recorded with id -1.
+    """
+
+    def __init__(self, capacity: int = 65536, sample_every: int = 1, *, enabled: bool = False):
+        self.capacity = capacity
+        self.sample_every = sample_every
+        self.enabled = enabled
+        self.ops = array('B', bytes(capacity))
+        self.credential_ids = array('q', [0]) * capacity
+        self.started_at = array('d', [0.0]) * capacity
+        self.finished_at = array('d', [0.0]) * capacity
+        self.attempts = array('I', [0]) * capacity
+        self.seen = 0
+        self.recorded = 0
+
+    def record(  # noqa: PLR0913
+        self,
+        op: TraceOp,
+        credential_id: int | None,
+        started_at: float,
+        finished_at: float,
+        attempt: int = 0,
+    ) -> None:
+        self.seen += 1
+        if self.sample_every > 1 and self.seen % self.sample_every:
+            return
+
+        index = self.recorded % self.capacity
+        self.ops[index] = op
+        self.credential_ids[index] = -1 if credential_id is None else credential_id
+        self.started_at[index] = started_at
+        self.finished_at[index] = finished_at
+        self.attempts[index] = attempt
+        self.recorded += 1
+
+    def clear(self) -> None:
+        self.seen = self.recorded = 0
+
+    def dump(self) -> list[dict]:
+        """The buffered events, oldest first. Timestamps are ``time.perf_counter`` seconds."""
+        events = []
+        for position in range(max(0, self.recorded - self.capacity), self.recorded):
+            index = position % self.capacity
+            events.append(
+                {
+                    'op': TraceOp(self.ops[index]).name.lower(),
+                    'credential_id': self.credential_ids[index],
+                    'started_at': self.started_at[index],
+                    'finished_at': self.finished_at[index],
+                    'attempt': self.attempts[index],
+                },
+            )
+        return events
+
+    def dump_to(self, file: TextIO) -> None:
+        """Write the buffered events as JSON lines."""
+        for event in self.dump():
+            file.write(json.dumps(event) + '\n')
+
+
+TRACER = Tracer()
@@ -1,37 +1,42 @@
 import argparse
 import asyncio
-import json
 import logging
+import multiprocessing
+import os
 import random
 import signal
 from pathlib import Path
 
-from base_credentials_pool import BaseCredentialsPool, CredentialMetadata
-from in_memory_credentials_pool import InMemoryCredentialsPool
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import persistent_credentials_pool
+from base_credentials_pool import BaseCredentialsPool
+from cached_credentials_pool import CachedCredentialsPool
+from in_memory_credentials_pool import InMemoryCredentialsPool, read_credentials
+from metrics import start_metrics_server
 from persistent_credentials_pool import PersistentCredentialsPool
+from settings import POSTGRES_URL
+from shared_memory_credentials_pool import SharedMemoryCredentialsPool
+from sqlite_credentials_pool import SqliteCredentialsPool
+from tracing import TRACER
 
 LOGGER = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=logging.INFO, format='%(processName)s %(levelname)s:%(name)s:%(message)s')
 
-stop_event = asyncio.Event()
+CREDENTIALS_FILE = Path('fixtures/credentials.json')
+SQLITE_FILE = Path('credentials.sqlite3')
+FORWARDED_SIGNALS = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1)
 
+stop_event = asyncio.Event()
 
-async def worker(pool, worker_id: int):
-    credential = None
 
+async def worker(pool: BaseCredentialsPool, worker_id: int, tags: list[str] | None):
     while not stop_event.is_set():
         try:
-            credential = await pool.acquire()
-            if credential:
-                LOGGER.info(f'Worker {worker_id} acquired credentials: {credential}')
+            async with pool.lease(tags=tags):
                 await asyncio.sleep(random.randint(1, 5))
-                await pool.release(credential)
-                LOGGER.info(f'Worker {worker_id} released credentials: {credential}')
         except Exception:
             LOGGER.exception(f'Worker {worker_id} encountered an error')
-        finally:
-            if stop_event.is_set() and credential:
-                await pool.release(credential)
         await asyncio.sleep(random.randint(1, 5))
 
 
@@ -41,40 +46,170 @@ async def shutdown(sig: signal.Signals) -> None:
     stop_event.set()
 
 
-async def main(pool: BaseCredentialsPool, num_workers: int) -> None:
+def dump_trace() -> None:
+    trace_file = Path(f'trace-{os.getpid()}.jsonl')
+    with trace_file.open('w') as file:
+        TRACER.dump_to(file)
+    LOGGER.info(f'Dumped {min(TRACER.recorded, TRACER.capacity)} trace events to {trace_file}')
+
+
+async def main(pool: BaseCredentialsPool, num_workers: int, tags: list[str] | None, metrics_port: int | None) -> None:
     loop = asyncio.get_event_loop()
 
+    if metrics_port is not None:
+        metrics_server = await start_metrics_server(port=metrics_port)
+        LOGGER.info(f'Serving metrics on http://127.0.0.1:{metrics_port}/metrics')
+
     signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
     for s in signals:
         loop.add_signal_handler(s, lambda s=s: loop.create_task(shutdown(s)))
+    loop.add_signal_handler(signal.SIGUSR1, dump_trace)
 
-    worker_tasks = [loop.create_task(worker(pool, i)) for i in range(num_workers)]
+    worker_tasks = [loop.create_task(worker(pool, i, tags)) for i in range(num_workers)]
 
     await asyncio.gather(*worker_tasks)
+    await pool.close()
+
+    if metrics_port is not None:
+        metrics_server.close()
+
+
+def create_pool(args: argparse.Namespace) -> BaseCredentialsPool:
+    if args.pool_type == 'in_memory':
+        return InMemoryCredentialsPool.from_file(CREDENTIALS_FILE, cooldown=args.cooldown)
+    if args.pool_type == 'shared_memory':
+        return SharedMemoryCredentialsPool(read_credentials(CREDENTIALS_FILE), args.shared_memory_name)
+    if args.pool_type == 'sqlite':
+        return SqliteCredentialsPool(SQLITE_FILE, read_credentials(CREDENTIALS_FILE), cooldown=args.cooldown)
+
+    pool = PersistentCredentialsPool(lease_ttl=args.lease_ttl, reap_interval=args.lease_ttl, cooldown=args.cooldown)
+    if args.pool_type == 'cached':
+        return CachedCredentialsPool(pool, tags=args.tags)
+    return pool
+
+
+def run(args: argparse.Namespace, num_workers: int, metrics_port: int | None) -> None:
+    asyncio.run(main(create_pool(args), num_workers, args.tags, metrics_port))
+
+
+def run_process(args: argparse.Namespace, num_workers: int, metrics_port: int | None) -> None:
+    # An engine of its own, so no connection pool is ever shared through fork.
+    engine = create_async_engine(POSTGRES_URL)
+    persistent_credentials_pool.async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
+    run(args, num_workers, metrics_port)
+
+
+def split_workers(num_workers: int, num_processes: int) -> list[int]:
+    """Number of workers of every process, differing by at most one."""
+    return [num_workers // num_processes + (index < num_workers % num_processes) for index in range(num_processes)]
+
+
+def run_processes(args: argparse.Namespace) -> None:
+    """Fork ``args.processes`` processes, each running its share of the workers on its own event loop and pool.
+
+    Exit signals and ``SIGUSR1`` are forwarded to every process, and the call returns once all of them have
+    stopped their workers and released their credentials, exiting with status 1 if any of them failed. Process i
+    serves its metrics on ``metrics_port + i``.
+    """
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for index, num_workers in enumerate(split_workers(args.workers, args.processes)):
+        metrics_port = None if args.metrics_port is None else args.metrics_port + index
+        process = context.Process(target=run_process, args=(args, num_workers, metrics_port), name=f'worker-{index}')
+        process.start()
+        processes.append(process)
+
+    def forward(signal_number: int, _frame) -> None:
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal_number)
+
+    for s in FORWARDED_SIGNALS:
+        signal.signal(s, forward)
+
+    failed = False
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            LOGGER.error(f'Process {process.name} exited with code {process.exitcode}')
+            failed = True
+    if failed:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run workers with specified concurrency')
-    parser.add_argument('--workers', type=int, default=2000, help='Number of workers')
+    parser.add_argument('--workers', type=int, default=2000, help='Number of workers, split across the processes')
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='Number of processes, each with its own event loop and database connections',
+    )
     parser.add_argument(
         '--pool_type',
-        choices=['in_memory', 'persistent'],
+        choices=['in_memory', 'shared_memory', 'sqlite', 'persistent', 'cached'],
         default='persistent',
         help='Type of credentials pool',
     )
 
+    parser.add_argument(
+        '--lease_ttl',
+        type=float,
+        default=None,
+        help='Seconds after which credentials held by a crashed process are reclaimed (persistent pools only)',
+    )
+
+    parser.add_argument(
+        '--cooldown',
+        type=float,
+        default=None,
+        help='Seconds a released credential rests before it can be acquired again',
+    )
+
+    parser.add_argument(
+        '--tags',
+        nargs='+',
+        default=None,
+        help='Only use credentials with one of these tags, preferring earlier ones',
+    )
+
+    parser.add_argument(
+        '--metrics_port',
+        type=int,
+        default=None,
+        help='Serve pool metrics in the Prometheus text format on this local port',
+    )
+
+    parser.add_argument(
+        '--trace_sample_every',
+        type=int,
+        default=None,
+        help='Trace every n-th pool event into a ring buffer, dumped to trace-<pid>.jsonl on SIGUSR1',
+    )
+
     args = parser.parse_args()
 
-    if args.pool_type == 'in_memory':
-        credentials_file = Path('fixtures/credentials.json')
-
-        with credentials_file.open() as f:
-            credentials = [
-                CredentialMetadata(username=c['username'], password=c['password'], cookie=c['cookie'])
-                for c in json.load(f)
-            ]
-        pool = InMemoryCredentialsPool(credentials)
-    else:
-        pool = PersistentCredentialsPool()
-
-    asyncio.run(main(pool, args.workers))
+    if args.trace_sample_every:
+        TRACER.sample_every = args.trace_sample_every
+        TRACER.enabled = True
+
+    if args.pool_type in {'in_memory', 'sqlite'} and args.processes > 1:
+        parser.error(
+            f'An {args.pool_type} pool is private to its process, use --pool_type shared_memory with --processes',
+        )
+
+    owner_pool = None
+    if args.pool_type == 'shared_memory':
+        args.shared_memory_name = f'aio_credentials_pool_{os.getpid()}'
+        owner_pool = SharedMemoryCredentialsPool(read_credentials(CREDENTIALS_FILE), args.shared_memory_name)
+
+    try:
+        if args.processes > 1:
+            run_processes(args)
+        else:
+            run(args, args.workers, args.metrics_port)
+    finally:
+        if owner_pool is not None:
+            owner_pool.unlink()
+            asyncio.run(owner_pool.close())